@@ -1,14 +1,21 @@
 from datetime import timedelta, timezone, datetime
+import secrets
 from typing_extensions import Annotated
-from fastapi import APIRouter, Depends, status, HTTPException
+from typing import Optional
+from fastapi import APIRouter, Depends, status, HTTPException, Query, Request
+from starlette.requests import HTTPConnection
 from pydantic import BaseModel
 from models.user import User
-from passlib.context import CryptContext
-from sqlalchemy.orm import Session
-from settings.database import SessionLocal
+from auth.hashing import bcrypt_context, hash_password, verify_password
+from auth.throttle import LoginThrottle
+from auth.token_cache import TokenCache
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from settings.database import AsyncSessionLocal
 from fastapi.security import OAuth2PasswordRequestForm, OAuth2PasswordBearer
 from jose import jwt, JWTError
 from schemas.auth import CreateUserRequest, UpdateUserRequest, ChangePasswordRequest, Token
+from services import state
 
 router = APIRouter(
     prefix="/auth",
@@ -18,15 +25,18 @@ router = APIRouter(
 SECRET_KEY = "YourSecretKey Here"
 ALGORITHM = "YourAlgorithm Here" #Example HS256
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+# Progress stream tickets only need to outlive the connection attempt (and EventSource's reconnects)
+STREAM_TICKET_TTL_SECONDS = 60
 
-bcrypt_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_bearer = OAuth2PasswordBearer(tokenUrl='auth/token')
+token_cache = TokenCache()
+login_throttle = LoginThrottle()
 
-def autenticate_user(email:str, password:str, db):
-    user = db.query(User).filter(User.email == email).first()
-    if not user:
-        return False
-    if not bcrypt_context.verify(password, user.hashed_password):
+async def autenticate_user(email:str, password:str, db):
+    user = (await db.execute(select(User).where(User.email == email))).scalars().first()
+    # Unknown users still pay for a bcrypt check so timing does not reveal which emails exist
+    password_ok = await verify_password(password, user.hashed_password if user else None)
+    if not user or not password_ok:
         return False
     return user
 
@@ -37,6 +47,11 @@ def create_access_token(email: str, user_id: int, expires_delta=timedelta):
     return jwt.encode(encode, SECRET_KEY, algorithm=ALGORITHM)
 
 async def get_current_user(token: Annotated[str, Depends(oauth2_bearer)]):
+    # Hot path: a token validated in the last minute is not decoded again
+    cached = token_cache.get(token)
+    if cached is not None:
+        return cached
+
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         email: str = payload.get("sub")
@@ -46,17 +61,37 @@ async def get_current_user(token: Annotated[str, Depends(oauth2_bearer)]):
     except JWTError:
         raise HTTPException(status_code=401, detail="Invalid authentication credentials")
     
-    return {"email": email, "user_id": user_id}
+    user = {"email": email, "user_id": user_id}
+    token_cache.put(token, user, payload.get("exp"))
+    return user
+
+def issue_stream_ticket(user, job_ids=None):
+    """A short-lived ticket for progress streams, limited to job_ids if given.
+
+    EventSource and browser WebSockets cannot set headers; they send this
+    as ?ticket= instead of putting the bearer token in the URL, where it
+    would end up in access logs and browser history.
+    """
+    ticket = secrets.token_urlsafe(32)
+    # Kept in the shared store: the stream may be served by another worker process
+    state.store.set(f"stream-ticket:{ticket}", {**user, "job_ids": job_ids}, STREAM_TICKET_TTL_SECONDS)
+    return ticket
+
+async def get_stream_user(connection: HTTPConnection, ticket: Optional[str] = Query(default=None)):
+    scheme, _, header_token = connection.headers.get("authorization", "").partition(" ")
+    if scheme.lower() == "bearer" and header_token:
+        return await get_current_user(header_token)
+    user = state.store.get(f"stream-ticket:{ticket}") if ticket else None
+    if user is None:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    return user
 
     
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
-db_dependency = Annotated[Session, Depends(get_db)]
+db_dependency = Annotated[AsyncSession, Depends(get_db)]
 
 @router.get("/profile", status_code=status.HTTP_200_OK)
 async def get_user_profile(user: Annotated[dict, Depends(get_current_user)],
@@ -64,7 +99,7 @@ async def get_user_profile(user: Annotated[dict, Depends(get_current_user)],
     if user is None:
         raise HTTPException(status_code=401, detail="Authentication required")
     
-    user_model = db.query(User).filter(User.id == user["user_id"]).first()
+    user_model = await db.get(User, user["user_id"])
     if user_model is None:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -87,12 +122,12 @@ async def create_user(db: db_dependency,
         email=create_user_request.email,
         first_name=create_user_request.first_name,
         last_name=create_user_request.last_name,
-        hashed_password=bcrypt_context.hash(create_user_request.password),
+        hashed_password=await hash_password(create_user_request.password),
         role=create_user_request.role
     )
 
     db.add(create_user_model)
-    db.commit()
+    await db.commit()
 
     if create_user_model is not None:
         return create_user_model
@@ -105,14 +140,14 @@ async def update_user(user: Annotated[dict, Depends(get_current_user)],
     if user is None:
         raise HTTPException(status_code=401, detail="Authentication required")
         
-    user_model = db.query(User).filter(User.id == user["user_id"]).first()
+    user_model = await db.get(User, user["user_id"])
     if user_model is None:
         raise HTTPException(status_code=404, detail="User not found")
     user_model.email = update_user_request.email
     user_model.first_name = update_user_request.first_name
     user_model.last_name = update_user_request.last_name
     user_model.role = update_user_request.role
-    db.commit()
+    await db.commit()
     return user_model
 
 @router.put("/change_password", status_code=status.HTTP_200_OK)
@@ -122,25 +157,34 @@ async def change_password(user: Annotated[dict, Depends(get_current_user)],
     if user is None:
         raise HTTPException(status_code=401, detail="Authentication required")
         
-    user_model = db.query(User).filter(User.id == user["user_id"]).first()
+    user_model = await db.get(User, user["user_id"])
     if user_model is None:
         raise HTTPException(status_code=404, detail="User not found")
         
     # Verify current password
-    if not bcrypt_context.verify(change_password_request.password, user_model.hashed_password):
+    if not await verify_password(change_password_request.password, user_model.hashed_password):
         raise HTTPException(status_code=401, detail="Current password is incorrect")
         
     # Update password
-    user_model.hashed_password = bcrypt_context.hash(change_password_request.new_password)
-    db.commit()
+    user_model.hashed_password = await hash_password(change_password_request.new_password)
+    await db.commit()
     return {"message": "Password updated successfully"}
 
 @router.post("/token", response_model=Token, status_code=status.HTTP_200_OK)
 async def login_for_access_token(form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
+                                 request: Request,
                                  db: db_dependency):
-    authentication = autenticate_user(form_data.username, form_data.password, db)
+    throttle_keys = (f"email:{form_data.username.lower()}", f"ip:{request.client.host if request.client else ''}")
+    retry_after = login_throttle.retry_after(*throttle_keys)
+    if retry_after:
+        raise HTTPException(status_code=429, detail="Too many failed login attempts",
+                            headers={"Retry-After": str(retry_after)})
+
+    authentication = await autenticate_user(form_data.username, form_data.password, db)
     if not authentication:
+        login_throttle.record_failure(*throttle_keys)
         raise HTTPException(status_code=401, detail="Invalid authentication credentials")
+    login_throttle.reset(throttle_keys[0])
     
     token = create_access_token(
         email=authentication.email,
@@ -0,0 +1,39 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from passlib.context import CryptContext
+
+from services import metrics
+
+# bcrypt releases the GIL, so a small thread pool runs hashes in parallel
+# without ever blocking the event loop
+HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", "2"))
+# Requests beyond this wait their turn instead of piling onto the executor queue
+MAX_CONCURRENT_HASHES = int(os.environ.get("PASSWORD_HASH_CONCURRENCY", str(HASH_WORKERS * 2)))
+
+bcrypt_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+_executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="password-hash")
+_semaphore = asyncio.Semaphore(MAX_CONCURRENT_HASHES)
+
+# Verified against when the user does not exist, so unknown emails take as long as wrong passwords
+_DUMMY_HASH = bcrypt_context.hash("cloud-drive-timing-equalizer")
+
+
+def _timed(operation, func, *args):
+    with metrics.password_hash_duration.time(operation=operation):
+        return func(*args)
+
+
+async def _run(operation, func, *args):
+    async with _semaphore:
+        return await asyncio.get_running_loop().run_in_executor(_executor, _timed, operation, func, *args)
+
+
+async def verify_password(plain_password, hashed_password):
+    return await _run("verify", bcrypt_context.verify, plain_password, hashed_password or _DUMMY_HASH)
+
+
+async def hash_password(plain_password):
+    return await _run("hash", bcrypt_context.hash, plain_password)
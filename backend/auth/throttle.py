@@ -0,0 +1,55 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+MAX_FAILURES = int(os.environ.get("LOGIN_MAX_FAILURES", "5"))
+FAILURE_WINDOW_SECONDS = int(os.environ.get("LOGIN_FAILURE_WINDOW", "900"))
+MAX_LOCKOUT_SECONDS = 900
+MAX_TRACKED_KEYS = 10_000
+
+
+class LoginThrottle:
+    """Counts recent failed logins per key (email or client address).
+
+    After MAX_FAILURES inside the window the key is locked out, with the
+    lockout doubling for each further failure up to MAX_LOCKOUT_SECONDS.
+    A throttled attempt is rejected before any bcrypt work is done.
+    """
+
+    def __init__(self, max_failures=MAX_FAILURES, window=FAILURE_WINDOW_SECONDS, max_keys=MAX_TRACKED_KEYS):
+        self.max_failures = max_failures
+        self.window = window
+        self.max_keys = max_keys
+        self._failures = OrderedDict()  # key -> (count, first_failure, locked_until)
+        self._lock = threading.Lock()
+
+    def retry_after(self, *keys):
+        """Seconds until any of the keys may try again, or 0 if none are locked."""
+        now = time.monotonic()
+        wait = 0
+        with self._lock:
+            for key in keys:
+                entry = self._failures.get(key)
+                if entry and entry[2] > now:
+                    wait = max(wait, entry[2] - now)
+        return int(wait + 0.999)
+
+    def record_failure(self, *keys):
+        now = time.monotonic()
+        with self._lock:
+            for key in keys:
+                count, first, locked_until = self._failures.pop(key, (0, now, 0))
+                if now - first > self.window:
+                    count, first = 0, now
+                count += 1
+                if count >= self.max_failures:
+                    locked_until = now + min(MAX_LOCKOUT_SECONDS, 2 ** (count - self.max_failures))
+                self._failures[key] = (count, first, locked_until)
+            while len(self._failures) > self.max_keys:
+                self._failures.popitem(last=False)
+
+    def reset(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._failures.pop(key, None)
@@ -0,0 +1,140 @@
+"""Offline benchmarks for the file and share APIs.
+
+Run from the backend directory:
+
+    python -m benchmarks --profile quick --concurrency 1,8,32 --output results.json
+    python -m benchmarks --compare baseline.json results.json
+
+Everything (RAID_DIR, databases, job and thumbnail dirs) lives in a
+temporary directory, and requests go straight to the ASGI app through
+httpx.ASGITransport, so no server or network is involved. Latencies
+therefore include the app and the in-process client but not sockets.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks import dataset
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _isolate(workdir):
+    # Must run before anything imports the app: these are read at import time
+    raid_dir = os.path.join(workdir, "raid")
+    os.makedirs(raid_dir, exist_ok=True)
+    os.environ["RAID_DIR"] = raid_dir
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ["FILE_INDEX_PATH"] = os.path.join(workdir, "file_index.db")
+    os.environ["JOB_OUTPUT_DIR"] = os.path.join(workdir, "jobs")
+    os.environ["THUMBNAIL_CACHE_DIR"] = os.path.join(workdir, "thumbnails")
+    # Listings would otherwise queue thumbnail renders that compete with the measured requests
+    os.environ.setdefault("THUMBNAIL_PREFETCH_SIZE", "none")
+    return raid_dir
+
+
+def compare(baseline_path, current_path, threshold):
+    """Print per-scenario changes; returns 1 if any p50 or throughput regressed beyond threshold."""
+    with open(baseline_path) as f:
+        baseline = {(r["scenario"], r["concurrency"]): r for r in json.load(f)["results"]}
+    with open(current_path) as f:
+        current = json.load(f)["results"]
+
+    regressed = False
+    print(f"{'scenario':<24} {'c':>4} {'req/s':>10} {'Δ':>8} {'p50 ms':>9} {'Δ':>8} {'p99 ms':>9} {'Δ':>8}")
+    for result in current:
+        before = baseline.get((result["scenario"], result["concurrency"]))
+        if before is None:
+            continue
+
+        def change(key):
+            return (result[key] - before[key]) / before[key] * 100 if before[key] else 0.0
+
+        rps, p50, p99 = change("throughput_rps"), change("p50_ms"), change("p99_ms")
+        flag = ""
+        if rps < -threshold or p50 > threshold:
+            regressed = True
+            flag = "  <-- regression"
+        print(f"{result['scenario']:<24} {result['concurrency']:>4} {result['throughput_rps']:>10.1f} {rps:>+7.1f}% "
+              f"{result['p50_ms']:>9.2f} {p50:>+7.1f}% {result['p99_ms']:>9.2f} {p99:>+7.1f}%{flag}")
+    return 1 if regressed else 0
+
+
+def main(argv=None):
+    from benchmarks.runner import SCENARIO_NAMES
+
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description=__doc__.split("\n")[0])
+    parser.add_argument("--profile", choices=sorted(dataset.PROFILES), default="quick")
+    parser.add_argument("--scenarios", default=",".join(SCENARIO_NAMES),
+                        help="comma-separated subset of: " + ", ".join(SCENARIO_NAMES))
+    parser.add_argument("--concurrency", default="1,8,32", help="comma-separated concurrency levels")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplier for each scenario's request count")
+    parser.add_argument("--output", help="write JSON results here (default: stdout)")
+    parser.add_argument("--workdir", help="reuse this directory instead of a fresh temp dir")
+    parser.add_argument("--keep", action="store_true", help="do not delete the temp dir afterwards")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"),
+                        help="compare two result files instead of running")
+    parser.add_argument("--threshold", type=float, default=10.0, help="regression threshold in percent")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        return compare(args.compare[0], args.compare[1], args.threshold)
+
+    scenarios = [s for s in args.scenarios.split(",") if s]
+    unknown = set(scenarios) - set(SCENARIO_NAMES)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    concurrency_levels = [int(c) for c in args.concurrency.split(",") if c]
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="cloud_drive_bench_")
+    raid_dir = _isolate(workdir)
+    # Results should be comparable across commits, so the dataset is built outside the timed part
+    print(f"Building '{args.profile}' tree in {raid_dir}", file=sys.stderr)
+    started = time.perf_counter()
+    tree = dataset.build_tree(raid_dir, args.profile)
+    print(f"Tree built in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+
+    try:
+        from main import app
+        from benchmarks import runner
+
+        results = asyncio.run(runner.run(app, tree, scenarios, concurrency_levels, args.scale,
+                                         progress=lambda line: print(line, file=sys.stderr)))
+    finally:
+        if not args.keep and not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "commit": _git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "profile": args.profile,
+        "scale": args.scale,
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
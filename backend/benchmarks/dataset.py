@@ -0,0 +1,82 @@
+import os
+import random
+
+# Content is generated from a fixed seed so every run (and every commit) benchmarks the same bytes
+SEED = 1234
+WRITE_BLOCK = 1024 * 1024
+
+PROFILES = {
+    # name: (small files, small file size, huge files, huge file size, nesting depth, files per level)
+    "quick": (2000, 4 * 1024, 2, 32 * 1024 * 1024, 20, 5),
+    "default": (20000, 8 * 1024, 3, 256 * 1024 * 1024, 50, 10),
+    "large": (100000, 16 * 1024, 4, 1024 * 1024 * 1024, 100, 10),
+}
+
+SMALL_DIR = "small"
+HUGE_DIR = "huge"
+DEEP_DIR = "deep"
+ZIP_DIR = "zip_me"
+
+
+def _write(path, size, rng):
+    # Half random (incompressible), half repeated text, like a typical mix of media and documents
+    block = rng.randbytes(min(size, WRITE_BLOCK) // 2)
+    block += (b"cloud drive benchmark line\n" * (len(block) // 27 + 1))[:min(size, WRITE_BLOCK) - len(block)]
+    with open(path, "wb") as f:
+        remaining = size
+        while remaining > 0:
+            chunk = block[:remaining]
+            f.write(chunk)
+            remaining -= len(chunk)
+
+
+def build_tree(root, profile="default"):
+    """Create the synthetic tree under root and return a description of it.
+
+    Layout:
+      small/        many small files in one flat directory (listing, search)
+      huge/         a few large files (download, range reads)
+      deep/         a chain of nested directories with a few files per level
+      zip_me/       a mixed folder small enough to zip on every iteration
+    """
+    small_count, small_size, huge_count, huge_size, depth, per_level = PROFILES[profile]
+    rng = random.Random(SEED)
+
+    small_dir = os.path.join(root, SMALL_DIR)
+    os.makedirs(small_dir, exist_ok=True)
+    small_files = []
+    for i in range(small_count):
+        name = f"doc_{i:06d}_{rng.choice(('report', 'invoice', 'photo', 'notes'))}.txt"
+        _write(os.path.join(small_dir, name), small_size, rng)
+        small_files.append(f"{SMALL_DIR}/{name}")
+
+    huge_dir = os.path.join(root, HUGE_DIR)
+    os.makedirs(huge_dir, exist_ok=True)
+    huge_files = []
+    for i in range(huge_count):
+        name = f"video_{i}.bin"
+        _write(os.path.join(huge_dir, name), huge_size, rng)
+        huge_files.append(f"{HUGE_DIR}/{name}")
+
+    deep_path = DEEP_DIR
+    for level in range(depth):
+        deep_path = os.path.join(deep_path, f"level_{level:03d}")
+        os.makedirs(os.path.join(root, deep_path), exist_ok=True)
+        for i in range(per_level):
+            _write(os.path.join(root, deep_path, f"file_{i}.dat"), small_size, rng)
+
+    zip_dir = os.path.join(root, ZIP_DIR)
+    os.makedirs(os.path.join(zip_dir, "nested"), exist_ok=True)
+    for i in range(50):
+        _write(os.path.join(zip_dir, f"part_{i}.txt"), small_size * 4, rng)
+    _write(os.path.join(zip_dir, "nested", "blob.bin"), 4 * 1024 * 1024, rng)
+
+    return {
+        "profile": profile,
+        "small_files": small_files,
+        "small_size": small_size,
+        "huge_files": huge_files,
+        "huge_size": huge_size,
+        "deep_dir": deep_path,
+        "zip_dir": ZIP_DIR,
+    }
@@ -0,0 +1,151 @@
+import asyncio
+import itertools
+import random
+import statistics
+import time
+import uuid
+
+import httpx
+
+BENCH_USER = {"email": "bench@example.com", "user_id": 1}
+RANGE_BYTES = 64 * 1024
+UPLOAD_BYTES = 256 * 1024
+
+SCENARIO_NAMES = [
+    "list_small_dir", "list_small_dir_sorted", "list_deep_dir", "search", "upload", "upload_raw",
+    "download_small", "download_huge", "range_read", "zip_folder", "share_info", "share_download",
+]
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    k = (len(sorted_values) - 1) * pct / 100
+    lower = int(k)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (k - lower)
+
+
+def summarize(name, latencies, errors, nbytes, elapsed, concurrency):
+    ordered = sorted(latencies)
+    return {
+        "scenario": name,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors,
+        "duration_s": round(elapsed, 4),
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "throughput_mb_s": round(nbytes / elapsed / 1e6, 2) if elapsed else 0.0,
+        "p50_ms": round(percentile(ordered, 50) * 1000, 3),
+        "p90_ms": round(percentile(ordered, 90) * 1000, 3),
+        "p99_ms": round(percentile(ordered, 99) * 1000, 3),
+        "max_ms": round(ordered[-1] * 1000, 3) if ordered else 0.0,
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 3) if ordered else 0.0,
+    }
+
+
+def build_scenarios(tree, share_tokens):
+    """Scenario name -> (request factory, default request count).
+
+    A factory takes the iteration number and returns keyword arguments for
+    client.request(); the rng is seeded so runs issue identical requests.
+    """
+    rng = random.Random(42)
+    small = tree["small_files"]
+    huge = tree["huge_files"]
+    huge_size = tree["huge_size"]
+    terms = ["report", "invoice", "photo", "doc_0012", "notes", "level_0"]
+
+    def ranged(i):
+        start = rng.randrange(0, max(1, huge_size - RANGE_BYTES))
+        return {"method": "GET", "url": f"/files/download/{huge[i % len(huge)]}",
+                "headers": {"Range": f"bytes={start}-{start + RANGE_BYTES - 1}"}}
+
+    def upload(i):
+        payload = rng.randbytes(UPLOAD_BYTES)
+        return {"method": "POST", "url": "/files/upload", "params": {"path": "bench_uploads"},
+                "files": {"file": (f"upload_{uuid.uuid4().hex}.bin", payload, "application/octet-stream")}}
+
+    def upload_raw(i):
+        return {"method": "PUT", "url": f"/files/upload/raw/bench_uploads/raw_{uuid.uuid4().hex}.bin",
+                "content": rng.randbytes(UPLOAD_BYTES)}
+
+    return {
+        "list_small_dir": (lambda i: {"method": "GET", "url": "/files/list",
+                                      "params": {"path": "small", "limit": 500}}, 200),
+        "list_small_dir_sorted": (lambda i: {"method": "GET", "url": "/files/list",
+                                             "params": {"path": "small", "limit": 500, "sort": "size",
+                                                        "order": "desc"}}, 200),
+        "list_deep_dir": (lambda i: {"method": "GET", "url": "/files/list",
+                                     "params": {"path": tree["deep_dir"]}}, 500),
+        "search": (lambda i: {"method": "GET", "url": "/files/list",
+                              "params": {"q": terms[i % len(terms)], "limit": 50}}, 500),
+        "upload": (upload, 200),
+        "upload_raw": (upload_raw, 200),
+        "download_small": (lambda i: {"method": "GET", "url": f"/files/download/{small[i % len(small)]}"}, 1000),
+        "download_huge": (lambda i: {"method": "GET", "url": f"/files/download/{huge[i % len(huge)]}"}, 6),
+        "range_read": (ranged, 1000),
+        "zip_folder": (lambda i: {"method": "GET", "url": f"/files/download/{tree['zip_dir']}"}, 20),
+        "share_info": (lambda i: {"method": "GET", "url": f"/share/{share_tokens[i % len(share_tokens)]}/info"}, 1000),
+        "share_download": (lambda i: {"method": "GET",
+                                      "url": f"/share/{share_tokens[i % len(share_tokens)]}/download"}, 500),
+    }
+
+
+async def run_scenario(client, name, factory, count, concurrency):
+    counter = itertools.count()
+    latencies = []
+    errors = 0
+    nbytes = 0
+
+    async def worker():
+        nonlocal errors, nbytes
+        while True:
+            i = next(counter)
+            if i >= count:
+                return
+            request = factory(i)
+            started = time.perf_counter()
+            response = await client.request(**request)
+            latencies.append(time.perf_counter() - started)
+            if response.status_code >= 400:
+                errors += 1
+            nbytes += len(response.content)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(name, latencies, errors, nbytes, time.perf_counter() - started, concurrency)
+
+
+async def run(app, tree, scenarios, concurrency_levels, scale=1.0, warmup=5, progress=print):
+    from auth.auth import get_current_user
+    from routes import files
+
+    # Authentication has its own benchmark-worthy costs (bcrypt); these scenarios measure the file paths
+    app.dependency_overrides[get_current_user] = lambda: BENCH_USER
+    results = []
+    async with app.router.lifespan_context(app):
+        await asyncio.to_thread(files.search_index.wait_ready)
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            share_tokens = []
+            for path in tree["small_files"][:50] + tree["huge_files"][:1]:
+                response = await client.post("/share/create", json={"path": path})
+                response.raise_for_status()
+                share_tokens.append(response.json()["token"])
+
+            available = build_scenarios(tree, share_tokens)
+            for name in scenarios:
+                factory, default_count = available[name]
+                count = max(1, int(default_count * scale))
+                for _ in range(min(warmup, count)):
+                    await client.request(**factory(0))
+                for concurrency in concurrency_levels:
+                    result = await run_scenario(client, name, factory, count, concurrency)
+                    progress(f"{name:<24} c={concurrency:<4} {result['throughput_rps']:>10.1f} req/s "
+                             f"p50={result['p50_ms']:.2f}ms p99={result['p99_ms']:.2f}ms"
+                             + (f" errors={result['errors']}" if result["errors"] else ""))
+                    results.append(result)
+    app.dependency_overrides.pop(get_current_user, None)
+    return results
+
@@ -1,12 +1,70 @@
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, APIRouter
-from routes import files, share, installer
+from routes import files, share, installer, metrics as metrics_route
 from fastapi.middleware.cors import CORSMiddleware
 from models.user import Base
-from models.shared_link import SharedLink
+from models.shared_link import SharedLink, SharedLinkArchive
+from models.job import Job
 from auth.auth import router as auth_router
-from settings.database import engine
+from settings.database import engine, async_engine, AsyncSessionLocal
+from services import compression, events, jobs, metrics, progress, share_maintenance, state
+from settings.logging_config import configure_logging
 
-app = FastAPI()
+configure_logging()
+metrics.instrument_engine(engine, "sync")
+metrics.instrument_engine(async_engine.sync_engine, "async")
+events.attach(state.store)
+progress.hub.attach(state.store)
+
+
+def on_elected():
+    # Singleton work: one process builds the index and watches the disk for all of them
+    files.search_index.start()
+    files.file_watcher.start()
+    files.job_manager.requeue_stale()
+
+
+def on_demoted():
+    files.file_watcher.stop()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    state.store.start()
+    state.leadership.start(on_elected, on_demoted)
+    files.search_index.follow()
+    files.change_journal.start()
+    if files.blob_store is not None:
+        files.blob_store.start()
+    files.job_manager.start()
+    files.rebalancer.start()
+    reaper_stop = asyncio.Event()
+    share_reaper = asyncio.create_task(share_maintenance.run_share_reaper(AsyncSessionLocal, reaper_stop))
+    try:
+        yield
+    finally:
+        # Also on the way out of a failed run (benchmarks, tests), or the threads below keep the process alive
+        # Waits for the batch in progress to commit rather than cancelling it mid-transaction
+        reaper_stop.set()
+        await share_reaper
+        files.job_manager.stop()
+        files.rebalancer.stop()
+        files.thumbnail_cache.shutdown()
+        files.file_watcher.stop()
+        files.change_journal.stop()
+        if files.blob_store is not None:
+            files.blob_store.stop()
+        state.leadership.stop()
+        state.store.close()
+        # aiosqlite connections each own a non-daemon thread; close them or the process never exits
+        await async_engine.dispose()
+
+app = FastAPI(lifespan=lifespan)
+
+app.add_middleware(compression.CompressionMiddleware)
+# Outside compression, so response byte counts are what went over the wire
+app.add_middleware(metrics.MetricsMiddleware)
 
 app.add_middleware(
     CORSMiddleware,
@@ -17,11 +75,14 @@ app.add_middleware(
 )
 
 Base.metadata.create_all(bind=engine)
+share_maintenance.ensure_indexes(engine)
+jobs.ensure_schema(engine)
 
 app.include_router(files.route)
 app.include_router(auth_router)
 app.include_router(share.router)
 app.include_router(installer.router, prefix="/installer", tags=["Installer"])
+app.include_router(metrics_route.router)
 
 @app.get("/")
 def read_root():
@@ -30,4 +91,6 @@ def read_root():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("main:app", host="0.0.0.0", port=8006, reload=True)
\ No newline at end of file
+    # One worker per core for CPU-bound work (zipping, hashing); see services/state.py
+    workers = state.WEB_CONCURRENCY
+    uvicorn.run("main:app", host="0.0.0.0", port=8006, reload=workers == 1, workers=workers)
\ No newline at end of file
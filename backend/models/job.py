@@ -0,0 +1,28 @@
+from settings.database import Base
+from sqlalchemy import Column, Integer, String, DateTime, BigInteger, ForeignKey, Text, Index
+from datetime import datetime
+
+class Job(Base):
+    __tablename__ = "jobs"
+
+    id = Column(String, primary_key=True)  # uuid4
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    kind = Column(String)  # e.g. "zip"
+    status = Column(String, default="queued")  # queued, processing, complete, error, cancelled, expired
+    params = Column(Text)  # JSON encoded runner arguments
+    filename = Column(String)  # Download name of the result
+    result_path = Column(String)  # Absolute path of the result file, if any
+    bytes_total = Column(BigInteger, default=0)
+    bytes_done = Column(BigInteger, default=0)
+    error = Column(String)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+    worker_id = Column(String)  # Process running the job
+    heartbeat_at = Column(DateTime)  # Refreshed while running; a stale one means the worker died
+    cancel_requested = Column(Integer, default=0)
+
+    __table_args__ = (
+        Index("ix_jobs_status_finished_at", "status", "finished_at"),
+        Index("ix_jobs_status_created_at", "status", "created_at"),
+    )
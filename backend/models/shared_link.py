@@ -1,5 +1,5 @@
 from settings.database import Base
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, Index
 from datetime import datetime
 
 class SharedLink(Base):
@@ -7,8 +7,27 @@ class SharedLink(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     token = Column(String, unique=True, index=True)
-    file_path = Column(String)  # Relative path to RAID_DIR
+    file_path = Column(String)  # Relative path in the storage pool (RAID_DIR and STORAGE_VOLUMES)
     created_at = Column(DateTime, default=datetime.utcnow)
     expires_at = Column(DateTime)
     user_id = Column(Integer, ForeignKey("users.id"))
     is_active = Column(Boolean, default=True)
+
+    __table_args__ = (
+        # list_shared_links: a user's active links ordered/filtered by expiry
+        Index("ix_shared_links_user_active_expires", "user_id", "is_active", "expires_at"),
+        # Reaper: expired or inactive links across all users
+        Index("ix_shared_links_active_expires", "is_active", "expires_at"),
+    )
+
+class SharedLinkArchive(Base):
+    __tablename__ = "shared_links_archive"
+
+    id = Column(Integer, primary_key=True)
+    token = Column(String, index=True)
+    file_path = Column(String)
+    created_at = Column(DateTime)
+    expires_at = Column(DateTime)
+    user_id = Column(Integer, index=True)
+    is_active = Column(Boolean)
+    archived_at = Column(DateTime, default=datetime.utcnow)
@@ -1,83 +1,89 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, APIRouter, Depends, Query, BackgroundTasks
-from typing import Annotated
-from auth.auth import get_current_user
-from fastapi.responses import FileResponse
+from fastapi import (FastAPI, File, UploadFile, HTTPException, APIRouter, Depends, Query, BackgroundTasks, Request, Header,
+                     WebSocket, WebSocketDisconnect)
+import asyncio
+from fastapi.concurrency import run_in_threadpool
+from typing import Annotated, List, Literal, Optional
+from auth.auth import STREAM_TICKET_TTL_SECONDS, get_current_user, get_stream_user, issue_stream_ticket
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+from services import (cas, changes, conditional, delta, dir_cache, events, file_index, fileops, jobs, metrics, progress,
+                      quota, storage, thumbnails, uploads, watcher, zipstream)
+from settings.database import SessionLocal
+from services.zipstream import content_disposition
+import json
+import logging
 import os
 user_dependency = Annotated[dict, Depends(get_current_user)]
-import shutil
+stream_user_dependency = Annotated[dict, Depends(get_stream_user)]
+import uuid
 from pydantic import BaseModel
 
-RAID_DIR = r"/home/androide47/Documentos"
+RAID_DIR = os.environ.get("RAID_DIR", r"/home/androide47/Documentos")
+UPLOAD_COPY_BUFFER = 1024 * 1024
+SEARCH_PAGE_SIZE = 50
+BROWSE_PAGE_SIZE = 500
+
+logger = logging.getLogger(__name__)
 
-os.makedirs(RAID_DIR, exist_ok=True)
+# RAID_DIR is the primary volume; STORAGE_VOLUMES adds more (see services/storage.py)
+storage_pool = storage.StoragePool(storage.volumes_from_env(RAID_DIR), file_index.INDEX_DB_PATH)
+for volume in storage_pool.volumes:
+    os.makedirs(volume.path, exist_ok=True)
+
+search_index = file_index.FileIndex(file_index.INDEX_DB_PATH, storage_pool)
+file_watcher = watcher.FileWatcher(search_index)
+directory_cache = dir_cache.DirectoryCache(storage_pool)
+events.subscribe(directory_cache.handle_event)
+change_journal = changes.ChangeJournal(file_index.INDEX_DB_PATH, search_index)
+thumbnail_cache = thumbnails.ThumbnailCache(storage_pool)
+blob_store = cas.BlobStore(storage_pool) if cas.CAS_ENABLED else None
+quota_ledger = quota.QuotaLedger(file_index.INDEX_DB_PATH, storage_pool)
+rebalancer = storage.Rebalancer(storage_pool)
 
 route = APIRouter(
     prefix="/files",
     tags=["Files"]
 )
 
-import uuid
-import threading
-import zipfile
+def zip_directory_task(ctx):
+    source_dirs = storage_pool.dir_copies(ctx.params["path"])
+    if not source_dirs:
+        raise FileNotFoundError("Directory no longer exists")
 
-# Global job store
-zip_jobs = {}
+    ctx.set_total(zipstream.tree_size(source_dirs))
+    output_zip = ctx.output_path(".zip")
+    with open(output_zip, "wb") as out:
+        for data in zipstream.stream_zip(source_dirs, store_compressed=ctx.params.get("store_compressed", True),
+                                         on_read=ctx.advance):
+            ctx.check_cancelled()
+            out.write(data)
+    return {"result_path": output_zip}
 
-def zip_directory_task(source_dir, output_zip, job_id):
-    try:
-        total_files = 0
-        for root, dirs, files in os.walk(source_dir):
-            total_files += len(files)
-            
-        if total_files == 0:
-            # Empty folder or only dirs
-            with zipfile.ZipFile(output_zip, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                pass
-            zip_jobs[job_id]['progress'] = 100
-            zip_jobs[job_id]['status'] = 'complete'
-            return
-
-        processed_files = 0
-        with zipfile.ZipFile(output_zip, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for root, dirs, files in os.walk(source_dir):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    arcname = os.path.relpath(file_path, source_dir)
-                    zipf.write(file_path, arcname)
-                    processed_files += 1
-                    # Update progress
-                    progress = int((processed_files / total_files) * 100)
-                    zip_jobs[job_id]['progress'] = progress
-        
-        zip_jobs[job_id]['status'] = 'complete'
-    except Exception as e:
-        zip_jobs[job_id]['status'] = 'error'
-        zip_jobs[job_id]['error'] = str(e)
+job_manager = jobs.JobManager(SessionLocal)
+job_manager.register("zip", zip_directory_task)
+job_manager.register("batch", fileops.batch_job(storage_pool, search_index, quota_ledger))
+job_manager.register("copy", fileops.copy_job(storage_pool, search_index, quota_ledger))
+metrics.job_queue_depth.callback = job_manager.queue_depth
 
 @route.post("/zip/{filename:path}")
-async def start_zip(filename: str, user: user_dependency):
+async def start_zip(filename: str, user: user_dependency, store_compressed: bool = Query(default=True)):
     if not user:
         raise HTTPException(status_code=401, detail="Unauthorized")
         
-    source_path = os.path.join(RAID_DIR, filename)
-    if not os.path.isdir(source_path):
+    source_path = os.path.normpath(os.path.join(RAID_DIR, filename))
+    if not source_path.startswith(RAID_DIR):
+        raise HTTPException(status_code=403, detail="Access denied")
+    if not storage_pool.isdir(os.path.relpath(source_path, RAID_DIR)):
          raise HTTPException(status_code=404, detail="Directory not found")
          
-    job_id = str(uuid.uuid4())
-    # Create temp zip path
-    zip_name = f"{os.path.basename(filename)}.zip"
-    output_zip = os.path.join("/tmp", f"{job_id}_{zip_name}")
-    
-    zip_jobs[job_id] = {
-        "status": "processing",
-        "progress": 0,
-        "filepath": output_zip,
-        "filename": zip_name
-    }
-    
-    # Start background thread
-    thread = threading.Thread(target=zip_directory_task, args=(source_path, output_zip, job_id))
-    thread.start()
+    zip_name = f"{os.path.basename(source_path)}.zip"
+    try:
+        job_id = await run_in_threadpool(
+            job_manager.submit, user["user_id"], "zip",
+            {"path": filename, "store_compressed": store_compressed}, zip_name
+        )
+    except jobs.QueueFull:
+        raise HTTPException(status_code=429, detail="Too many queued jobs")
     
     return {"job_id": job_id}
 
@@ -86,68 +92,434 @@ async def get_zip_status(job_id: str, user: user_dependency):
     if not user:
         raise HTTPException(status_code=401, detail="Unauthorized")
         
-    job = zip_jobs.get(job_id)
+    job = await run_in_threadpool(job_manager.get, job_id, user["user_id"])
     if not job:
         raise HTTPException(status_code=404, detail="Job not found")
         
     return job
 
 @route.get("/zip/download/{job_id}")
-async def download_zip_result(job_id: str, user: user_dependency, background_tasks: BackgroundTasks):
+async def download_zip_result(job_id: str, request: Request, user: user_dependency):
     if not user:
         raise HTTPException(status_code=401, detail="Unauthorized")
 
-    job = zip_jobs.get(job_id)
-    if not job or job['status'] != 'complete':
+    file_path, filename = await run_in_threadpool(job_manager.result_path, job_id, user["user_id"])
+    if not file_path or not os.path.isfile(file_path):
         raise HTTPException(status_code=400, detail="Job not complete or found")
         
-    file_path = job['filepath']
-    filename = job['filename']
-    
-    # Cleanup job from dict (file cleanup via background task)
-    del zip_jobs[job_id]
-    
-    background_tasks.add_task(os.remove, file_path)
-    return FileResponse(file_path, filename=filename, media_type="application/zip")
+    # The archive stays until the reaper expires it, so interrupted downloads can resume
+    return conditional.file_response(request, file_path, filename, media_type="application/zip")
 
+@route.delete("/zip/{job_id}")
+async def cancel_zip(job_id: str, user: user_dependency):
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
 
+    if not await run_in_threadpool(job_manager.cancel, job_id, user["user_id"]):
+        raise HTTPException(status_code=404, detail="Job not found or already finished")
+    return {"status": "success"}
 
-user_dependency = Annotated[dict, Depends(get_current_user)]
+@route.get("/jobs")
+async def list_jobs(user: user_dependency):
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    return await run_in_threadpool(job_manager.list_jobs, user["user_id"])
+
+def _progress_snapshot(user_id, job_ids):
+    # Current state first, so a client connecting mid-job does not wait for the next change
+    if job_ids is not None:
+        return [job for job in (job_manager.get(job_id, user_id) for job_id in job_ids) if job is not None]
+    return [job for job in job_manager.list_jobs(user_id) if job["status"] in jobs.ACTIVE_STATUSES]
+
+def _stream_scope(user, job_ids):
+    """Jobs a stream may follow: None means all of the user's jobs, a list only those.
+
+    A ticket issued for some jobs only opens streams of those jobs; asking it
+    for others is refused rather than narrowed down to nothing, which would
+    read as "all".
+    """
+    scoped = user.get("job_ids")
+    if scoped is None:
+        return job_ids
+    if not job_ids:
+        return scoped
+    allowed = [job_id for job_id in job_ids if job_id in scoped]
+    if not allowed:
+        raise HTTPException(status_code=403, detail="Ticket does not cover these jobs")
+    return allowed
+
+class StreamTicketRequest(BaseModel):
+    job_id: Optional[List[str]] = None
+
+@route.post("/jobs/ticket")
+async def job_events_ticket(request: StreamTicketRequest, user: user_dependency):
+    """Short-lived ticket for /jobs/events and /jobs/ws, for clients that cannot send an Authorization header."""
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    if request.job_id is not None and not request.job_id:
+        raise HTTPException(status_code=400, detail="job_id must list at least one job, or be left out for all")
+
+    return {"ticket": issue_stream_ticket(user, request.job_id), "expires_in": STREAM_TICKET_TTL_SECONDS}
+
+@route.get("/jobs/events")
+async def job_events(request: Request, user: stream_user_dependency, job_id: Optional[List[str]] = Query(default=None)):
+    """Server-Sent Events stream of progress for the user's jobs and uploads (or only job_id ones).
+
+    Replaces polling the status endpoints: updates are pushed as they happen,
+    coalesced per job and sent at most every progress.PUSH_INTERVAL_SECONDS.
+    """
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    job_id = _stream_scope(user, job_id)
+    subscription = progress.hub.subscribe(user["user_id"], job_id)
+    snapshot = await run_in_threadpool(_progress_snapshot, user["user_id"], job_id)
+
+    def encode(updates):
+        metrics.progress_updates.inc(len(updates))
+        return "".join(f"event: progress\ndata: {json.dumps(jsonable_encoder(update))}\n\n" for update in updates)
+
+    async def stream():
+        metrics.progress_streams.inc(transport="sse")
+        try:
+            yield f"retry: 3000\n\n{encode(snapshot)}"
+            async for batch in progress.hub.batches(subscription):
+                if await request.is_disconnected():
+                    break
+                yield encode(batch) if batch else ": keepalive\n\n"
+        finally:
+            metrics.progress_streams.dec(transport="sse")
+            progress.hub.unsubscribe(subscription)
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"cache-control": "no-cache", "x-accel-buffering": "no"})
+
+@route.websocket("/jobs/ws")
+async def job_events_ws(websocket: WebSocket, user: stream_user_dependency,
+                        job_id: Optional[List[str]] = Query(default=None)):
+    """The /jobs/events stream over a WebSocket: each message is a JSON list of updates."""
+    # Before accepting, so an out-of-scope request is refused like a failed login
+    job_id = _stream_scope(user, job_id)
+    await websocket.accept()
+    subscription = progress.hub.subscribe(user["user_id"], job_id)
+    snapshot = await run_in_threadpool(_progress_snapshot, user["user_id"], job_id)
+    metrics.progress_streams.inc(transport="websocket")
+
+    async def drain():
+        # Nothing is expected from the client; reading notices when it goes away
+        try:
+            while True:
+                await websocket.receive_text()
+        except WebSocketDisconnect:
+            pass
+
+    reader = asyncio.create_task(drain())
+    try:
+        if snapshot:
+            await websocket.send_json(jsonable_encoder(snapshot))
+            metrics.progress_updates.inc(len(snapshot))
+        async for batch in progress.hub.batches(subscription):
+            if reader.done():
+                break
+            # Empty lists are keepalives
+            await websocket.send_json(jsonable_encoder(batch))
+            metrics.progress_updates.inc(len(batch))
+    except WebSocketDisconnect:
+        pass
+    finally:
+        reader.cancel()
+        metrics.progress_streams.dec(transport="websocket")
+        progress.hub.unsubscribe(subscription)
 
 class CreateFolderRequest(BaseModel):
     path: str
     folder_name: str
 
+class BatchOperation(BaseModel):
+    op: Literal["delete", "move", "copy", "rename"]
+    path: str
+    destination: Optional[str] = None
+    name: Optional[str] = None
+    overwrite: bool = False
+
+class TransferRequest(BaseModel):
+    path: str
+    destination: str
+    overwrite: bool = False
+    background: Optional[bool] = None
+
+class BatchRequest(BaseModel):
+    operations: List[BatchOperation]
+    background: Optional[bool] = None
+
+class UploadInitRequest(BaseModel):
+    filename: str
+    size: int
+    path: str = ""
+    chunk_size: int = uploads.DEFAULT_CHUNK_SIZE
+    sha256: Optional[str] = None
+
 @route.post("/upload")
 async def upload(user: user_dependency, file: UploadFile = File(...), path: str = Query(default="")):
     # Security check for path traversal
     safe_path = os.path.normpath(os.path.join(RAID_DIR, path))
     if not safe_path.startswith(RAID_DIR):
          raise HTTPException(status_code=403, detail="Access denied")
-    
-    if not os.path.exists(safe_path):
-        os.makedirs(safe_path, exist_ok=True)
 
-    print(f"Starting upload for file: {file.filename} to {safe_path}")
     safe_filename = os.path.basename(file.filename)
-    file_path = os.path.join(safe_path, safe_filename)
-    print(f"Saving to: {file_path}")
+    rel_path = os.path.relpath(os.path.join(safe_path, safe_filename), RAID_DIR)
+    # The multipart body is already spooled, so its size is known
+    reservation = await run_in_threadpool(quota_ledger.reserve, user["user_id"], file.size or 0, rel_path)
+    try:
+        file_path = await run_in_threadpool(storage_pool.place, rel_path, file.size or 0)
+    except BaseException:
+        quota_ledger.release(reservation)
+        file.file.close()
+        raise
+    safe_path = os.path.dirname(file_path)
+    logger.debug("Saving upload to %s", file_path)
+
+    def copy_upload():
+        # Hash while copying; the bytes are read exactly once either way
+        if blob_store is None:
+            with open(file_path, "wb") as buffer:
+                return cas.copy_hashed(file.file, buffer, UPLOAD_COPY_BUFFER), False
+        tmp_path = os.path.join(safe_path, f".{safe_filename}.{uuid.uuid4().hex}.upload")
+        try:
+            with open(tmp_path, "wb") as buffer:
+                digest = cas.copy_hashed(file.file, buffer, UPLOAD_COPY_BUFFER)
+            return digest, blob_store.adopt(tmp_path, digest, file_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
 
     try:
-        with open(file_path, "wb") as buffer:
-            print("Copying file object...")
-            shutil.copyfileobj(file.file, buffer)
-            print("Copy completed.")
+        # Copy in the threadpool so a large upload does not stall the event loop
+        digest, deduplicated = await run_in_threadpool(copy_upload)
+        await run_in_threadpool(search_index.upsert_path, rel_path)
+        await run_in_threadpool(quota_ledger.record, user["user_id"], rel_path, os.path.getsize(file_path))
+        thumbnail_cache.prefetch([file_path])
     except Exception as e:
-        print(f"Error during upload: {e}")
+        logger.exception("Error during upload of %s", file_path)
         raise HTTPException(status_code=500, detail=str(e))
     finally:
+        quota_ledger.release(reservation)
         file.file.close()
 
-    return {"status": "success", "message": f"File {safe_filename} uploaded successfully"}
+    return {"status": "success", "message": f"File {safe_filename} uploaded successfully",
+            "sha256": digest, "deduplicated": deduplicated}
+
+@route.post("/upload/init")
+async def init_upload(request: UploadInitRequest, user: user_dependency):
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    safe_path = os.path.normpath(os.path.join(RAID_DIR, request.path))
+    if not safe_path.startswith(RAID_DIR):
+        raise HTTPException(status_code=403, detail="Access denied")
+
+    rel_path = os.path.relpath(os.path.join(safe_path, uploads.clean_filename(request.filename)), RAID_DIR)
+    # The session holds its bytes until it is finalized, aborted or purged
+    reservation = await run_in_threadpool(quota_ledger.reserve, user["user_id"], request.size, rel_path, True)
+    try:
+        if blob_store is not None and request.sha256 and cas.is_digest(request.sha256.lower()):
+            # Known content: link the stored blob into place and skip the transfer entirely
+            file_path = await run_in_threadpool(storage_pool.place, rel_path, request.size)
+            if await run_in_threadpool(blob_store.link_existing, request.sha256.lower(), request.size, file_path):
+                await run_in_threadpool(search_index.upsert_path, rel_path)
+                await run_in_threadpool(quota_ledger.record, user["user_id"], rel_path, request.size)
+                quota_ledger.release(reservation)
+                thumbnail_cache.prefetch([file_path])
+                return {"upload_id": None, "chunk_size": request.chunk_size, "total_chunks": 0,
+                        "deduplicated": True}
+
+        meta = await run_in_threadpool(
+            uploads.create_session, RAID_DIR, user["user_id"], request.path,
+            request.filename, request.size, request.chunk_size, request.sha256,
+            reservation, _release_session
+        )
+    except BaseException:
+        quota_ledger.release(reservation)
+        raise
+    return {
+        "upload_id": meta["upload_id"],
+        "chunk_size": meta["chunk_size"],
+        "total_chunks": meta["total_chunks"],
+        "deduplicated": False
+    }
+
+@route.put("/upload/raw/{filename:path}")
+async def upload_raw(filename: str, request: Request, user: user_dependency,
+                     x_content_sha256: str = Header(default=None)):
+    """Upload a file as the raw request body, without multipart encoding or spooling."""
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    rel_path, _ = fileops.resolve(RAID_DIR, filename)
+    if storage_pool.isdir(rel_path):
+        raise HTTPException(status_code=409, detail="A directory exists at this path")
+
+    length = request.headers.get("content-length")
+    try:
+        length = int(length) if length is not None else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid Content-Length")
+    if length is None and quota_ledger.quota(user["user_id"]):
+        raise HTTPException(status_code=411, detail="Content-Length is required when a quota applies")
+
+    # Quota and free space are both settled before the first byte is written, and before any directory is made
+    reservation = await run_in_threadpool(quota_ledger.reserve, user["user_id"], length or 0, rel_path)
+    try:
+        file_path = await run_in_threadpool(storage_pool.place, rel_path, length or 0)
+        writer = await run_in_threadpool(uploads.RawUpload, file_path, length)
+        try:
+            async for chunk in request.stream():
+                if writer.append(chunk):
+                    await run_in_threadpool(writer.write)
+            digest = await run_in_threadpool(writer.finish, x_content_sha256)
+            await run_in_threadpool(writer.commit, digest, blob_store)
+        except BaseException:
+            await run_in_threadpool(writer.abort)
+            raise
+        await run_in_threadpool(search_index.upsert_path, rel_path)
+        await run_in_threadpool(quota_ledger.record, user["user_id"], rel_path, writer.written)
+    finally:
+        quota_ledger.release(reservation)
+
+    thumbnail_cache.prefetch([file_path])
+    return {"status": "success", "path": rel_path, "size": writer.written, "sha256": digest}
+
+def _release_session(meta):
+    # Sessions created before reservations were kept have none
+    if meta.get("reservation"):
+        quota_ledger.release(meta["reservation"])
+
+def _push_upload(meta, status, bytes_done, **extra):
+    progress.hub.publish(meta["user_id"], {
+        "job_id": meta["upload_id"],
+        "kind": "upload",
+        "status": status,
+        "progress": progress.percent(status, bytes_done, meta["size"]),
+        "bytes_done": bytes_done,
+        "bytes_total": meta["size"],
+        "filename": meta["filename"],
+        **extra,
+    })
+
+@route.get("/upload/{upload_id}")
+async def get_upload_status(upload_id: str, user: user_dependency):
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    meta = await run_in_threadpool(uploads.load_session, RAID_DIR, upload_id, user["user_id"])
+    return await run_in_threadpool(uploads.session_status, RAID_DIR, meta)
+
+@route.put("/upload/{upload_id}/chunks/{index}")
+async def upload_chunk(upload_id: str, index: int, request: Request, user: user_dependency,
+                       x_chunk_sha256: str = Header(default=None)):
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    if not x_chunk_sha256:
+        raise HTTPException(status_code=400, detail="X-Chunk-SHA256 header required")
+
+    meta = await run_in_threadpool(uploads.load_session, RAID_DIR, upload_id, user["user_id"])
+    expected = uploads.chunk_length(meta, index)
+
+    # Read at most one chunk worth of body; anything larger is rejected early
+    data = bytearray()
+    async for piece in request.stream():
+        data.extend(piece)
+        if len(data) > expected:
+            raise HTTPException(status_code=413, detail=f"Chunk {index} exceeds {expected} bytes")
+
+    digest = await run_in_threadpool(uploads.write_chunk, RAID_DIR, meta, index, bytes(data), x_chunk_sha256)
+    received = await run_in_threadpool(uploads.received_chunks, RAID_DIR, meta)
+    _push_upload(meta, "uploading", min(len(received) * meta["chunk_size"], meta["size"]))
+    return {"upload_id": meta["upload_id"], "index": index, "sha256": digest}
+
+@route.post("/upload/{upload_id}/finalize")
+async def finalize_upload(upload_id: str, user: user_dependency):
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    meta = await run_in_threadpool(uploads.load_session, RAID_DIR, upload_id, user["user_id"])
+    safe_path = os.path.normpath(os.path.join(RAID_DIR, meta["path"]))
+    if not safe_path.startswith(RAID_DIR):
+        raise HTTPException(status_code=403, detail="Access denied")
+
+    # Assembly hashes the whole file, which takes a while for large ones; streams see it happen
+    _push_upload(meta, "processing", meta["size"])
+    rel_path = os.path.relpath(os.path.join(safe_path, meta["filename"]), RAID_DIR)
+
+    def finished(meta):
+        # Recorded before the reservation goes, so the bytes are never counted zero times
+        quota_ledger.record(user["user_id"], rel_path, meta["size"])
+        _release_session(meta)
+
+    try:
+        destination_dir = os.path.dirname(await run_in_threadpool(storage_pool.place, rel_path, meta["size"]))
+        file_path, digest = await run_in_threadpool(uploads.finalize_session, RAID_DIR, meta, destination_dir,
+                                                    blob_store, finished)
+    except HTTPException as e:
+        _push_upload(meta, "error", meta["size"], error=e.detail)
+        raise
+    await run_in_threadpool(search_index.upsert_path, rel_path)
+    thumbnail_cache.prefetch([file_path])
+    _push_upload(meta, "complete", meta["size"], sha256=digest)
+    return {"status": "success", "message": f"File {meta['filename']} uploaded successfully", "sha256": digest}
+
+@route.delete("/upload/{upload_id}")
+async def abort_upload(upload_id: str, user: user_dependency):
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    meta = await run_in_threadpool(uploads.load_session, RAID_DIR, upload_id, user["user_id"])
+    await run_in_threadpool(uploads.abort_session, RAID_DIR, meta, _release_session)
+    return {"status": "success"}
     
+def _walk_search(search_query, max_results):
+    # Used only until the first index build has finished
+    items = []
+    with metrics.walk_duration.time(operation="search_fallback"):
+        for rel_dir, dirs, files in storage_pool.walk(""):
+            if len(items) >= max_results:
+                break
+        
+            # Exclude hidden directories from traversal
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+
+            # Search directories
+            for d in dirs:
+                if len(items) >= max_results:
+                    break
+                if search_query in d.lower():
+                    full_rel_path = os.path.join(rel_dir, d) if rel_dir else d
+                    items.append({"name": full_rel_path, "type": "directory"})
+
+            # Search files
+            for f, _ in files:
+                if len(items) >= max_results:
+                    break
+                if not f.startswith('.') and search_query in f.lower():
+                    full_rel_path = os.path.join(rel_dir, f) if rel_dir else f
+                    items.append({"name": full_rel_path, "type": "file"})
+    return items
+
 @route.get("/list")
-async def list_files(user: user_dependency, path: str = Query(default=""), q: str = Query(default=None)):
+async def list_files(user: user_dependency, path: str = Query(default=""), q: str = Query(default=None),
+                     limit: Optional[int] = Query(default=None, ge=1, le=file_index.MAX_PAGE_SIZE),
+                     offset: int = Query(default=0, ge=0),
+                     cursor: Optional[str] = Query(default=None),
+                     sort: str = Query(default="name", pattern="^(name|size|mtime|type)$"),
+                     order: str = Query(default="asc", pattern="^(asc|desc)$"),
+                     type: Optional[str] = Query(default=None, pattern="^(file|directory)$"),
+                     ext: Optional[str] = Query(default=None),
+                     min_size: Optional[int] = Query(default=None, ge=0),
+                     max_size: Optional[int] = Query(default=None, ge=0),
+                     modified_after: Optional[float] = Query(default=None),
+                     modified_before: Optional[float] = Query(default=None)):
     if not user:
         raise HTTPException(status_code=401, detail="Unauthorized")
     
@@ -157,60 +529,58 @@ async def list_files(user: user_dependency, path: str = Query(default=""), q: st
         raise HTTPException(status_code=403, detail="Access denied")
 
     try:
-        items = []
-        
         if q:
-            # Recursive search mode
-            search_query = q.lower()
-            MAX_RESULTS = 50
-            
-            for root, dirs, files in os.walk(RAID_DIR):
-                if len(items) >= MAX_RESULTS:
-                    break
-                
-                # Exclude hidden directories from traversal
-                dirs[:] = [d for d in dirs if not d.startswith('.')]
-                
-                # Calculate relative path from RAID_DIR to current root
-                rel_dir = os.path.relpath(root, RAID_DIR)
-                if rel_dir == ".":
-                    rel_dir = ""
-
-                # Search directories
-                for d in dirs:
-                    if len(items) >= MAX_RESULTS:
-                        break
-                    if search_query in d.lower():
-                        full_rel_path = os.path.join(rel_dir, d) if rel_dir else d
-                        items.append({"name": full_rel_path, "type": "directory"})
-
-                # Search files
-                for f in files:
-                    if len(items) >= MAX_RESULTS:
-                        break
-                    if not f.startswith('.') and search_query in f.lower():
-                        full_rel_path = os.path.join(rel_dir, f) if rel_dir else f
-                        items.append({"name": full_rel_path, "type": "file"})
-            
-            # Limit results for performance? (optional, skipping for now)
-        else:
-            # Normal browse mode
-            if not os.path.exists(safe_path):
-                 return {"items": [], "count": 0} # Or raise 404, but empty list is safer for UI
-
-            with os.scandir(safe_path) as entries:
-                for entry in entries:
-                    if entry.is_dir():
-                        items.append({"name": entry.name, "type": "directory"})
-                    elif entry.is_file():
-                        items.append({"name": entry.name, "type": "file"})
-            
-            # Sort: Directories first, then files. Alphabetical order.
-            items.sort(key=lambda x: (x["type"] != "directory", x["name"].lower()))
+            limit = limit or SEARCH_PAGE_SIZE
+            if not search_index.ready:
+                items = await run_in_threadpool(_walk_search, q.lower(), limit)
+                return {"items": items, "count": len(items), "has_more": False, "indexing": True}
+
+            extensions = [e for e in ext.split(",") if e] if ext else None
+            result = await run_in_threadpool(
+                search_index.search, q, limit, offset, type, extensions,
+                min_size, max_size, modified_after, modified_before
+            )
+            items = result["items"]
+            return {"items": items, "count": len(items), "has_more": result["has_more"]}
+
+        # Normal browse mode
+        if not storage_pool.isdir(os.path.relpath(safe_path, RAID_DIR)):
+            return {"items": [], "count": 0, "total": 0, "next_cursor": None} # Or raise 404, but empty list is safer for UI
+
+        try:
+            page = await run_in_threadpool(
+                directory_cache.page, safe_path, sort, order == "desc",
+                limit or BROWSE_PAGE_SIZE, cursor, (uploads.STAGING_DIR_NAME, cas.BLOB_DIR_NAME)
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        items = page["items"]
+        # Warm the grid-view thumbnails for this directory in the background
+        thumbnail_cache.prefetch_directory(safe_path, [item["name"] for item in items if item["type"] == "file"])
+        if search_index.ready:
+            # Recursive folder sizes come from the index's running totals
+            rel_dir = os.path.relpath(safe_path, RAID_DIR)
+            rel_dir = "" if rel_dir == "." else rel_dir
+            dir_paths = [os.path.join(rel_dir, item["name"]) for item in items if item["type"] == "directory"]
+            stats = await run_in_threadpool(search_index.dir_stats, dir_paths)
+            items = [
+                {**item, "size": stats[os.path.join(rel_dir, item["name"])]["size"],
+                 "file_count": stats[os.path.join(rel_dir, item["name"])]["files"]}
+                if item["type"] == "directory" else item
+                for item in items
+            ]
 
-        return {"items": items, "count": len(items)}
+        return {
+            "items": items,
+            "count": len(items),
+            "total": page["total"],
+            "next_cursor": page["next_cursor"]
+        }
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"Error listing files: {e}")
+        logger.exception("Error listing files in %s", path)
         raise HTTPException(status_code=500, detail=str(e))
 
 @route.post("/mkdir")
@@ -225,64 +595,283 @@ async def create_directory(request: CreateFolderRequest, user: user_dependency):
     new_folder_path = os.path.join(safe_path, request.folder_name)
     
     try:
+        # New folders start out on the primary volume; files placed in them elsewhere mirror the path there
+        if storage_pool.exists(os.path.relpath(new_folder_path, RAID_DIR)):
+            raise FileExistsError(new_folder_path)
         os.makedirs(new_folder_path, exist_ok=False)
+        await run_in_threadpool(search_index.upsert_path, os.path.relpath(new_folder_path, RAID_DIR))
         return {"status": "success", "message": f"Folder {request.folder_name} created successfully"}
     except FileExistsError:
         raise HTTPException(status_code=400, detail="Folder already exists")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-from fastapi import BackgroundTasks
-
-# ... (imports)
-
 @route.get("/download/{filename:path}")
-async def download(filename: str, user: user_dependency, background_tasks: BackgroundTasks):
+async def download(filename: str, request: Request, user: user_dependency, store_compressed: bool = Query(default=True)):
     if not user:
         raise HTTPException(status_code=401, detail="Unauthorized")
     
-    file_path = os.path.join(RAID_DIR, filename)
+    filename, _ = fileops.resolve(RAID_DIR, filename)
+    file_path = storage_pool.locate(filename)
     
     if os.path.isfile(file_path):
-        return FileResponse(file_path, filename=os.path.basename(filename), media_type="application/octet-stream")
+        storage_pool.record_access(filename)
+        return conditional.file_response(request, file_path, os.path.basename(filename))
     
-    elif os.path.isdir(file_path):
-        # Create a zip file for the directory
-        archive_name = os.path.basename(filename)
-        # Use a temp directory or just /tmp. 
-        # mktemp is deprecated, but we can standard /tmp location with a unique name if needed, 
-        # but simpler is /tmp + Safe Name for now.
-        # Actually shutil.make_archive adds the extension .zip automatically
-        zip_base_name = os.path.join("/tmp", archive_name)
-        
-        try:
-            # root_dir is the parent directory, base_dir is the directory itself to zip relative to root
-            # shutil.make_archive(zip_base_name, 'zip', file_path) # This zips contents OF file_path
-            
-            zip_path = shutil.make_archive(zip_base_name, 'zip', file_path)
-            
-            # Add cleanup task
-            background_tasks.add_task(os.remove, zip_path)
-            
-            return FileResponse(zip_path, filename=f"{archive_name}.zip", media_type="application/zip")
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Error creating zip: {str(e)}")
+    elif storage_pool.isdir(filename):
+        # Stream the archive as it is built; nothing is staged in /tmp
+        archive_name = os.path.basename(os.path.normpath(filename)) or "download"
+        return StreamingResponse(
+            zipstream.stream_zip(storage_pool.dir_copies(filename), store_compressed=store_compressed),
+            media_type="application/zip",
+            headers={"Content-Disposition": content_disposition(f"{archive_name}.zip")}
+        )
             
     else:
         raise HTTPException(status_code=404, detail="File or directory not found")
 
-@route.delete("/delete/{filename}")
-async def delete(filename: str,user: user_dependency):
+@route.get("/signature/{filename:path}")
+async def file_signature(filename: str, user: user_dependency,
+                         block_size: Optional[int] = Query(default=None, ge=delta.MIN_BLOCK_SIZE,
+                                                           le=delta.MAX_BLOCK_SIZE)):
     if not user:
         raise HTTPException(status_code=401, detail="Unauthorized")
-    file_path = os.path.join(RAID_DIR, filename)
+
+    rel_path, _ = fileops.resolve(RAID_DIR, filename)
+    file_path = storage_pool.locate(rel_path)
+    try:
+        stat_result = os.stat(file_path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="File not found")
     if not os.path.isfile(file_path):
+        raise HTTPException(status_code=400, detail="Not a file")
+
+    block_size = block_size or delta.default_block_size(stat_result.st_size)
+    # The client sends this ETag back as If-Match with its delta. It is strong even for a file written
+    # a moment ago: apply_delta compares the exact stat again before it replaces anything
+    return StreamingResponse(delta.iter_signature(file_path, block_size), media_type="application/octet-stream",
+                             headers={"etag": conditional.strong_etag(stat_result)})
+
+@route.post("/delta/{filename:path}")
+async def apply_delta(filename: str, request: Request, user: user_dependency):
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    rel_path, _ = fileops.resolve(RAID_DIR, filename)
+    file_path = storage_pool.locate(rel_path)
+    if "if-match" not in request.headers:
+        raise HTTPException(status_code=428, detail="If-Match with the signature's ETag is required")
+    try:
+        base_stat = os.stat(file_path)
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="File not found")
+    if not os.path.isfile(file_path):
+        raise HTTPException(status_code=400, detail="Not a file")
+    if conditional.precondition_failed(request, conditional.strong_etag(base_stat), base_stat.st_mtime):
+        raise HTTPException(status_code=412, detail="File changed since the signature was taken")
+
+    applier = await run_in_threadpool(delta.DeltaApplier, file_path)
+    try:
+        async for chunk in request.stream():
+            await run_in_threadpool(applier.feed, chunk)
+        digest = await run_in_threadpool(applier.finish)
+        # Someone may have written the file while the delta was streaming in
+        current = os.stat(file_path)
+        if (current.st_ino, current.st_mtime_ns, current.st_size) != \
+                (base_stat.st_ino, base_stat.st_mtime_ns, base_stat.st_size):
+            raise HTTPException(status_code=412, detail="File changed while the delta was uploaded")
+        # The rebuilt file replaces the old one, which it is charged against like an upload
+        new_size = applier.copied_bytes + applier.literal_bytes
+        reservation = await run_in_threadpool(quota_ledger.reserve, user["user_id"], new_size, rel_path)
+        try:
+            await run_in_threadpool(applier.commit, digest, blob_store)
+            await run_in_threadpool(quota_ledger.record, user["user_id"], rel_path, new_size)
+        finally:
+            quota_ledger.release(reservation)
+    except BaseException:
+        await run_in_threadpool(applier.abort)
+        raise
+
+    await run_in_threadpool(search_index.upsert_path, rel_path)
+    thumbnail_cache.prefetch([file_path])
+    new_stat = os.stat(file_path)
+    return JSONResponse(
+        {"status": "success", "size": new_stat.st_size, "sha256": digest,
+         "copied_bytes": applier.copied_bytes, "literal_bytes": applier.literal_bytes},
+        headers={"etag": conditional.strong_etag(new_stat)}
+    )
+
+@route.get("/thumbnail/{filename:path}")
+async def thumbnail(filename: str, request: Request, user: user_dependency,
+                    size: str = Query(default="medium", pattern="^(small|medium|large)$")):
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    file_path = os.path.normpath(os.path.join(RAID_DIR, filename))
+    if not file_path.startswith(RAID_DIR):
+        raise HTTPException(status_code=403, detail="Access denied")
+    file_path = storage_pool.locate(os.path.relpath(file_path, RAID_DIR))
+    if not os.path.isfile(file_path):
+        raise HTTPException(status_code=404, detail="File not found")
+
+    try:
+        thumb_path, future = await run_in_threadpool(thumbnail_cache.thumbnail, file_path, size)
+        if future is not None:
+            await asyncio.wrap_future(future)
+    except ValueError as e:
+        raise HTTPException(status_code=415, detail=str(e))
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="File not found")
+    except Exception as e:
+        logger.warning("Error generating thumbnail for %s: %s", filename, e)
+        raise HTTPException(status_code=422, detail="Could not generate a thumbnail for this file")
+
+    thumb_name = f"{os.path.splitext(os.path.basename(file_path))[0]}.jpg"
+    response = conditional.file_response(request, thumb_path, thumb_name, media_type="image/jpeg")
+    response.headers["Cache-Control"] = "private, max-age=86400"
+    return response
+
+@route.delete("/delete/{filename:path}")
+async def delete(filename: str,user: user_dependency):
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
     
     try:
-        os.remove(file_path)
-        return {"status": "success", "message": f"File {filename} deleted successfully"}
+        await run_in_threadpool(fileops.delete_path, storage_pool, search_index, filename)
+        return {"status": "success", "message": f"{filename} deleted successfully"}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+@route.post("/move")
+async def move(request: TransferRequest, user: user_dependency):
+    """Move or rename a file or folder; an atomic rename on the same filesystem."""
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    return await run_in_threadpool(
+        fileops.move_path, storage_pool, search_index, request.path, request.destination, request.overwrite
+    )
+
+@route.post("/copy")
+async def copy(request: TransferRequest, user: user_dependency):
+    """Copy a file or folder on the server (reflink / copy_file_range where supported).
+
+    Folders larger than COPY_INLINE_BYTES (or background=true) are copied by
+    a job: poll /files/copy/{job_id} for byte progress.
+    """
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    source, _ = fileops.resolve(RAID_DIR, request.path)
+    fileops.resolve(RAID_DIR, request.destination)
+    sources = storage_pool.locations(source)
+    if not sources:
+        raise HTTPException(status_code=404, detail="File or directory not found")
+
+    background = request.background
+    if background is None:
+        background = await run_in_threadpool(fileops.copy_size, sources) > fileops.COPY_INLINE_BYTES
+
+    if background:
+        try:
+            job_id = await run_in_threadpool(
+                job_manager.submit, user["user_id"], "copy",
+                {"path": request.path, "destination": request.destination, "overwrite": request.overwrite},
+                os.path.basename(os.path.normpath(request.destination))
+            )
+        except jobs.QueueFull:
+            raise HTTPException(status_code=429, detail="Too many queued jobs")
+        return JSONResponse(status_code=202, content={"job_id": job_id, "status": "queued"})
+
+    return await run_in_threadpool(
+        fileops.copy_path, storage_pool, search_index, request.path, request.destination, request.overwrite,
+        ledger=quota_ledger, user_id=user["user_id"]
+    )
+
+@route.get("/copy/{job_id}")
+async def get_copy_status(job_id: str, user: user_dependency):
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    job = await run_in_threadpool(job_manager.get, job_id, user["user_id"])
+    if not job or job["kind"] != "copy":
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@route.delete("/copy/{job_id}")
+async def cancel_copy(job_id: str, user: user_dependency):
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    if not await run_in_threadpool(job_manager.cancel, job_id, user["user_id"]):
+        raise HTTPException(status_code=404, detail="Job not found or already finished")
+    return {"status": "success"}
+
+@route.post("/batch")
+async def batch(request: BatchRequest, user: user_dependency):
+    """Apply many delete/move/copy/rename operations in one request.
+
+    Small batches stream one NDJSON result line per operation as each one
+    finishes. Large batches (or background=true) are queued as a job;
+    poll /files/batch/{job_id} and fetch the results from
+    /files/batch/{job_id}/results.
+    """
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    if not request.operations:
+        raise HTTPException(status_code=400, detail="No operations given")
+    if len(request.operations) > fileops.MAX_BATCH_OPERATIONS:
+        raise HTTPException(status_code=413, detail=f"At most {fileops.MAX_BATCH_OPERATIONS} operations per batch")
+
+    operations = [operation.model_dump(exclude_none=True) for operation in request.operations]
+    background = request.background
+    if background is None:
+        background = len(operations) > fileops.BATCH_INLINE_LIMIT
+
+    if background:
+        try:
+            job_id = await run_in_threadpool(
+                job_manager.submit, user["user_id"], "batch", {"operations": operations}, "batch-results.ndjson"
+            )
+        except jobs.QueueFull:
+            raise HTTPException(status_code=429, detail="Too many queued jobs")
+        return JSONResponse(status_code=202, content={"job_id": job_id, "status": "queued"})
+
+    return StreamingResponse(
+        fileops.ndjson(fileops.iter_batch(storage_pool, search_index, operations,
+                                          ledger=quota_ledger, user_id=user["user_id"])),
+        media_type="application/x-ndjson"
+    )
+
+@route.get("/batch/{job_id}")
+async def get_batch_status(job_id: str, user: user_dependency):
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    job = await run_in_threadpool(job_manager.get, job_id, user["user_id"])
+    if not job or job["kind"] != "batch":
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@route.get("/batch/{job_id}/results")
+async def get_batch_results(job_id: str, request: Request, user: user_dependency):
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    file_path, filename = await run_in_threadpool(job_manager.result_path, job_id, user["user_id"])
+    if not file_path or not os.path.isfile(file_path):
+        raise HTTPException(status_code=400, detail="Job not complete or found")
+    return conditional.file_response(request, file_path, filename, media_type="application/x-ndjson")
+
+@route.delete("/batch/{job_id}")
+async def cancel_batch(job_id: str, user: user_dependency):
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    if not await run_in_threadpool(job_manager.cancel, job_id, user["user_id"]):
+        raise HTTPException(status_code=404, detail="Job not found or already finished")
+    return {"status": "success"}
     
 @route.get("/usage")
 async def disk_usage(user: user_dependency):
@@ -290,12 +879,19 @@ async def disk_usage(user: user_dependency):
         raise HTTPException(status_code=401, detail="Unauthorized")
     
     try:
-        # Usa shutil.disk_usage() en la ruta de tu RAID
-        total, used, free = shutil.disk_usage(RAID_DIR)
+        # Usa shutil.disk_usage() en cada volumen; el total es el del pool entero
+        pool_usage = await run_in_threadpool(storage_pool.usage)
+        total, used, free = pool_usage["total_bytes"], pool_usage["used_bytes"], pool_usage["free_bytes"]
         
         # Opcional: obtener la ruta real para el frontend
         raid_path = os.path.abspath(RAID_DIR)
 
+        # Bytes and files actually stored under RAID_DIR, from the index totals
+        indexed = {"size": None, "files": None}
+        if search_index.ready:
+            indexed = (await run_in_threadpool(search_index.dir_stats, [""]))[""]
+        user_used = await run_in_threadpool(quota_ledger.usage, user["user_id"])
+
         return {
             "path": raid_path,
             "total_bytes": total, 
@@ -304,8 +900,67 @@ async def disk_usage(user: user_dependency):
             # También puedes devolver valores en GB para el frontend
             "total_gb": round(total / (1024**3), 2),
             "used_gb": round(used / (1024**3), 2),
-            "free_gb": round(free / (1024**3), 2)
+            "free_gb": round(free / (1024**3), 2),
+            "stored_bytes": indexed["size"],
+            "stored_files": indexed["files"],
+            "user_used_bytes": user_used,
+            "user_quota_bytes": quota_ledger.quota(user["user_id"]) or None,
+            "volumes": pool_usage["volumes"]
         }
     except Exception as e:
         # Esto captura errores como que la ruta no existe o problemas de permisos
-        raise HTTPException(status_code=500, detail=f"Error al obtener el uso del disco: {str(e)}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Error al obtener el uso del disco: {str(e)}")
+
+@route.get("/usage/breakdown")
+async def usage_breakdown(user: user_dependency, path: str = Query(default=""),
+                          top: int = Query(default=10, ge=1, le=500),
+                          direct: bool = Query(default=False)):
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    safe_path = os.path.normpath(os.path.join(RAID_DIR, path))
+    if not safe_path.startswith(RAID_DIR):
+        raise HTTPException(status_code=403, detail="Access denied")
+    if not search_index.ready:
+        raise HTTPException(status_code=503, detail="Index is still being built")
+
+    rel_path = os.path.relpath(safe_path, RAID_DIR)
+    rel_path = "" if rel_path == "." else rel_path
+    totals = (await run_in_threadpool(search_index.dir_stats, [rel_path]))[rel_path]
+    directories = await run_in_threadpool(search_index.largest_directories, rel_path, top, direct)
+    return {"path": rel_path, "size": totals["size"], "files": totals["files"], "directories": directories}
+
+@route.get("/changes")
+async def list_changes(user: user_dependency,
+                       since: int = Query(default=0, ge=0),
+                       limit: int = Query(default=1000, ge=1, le=changes.MAX_PAGE_SIZE),
+                       timeout: float = Query(default=0, ge=0, le=60),
+                       path: Optional[str] = Query(default=None)):
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    if path:
+        safe_path = os.path.normpath(os.path.join(RAID_DIR, path))
+        if not safe_path.startswith(RAID_DIR):
+            raise HTTPException(status_code=403, detail="Access denied")
+        path = os.path.relpath(safe_path, RAID_DIR)
+        path = None if path == "." else path
+
+    try:
+        result = await run_in_threadpool(change_journal.read, since, limit, path)
+        # Long poll: hold the request until something is journaled or the timeout passes
+        if not result[0] and timeout and await change_journal.wait(result[1], timeout):
+            result = await run_in_threadpool(change_journal.read, result[1], limit, path)
+    except changes.CursorExpired:
+        raise HTTPException(status_code=410, detail="Cursor expired; full resync required")
+
+    items, cursor, has_more = result
+    return {"changes": items, "cursor": cursor, "has_more": has_more}
+
+@route.get("/changes/cursor")
+async def latest_change_cursor(user: user_dependency):
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    # Clients take this before their initial full listing, then poll /changes from it
+    return {"cursor": change_journal.latest_seq}
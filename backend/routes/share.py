@@ -1,42 +1,60 @@
-from fastapi import APIRouter, Depends, HTTPException, status, BackgroundTasks
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, status
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import datetime, timedelta
 import uuid
 import os
-import shutil
-from settings.database import SessionLocal
+import stat
 from models.shared_link import SharedLink
 from typing import Annotated
 from auth.auth import get_current_user, get_db
-from fastapi.responses import FileResponse
+from fastapi.responses import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+from routes.files import RAID_DIR, search_index, storage_pool
+from services import conditional, events, fileops, state, zipstream
+from services.share_cache import ShareCache
+from services.zipstream import content_disposition
 
 router = APIRouter(
     prefix="/share",
     tags=["Share"]
 )
 
-RAID_DIR = r"/home/androide47/Documentos"
-db_dependency = Annotated[Session, Depends(get_db)]
+DEFAULT_EXPIRY_HOURS = 24
+MAX_EXPIRY_HOURS = int(os.environ.get("SHARE_MAX_EXPIRY_HOURS", str(24 * 30)))
+db_dependency = Annotated[AsyncSession, Depends(get_db)]
 user_dependency = Annotated[dict, Depends(get_current_user)]
 
+share_cache = ShareCache()
+events.subscribe(share_cache.handle_event)
+# Revocations made by other worker processes
+state.store.subscribe("share-revoked", share_cache.invalidate)
+
 @router.post("/create")
 async def create_share_link(data: dict, user: user_dependency, db: db_dependency):
-    # expect data = {"path": "relative/path/to/file"}
+    # expect data = {"path": "relative/path/to/file", "expires_in_hours": 24 (optional)}
     file_path = data.get("path")
     if not file_path:
         raise HTTPException(status_code=400, detail="Path is required")
         
     if not user:
         raise HTTPException(status_code=401, detail="Unauthorized")
+
+    try:
+        expires_in_hours = float(data.get("expires_in_hours", DEFAULT_EXPIRY_HOURS))
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="expires_in_hours must be a number")
+    if not 0 < expires_in_hours <= MAX_EXPIRY_HOURS:
+        raise HTTPException(status_code=400, detail=f"expires_in_hours must be between 0 and {MAX_EXPIRY_HOURS}")
     
     # Validate file existence
-    full_path = os.path.join(RAID_DIR, file_path)
-    if not os.path.exists(full_path):
+    file_path, _ = fileops.resolve(RAID_DIR, file_path)
+    if not storage_pool.exists(file_path):
         raise HTTPException(status_code=404, detail="File not found")
         
     # Generate token
     token = str(uuid.uuid4())
-    expires_at = datetime.utcnow() + timedelta(hours=24)
+    expires_at = datetime.utcnow() + timedelta(hours=expires_in_hours)
     
     new_share = SharedLink(
         token=token,
@@ -47,15 +65,21 @@ async def create_share_link(data: dict, user: user_dependency, db: db_dependency
     )
     
     db.add(new_share)
-    db.commit()
+    await db.commit()
     
     # Construct full URL? Frontend needs just the token usually to build the link
     # But user asked for "link". We'll return the token mostly.
     return {"token": token, "expires_at": expires_at}
 
-@router.get("/{token}/info")
-async def get_share_info(token: str, db: db_dependency):
-    share = db.query(SharedLink).filter(SharedLink.token == token, SharedLink.is_active == True).first()
+async def resolve_share(token: str, db):
+    """Look a token up through the share cache, falling back to the database and disk."""
+    entry = share_cache.get(token)
+    if entry is not None:
+        return entry
+
+    share = (await db.execute(
+        select(SharedLink).where(SharedLink.token == token, SharedLink.is_active == True)
+    )).scalars().first()
     
     if not share:
         raise HTTPException(status_code=404, detail="Link not found")
@@ -63,68 +87,92 @@ async def get_share_info(token: str, db: db_dependency):
     if datetime.utcnow() > share.expires_at:
         raise HTTPException(status_code=410, detail="Link expired")
         
-    full_path = os.path.join(RAID_DIR, share.file_path)
-    if not os.path.exists(full_path):
+    rel_path, _ = fileops.resolve(RAID_DIR, share.file_path)
+    try:
+        stats = storage_pool.stat(rel_path)
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="File no longer exists")
-        
-    # Get file stats
-    stats = os.stat(full_path)
-    is_dir = os.path.isdir(full_path)
-    
-    return {
+
+    full_path = storage_pool.locate(rel_path)
+    is_dir = stat.S_ISDIR(stats.st_mode)
+    size = stats.st_size
+    if is_dir and search_index.ready:
+        # A directory inode's st_size is meaningless; report what it contains
+        size = (await run_in_threadpool(search_index.dir_stats, [rel_path]))[rel_path]["size"]
+
+    entry = {
+        "rel_path": rel_path,
+        "full_path": full_path,
         "filename": os.path.basename(share.file_path),
-        "size": stats.st_size,
+        "size": size,
         "is_dir": is_dir,
         "created_at": share.created_at,
         "expires_at": share.expires_at
     }
+    share_cache.put(token, entry)
+    return entry
 
-@router.get("/{token}/download")
-async def download_shared_file(token: str, db: db_dependency, background_tasks: BackgroundTasks):
-    share = db.query(SharedLink).filter(SharedLink.token == token, SharedLink.is_active == True).first()
+@router.get("/{token}/info")
+async def get_share_info(token: str, db: db_dependency):
+    share = await resolve_share(token, db)
     
-    if not share:
-        raise HTTPException(status_code=404, detail="Link not found")
-        
-    if datetime.utcnow() > share.expires_at:
-        raise HTTPException(status_code=410, detail="Link expired")
-        
-    full_path = os.path.join(RAID_DIR, share.file_path)
-    if not os.path.exists(full_path):
-        raise HTTPException(status_code=404, detail="File no longer exists")
+    return {
+        "filename": share["filename"],
+        "size": share["size"],
+        "is_dir": share["is_dir"],
+        "created_at": share["created_at"],
+        "expires_at": share["expires_at"]
+    }
 
-    filename = os.path.basename(share.file_path)
+@router.get("/{token}/download")
+async def download_shared_file(token: str, request: Request, db: db_dependency, store_compressed: bool = True):
+    share = await resolve_share(token, db)
+    filename = share["filename"]
     
-    if os.path.isdir(full_path):
-        # Zip folder logic
-        archive_name = filename
-        zip_base_name = os.path.join("/tmp", f"{share.token}_{archive_name}")
-        
-        try:
-            zip_path = shutil.make_archive(zip_base_name, 'zip', full_path)
-            background_tasks.add_task(os.remove, zip_path)
-            return FileResponse(zip_path, filename=f"{archive_name}.zip", media_type="application/zip")
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Error creating zip: {str(e)}")
+    if share["is_dir"]:
+        # Stream the folder as a zip while it is being read
+        return StreamingResponse(
+            zipstream.stream_zip(storage_pool.dir_copies(share["rel_path"]), store_compressed=store_compressed),
+            media_type="application/zip",
+            headers={"Content-Disposition": content_disposition(f"{filename}.zip")}
+        )
         
-    return FileResponse(full_path, filename=filename, media_type="application/octet-stream")
+    # Located and stat()ed again: the rebalancer may have moved it to another volume since it was cached
+    storage_pool.record_access(share["rel_path"])
+    return conditional.file_response(request, storage_pool.locate(share["rel_path"]), filename)
 
 @router.get("/list")
-async def list_shared_links(user: user_dependency, db: db_dependency):
+async def list_shared_links(user: user_dependency, db: db_dependency,
+                            limit: int = Query(default=100, ge=1, le=500),
+                            offset: int = Query(default=0, ge=0),
+                            include_expired: bool = Query(default=True)):
     if not user:
         raise HTTPException(status_code=401, detail="Unauthorized")
-        
-    links = db.query(SharedLink).filter(SharedLink.user_id == user["user_id"], SharedLink.is_active == True).all()
+
+    # Served by ix_shared_links_user_active_expires; expiry is evaluated in SQL
+    now = datetime.utcnow()
+    query = select(
+        SharedLink.token,
+        SharedLink.file_path,
+        SharedLink.created_at,
+        SharedLink.expires_at,
+        (SharedLink.expires_at < now).label("is_expired")
+    ).where(SharedLink.user_id == user["user_id"], SharedLink.is_active == True)
+    if not include_expired:
+        query = query.where(SharedLink.expires_at >= now)
+    query = query.order_by(SharedLink.expires_at.desc()).limit(limit).offset(offset)
+
+    rows = (await db.execute(query)).all()
     
     return [
         {
-            "token": link.token,
-            "file_path": link.file_path,
-            "created_at": link.created_at,
-            "expires_at": link.expires_at,
-            "is_expired": datetime.utcnow() > link.expires_at
+            "token": row.token,
+            "file_path": row.file_path,
+            "created_at": row.created_at,
+            "expires_at": row.expires_at,
+            "is_expired": bool(row.is_expired)
         }
-        for link in links
+        for row in rows
     ]
 
 @router.delete("/{token}")
@@ -132,10 +180,14 @@ async def delete_share_link(token: str, user: user_dependency, db: db_dependency
     if not user:
         raise HTTPException(status_code=401, detail="Unauthorized")
         
-    link = db.query(SharedLink).filter(SharedLink.token == token, SharedLink.user_id == user["user_id"]).first()
+    link = (await db.execute(
+        select(SharedLink).where(SharedLink.token == token, SharedLink.user_id == user["user_id"])
+    )).scalars().first()
     if not link:
         raise HTTPException(status_code=404, detail="Link not found")
         
     link.is_active = False 
-    db.commit()
+    await db.commit()
+    share_cache.invalidate(token)
+    await run_in_threadpool(state.store.publish, "share-revoked", token)
     return {"status": "success"}
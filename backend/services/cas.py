@@ -0,0 +1,295 @@
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+
+from services import events, metrics, state
+
+logger = logging.getLogger(__name__)
+
+# Off by default: it changes how uploaded files are laid out on disk (hardlinks into the blob store)
+CAS_ENABLED = os.environ.get("CAS_ENABLED", "false").lower() in ("1", "true", "yes")
+# Inside the storage root so blobs and user paths share a filesystem and can be hardlinked
+BLOB_DIR_NAME = ".cloud_drive_blobs"
+QUARANTINE_DIR_NAME = "quarantine"
+SCRUB_STATE_FILE = "last_scrub"
+
+GC_INTERVAL_SECONDS = int(os.environ.get("CAS_GC_INTERVAL", "600"))
+# A blob whose last link went away less than this long ago is kept, in case an upload is linking it right now
+GC_GRACE_SECONDS = int(os.environ.get("CAS_GC_GRACE", "300"))
+SCRUB_INTERVAL_SECONDS = int(os.environ.get("CAS_SCRUB_INTERVAL", str(7 * 24 * 3600)))
+SCRUB_BYTES_PER_SECOND = int(os.environ.get("CAS_SCRUB_RATE", str(16 * 1024 * 1024)))
+HASH_BUFFER_SIZE = 1024 * 1024
+
+_DIGEST_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+def is_digest(value):
+    return bool(value) and _DIGEST_RE.match(value) is not None
+
+
+def copy_hashed(src, dest, buffer_size=HASH_BUFFER_SIZE):
+    """Copy file object src to dest, returning the SHA-256 of what was written."""
+    digest = hashlib.sha256()
+    while True:
+        block = src.read(buffer_size)
+        if not block:
+            break
+        digest.update(block)
+        dest.write(block)
+    return digest.hexdigest()
+
+
+def hash_file(path, rate=None, stop=None):
+    """SHA-256 of a file; rate caps the read speed in bytes per second.
+
+    Returns None if stop (a threading.Event) is set part way through.
+    """
+    digest = hashlib.sha256()
+    started = time.monotonic()
+    done = 0
+    with open(path, "rb") as f:
+        fd = f.fileno()
+        while True:
+            block = f.read(HASH_BUFFER_SIZE)
+            if not block:
+                break
+            digest.update(block)
+            done += len(block)
+            if rate:
+                # Scrubbing should not evict the page cache that serves real downloads
+                if hasattr(os, "posix_fadvise"):
+                    os.posix_fadvise(fd, done - len(block), len(block), os.POSIX_FADV_DONTNEED)
+                ahead = done / rate - (time.monotonic() - started)
+                if stop is not None and stop.wait(ahead if ahead > 0 else 0):
+                    return None
+    return digest.hexdigest()
+
+
+def _temp_name(dest):
+    # Hidden, so neither the index nor listings pick it up before the rename
+    return os.path.join(os.path.dirname(dest), f".{os.path.basename(dest)}.{uuid.uuid4().hex}.tmp")
+
+
+class BlobStore:
+    """Content-addressed storage of uploaded files.
+
+    Every unique file content is stored once under BLOB_DIR_NAME, named by
+    its SHA-256, and each user-visible path holding that content is a
+    hardlink to the blob. The link count is the reference count: deleting
+    or replacing a user file drops it, and a blob left with a single link
+    is garbage. Moves and renames keep working unchanged, since they keep
+    the inode.
+
+    Files are only ever replaced through a rename, never rewritten in
+    place, so one link cannot change the content behind the others. The
+    scrubber re-hashes blobs at a throttled rate and quarantines any whose
+    bytes no longer match their name.
+
+    Hardlinks cannot cross filesystems, so each storage volume has its own
+    blob directory and content is deduplicated per volume.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.root = pool.root
+        self.blob_dir = os.path.join(pool.root, BLOB_DIR_NAME)
+        self.blob_dirs = [os.path.join(volume.path, BLOB_DIR_NAME) for volume in pool.volumes]
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._gc_due = None
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def blob_path(self, digest, dest=None):
+        """Where the blob for digest lives on dest's volume (the primary volume without dest)."""
+        blob_dir = self.blob_dir
+        if dest is not None and not self.pool.single:
+            blob_dir = os.path.join(self.pool.volume_of(dest).path, BLOB_DIR_NAME)
+        return os.path.join(blob_dir, digest[:2], digest[2:4], digest)
+
+    def link_existing(self, digest, size, dest):
+        """Point dest at the stored blob for digest; False if there is no such blob.
+
+        size must match the blob, so a client cannot claim content it does not have
+        by guessing a hash with a wrong length.
+        """
+        blob = self.blob_path(digest, dest)
+        tmp = _temp_name(dest)
+        try:
+            if os.stat(blob).st_size != size:
+                return False
+            os.link(blob, tmp)
+        except FileNotFoundError:
+            # Unknown, or collected between the stat and the link
+            return False
+        os.replace(tmp, dest)
+        metrics.cas_dedup_hits.inc()
+        metrics.cas_bytes_saved.inc(size)
+        return True
+
+    def adopt(self, src, digest, dest):
+        """Move the file at src, whose content hashes to digest, to dest, storing its content once.
+
+        Returns True if the content was already stored and src was discarded.
+        """
+        size = os.stat(src).st_size
+        if self.link_existing(digest, size, dest):
+            os.remove(src)
+            return True
+
+        blob = self.blob_path(digest, dest)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        try:
+            os.link(src, blob)
+        except FileExistsError:
+            # Another upload stored the same content after our lookup
+            if self.link_existing(digest, size, dest):
+                os.remove(src)
+                return True
+        os.replace(src, dest)
+        return False
+
+    def collect_garbage(self, now=None):
+        """Remove blobs no user path links to any more; returns (blobs, bytes) freed."""
+        now = time.time() if now is None else now
+        removed = freed = 0
+        for dirpath, dirnames, names in self._walk_blobs():
+            dirnames[:] = [d for d in dirnames if d != QUARANTINE_DIR_NAME]
+            for name in names:
+                if not is_digest(name):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.lstat(path)
+                    # ctime moves whenever a link is added or removed
+                    if st.st_nlink > 1 or st.st_ctime > now - GC_GRACE_SECONDS:
+                        continue
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+                removed += 1
+                freed += st.st_size
+        if removed:
+            metrics.cas_blobs_collected.inc(removed)
+            logger.info("Collected %d unreferenced blobs (%d bytes)", removed, freed)
+        return removed, freed
+
+    def scrub(self, rate=SCRUB_BYTES_PER_SECOND):
+        """Re-hash every blob; returns the digests that were quarantined, or None if stopped early."""
+        corrupt = []
+        for dirpath, dirnames, names in self._walk_blobs():
+            dirnames[:] = [d for d in dirnames if d != QUARANTINE_DIR_NAME]
+            for name in names:
+                if not is_digest(name):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    actual = hash_file(path, rate, self._stop)
+                    size = os.stat(path).st_size
+                except FileNotFoundError:
+                    continue
+                if actual is None:
+                    return None
+                metrics.cas_scrub_bytes.inc(size)
+                if actual != name:
+                    self._quarantine(path, name)
+                    corrupt.append(name)
+        self._write_scrub_state(time.time())
+        return corrupt
+
+    def _walk_blobs(self):
+        for blob_dir in self.blob_dirs:
+            yield from os.walk(blob_dir)
+
+    def _quarantine(self, path, digest):
+        # Out of the store, so no new upload is deduplicated against the damaged copy
+        blob_dir = next(d for d in self.blob_dirs if path.startswith(d + os.sep))
+        quarantine = os.path.join(blob_dir, QUARANTINE_DIR_NAME)
+        os.makedirs(quarantine, exist_ok=True)
+        links = os.stat(path).st_nlink - 1
+        os.rename(path, os.path.join(quarantine, f"{digest}.{int(time.time())}"))
+        metrics.cas_corrupt_blobs.inc()
+        logger.error("Blob %s failed verification and was quarantined; %d user file(s) share its content",
+                     digest, links)
+
+    def _read_scrub_state(self):
+        try:
+            with open(os.path.join(self.blob_dir, SCRUB_STATE_FILE)) as f:
+                return float(f.read().strip())
+        except (FileNotFoundError, ValueError):
+            return 0.0
+
+    def _write_scrub_state(self, when):
+        path = os.path.join(self.blob_dir, SCRUB_STATE_FILE)
+        with open(f"{path}.tmp", "w") as f:
+            f.write(str(when))
+        os.replace(f"{path}.tmp", path)
+
+    def handle_event(self, event):
+        # A delete, overwrite or move onto a file may have dropped a blob's last link;
+        # look again once the grace period is over
+        if event["type"] != "created":
+            with self._lock:
+                if self._gc_due is None:
+                    self._gc_due = time.monotonic() + GC_GRACE_SECONDS + 1
+            self._wake.set()
+
+    def start(self):
+        for blob_dir in self.blob_dirs:
+            os.makedirs(blob_dir, exist_ok=True)
+        events.subscribe(self.handle_event)
+        for target, name in ((self._gc_loop, "cas-gc"), (self._scrub_loop, "cas-scrub")):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        events.unsubscribe(self.handle_event)
+        self._stop.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join(timeout=5)
+
+    def _gc_loop(self):
+        next_periodic = time.monotonic() + GC_INTERVAL_SECONDS
+        while not self._stop.is_set():
+            with self._lock:
+                due = min(next_periodic, self._gc_due or next_periodic)
+            self._wake.wait(max(0.0, due - time.monotonic()))
+            self._wake.clear()
+            if self._stop.is_set():
+                break
+            with self._lock:
+                now = time.monotonic()
+                if now < next_periodic and (self._gc_due is None or now < self._gc_due):
+                    continue
+                self._gc_due = None
+            next_periodic = time.monotonic() + GC_INTERVAL_SECONDS
+            if not state.is_leader():
+                continue
+            try:
+                self.collect_garbage()
+            except Exception:
+                logger.exception("Blob garbage collection failed")
+
+    def _scrub_loop(self):
+        while not self._stop.is_set():
+            wait = self._read_scrub_state() + SCRUB_INTERVAL_SECONDS - time.time()
+            if wait > 0 and self._stop.wait(wait):
+                break
+            if not state.is_leader():
+                # Blobs are shared; one process scrubs them
+                self._stop.wait(GC_INTERVAL_SECONDS)
+                continue
+            try:
+                corrupt = self.scrub()
+            except Exception:
+                logger.exception("Blob scrub failed")
+                self._stop.wait(GC_INTERVAL_SECONDS)
+                continue
+            if corrupt is not None:
+                logger.info("Blob scrub finished, %d corrupt", len(corrupt))
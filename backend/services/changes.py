@@ -0,0 +1,219 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from services import events, state
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_RETENTION_SECONDS = int(os.environ.get("CHANGE_JOURNAL_RETENTION", str(7 * 24 * 3600)))
+JOURNAL_MAX_ROWS = int(os.environ.get("CHANGE_JOURNAL_MAX_ROWS", "1000000"))
+FLUSH_INTERVAL_SECONDS = 0.05
+CHANNEL = "change-journal"
+PRUNE_INTERVAL_SECONDS = 600
+MAX_PAGE_SIZE = 5000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    type TEXT NOT NULL,
+    path TEXT NOT NULL,
+    old_path TEXT,
+    is_dir INTEGER NOT NULL,
+    ts REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_changes_ts ON changes(ts);
+CREATE TABLE IF NOT EXISTS changes_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class CursorExpired(Exception):
+    pass
+
+
+class ChangeJournal:
+    """Append-only log of file index events, addressed by a monotonically increasing seq.
+
+    Events are buffered and written in batches by one thread, so a large
+    delete publishing thousands of events does not do thousands of commits.
+    Old entries are pruned by age and count. A cursor older than the
+    oldest retained entry, or older than the last full index rebuild
+    (which emits no events), raises CursorExpired: the client has to
+    resync by listing.
+    """
+
+    def __init__(self, db_path, index):
+        self.db_path = db_path
+        self.index = index
+        self._pending = []
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+        self._waiters = set()
+        self._waiters_lock = threading.Lock()
+        self._local = threading.local()
+
+        conn = self._connect()
+        conn.executescript(SCHEMA)
+        conn.commit()
+        self.latest_seq = self._max_seq()
+        # Other processes append to the same journal; their long-pollers are woken through the store
+        state.store.subscribe(CHANNEL, self._on_remote_write)
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _max_seq(self):
+        row = self._connect().execute("SELECT seq FROM sqlite_sequence WHERE name = 'changes'").fetchone()
+        return row[0] if row else 0
+
+    def _get_meta(self, key):
+        row = self._connect().execute("SELECT value FROM changes_meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, conn, key, value):
+        conn.execute("INSERT OR REPLACE INTO changes_meta(key, value) VALUES (?, ?)", (key, str(value)))
+
+    def start(self):
+        # Every process journals the events it produced, so each is written once
+        events.subscribe(self.handle_event, local_only=True)
+        self._thread = threading.Thread(target=self._run, name="change-journal", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        events.unsubscribe(self.handle_event)
+        self._stop.set()
+        with self._cond:
+            self._cond.notify()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    def handle_event(self, event):
+        with self._cond:
+            self._pending.append((event["type"], event["path"], event.get("old_path"),
+                                  int(bool(event["is_dir"])), time.time()))
+            self._cond.notify()
+
+    def _check_rebuild(self):
+        # A rebuild rewrites the index without events; every earlier cursor is now meaningless
+        built_at = self.index.built_at()
+        if built_at is not None and self._get_meta("index_built_at") != built_at:
+            conn = self._connect()
+            conn.execute("DELETE FROM changes")
+            self._set_meta(conn, "index_built_at", built_at)
+            self._set_meta(conn, "floor", self._max_seq())
+            conn.commit()
+
+    def _run(self):
+        self.index.wait_ready()
+        self._check_rebuild()
+        next_prune = 0.0
+        while not self._stop.is_set():
+            with self._cond:
+                if not self._pending:
+                    self._cond.wait(1.0)
+                batch, self._pending = self._pending, []
+            if batch:
+                try:
+                    self._write(batch)
+                except Exception:
+                    logger.exception("Failed to write %d changes to the journal", len(batch))
+                # Let a burst accumulate into one transaction
+                self._stop.wait(FLUSH_INTERVAL_SECONDS)
+            if time.monotonic() >= next_prune and state.is_leader():
+                next_prune = time.monotonic() + PRUNE_INTERVAL_SECONDS
+                try:
+                    self.prune()
+                except Exception:
+                    logger.exception("Failed to prune the change journal")
+
+    def _write(self, batch):
+        conn = self._connect()
+        conn.executemany("INSERT INTO changes(type, path, old_path, is_dir, ts) VALUES (?, ?, ?, ?, ?)", batch)
+        conn.commit()
+        self.latest_seq = self._max_seq()
+        self._wake_waiters()
+        state.store.publish(CHANNEL, self.latest_seq)
+
+    def _on_remote_write(self, seq):
+        if seq > self.latest_seq:
+            self.latest_seq = seq
+            self._wake_waiters()
+
+    def prune(self, now=None):
+        now = time.time() if now is None else now
+        conn = self._connect()
+        conn.execute("DELETE FROM changes WHERE ts < ?", (now - JOURNAL_RETENTION_SECONDS,))
+        conn.execute("DELETE FROM changes WHERE seq <= ?", (self._max_seq() - JOURNAL_MAX_ROWS,))
+        conn.commit()
+
+    def floor(self):
+        """Cursors below this have lost history."""
+        row = self._connect().execute("SELECT MIN(seq) FROM changes").fetchone()
+        oldest = row[0] if row and row[0] is not None else self.latest_seq + 1
+        return max(oldest - 1, int(self._get_meta("floor") or 0))
+
+    def read(self, since, limit, path_prefix=None):
+        """Changes with seq > since, oldest first: (changes, next_cursor, has_more)."""
+        if since < self.floor():
+            raise CursorExpired()
+        # Everything up to here is committed, so a page with no matches can still advance the cursor to it
+        latest = self.latest_seq
+        query = "SELECT seq, type, path, old_path, is_dir, ts FROM changes WHERE seq > ?"
+        params = [since]
+        if path_prefix:
+            prefix = os.path.normpath(path_prefix)
+            like = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "/%"
+            query += (" AND (path = ? OR path LIKE ? ESCAPE '\\' OR old_path = ?"
+                      " OR old_path LIKE ? ESCAPE '\\')")
+            params += [prefix, like, prefix, like]
+        query += " ORDER BY seq LIMIT ?"
+        params.append(limit + 1)
+        rows = self._connect().execute(query, params).fetchall()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        changes = []
+        for seq, change_type, path, old_path, is_dir, ts in rows:
+            change = {"seq": seq, "type": change_type, "path": path, "is_dir": bool(is_dir), "ts": ts}
+            if old_path:
+                change["old_path"] = old_path
+            changes.append(change)
+        cursor = rows[-1][0] if rows else max(since, latest)
+        return changes, cursor, has_more
+
+    def _wake_waiters(self):
+        with self._waiters_lock:
+            waiters = list(self._waiters)
+        for loop, event in waiters:
+            loop.call_soon_threadsafe(event.set)
+
+    async def wait(self, since, timeout):
+        """Wait up to timeout seconds for a change after since; True if one arrived."""
+        if self.latest_seq > since:
+            return True
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self._waiters_lock:
+            self._waiters.add(waiter)
+        try:
+            # latest_seq may have moved between the check and registering
+            if self.latest_seq > since:
+                return True
+            await asyncio.wait_for(waiter[1].wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            with self._waiters_lock:
+                self._waiters.discard(waiter)
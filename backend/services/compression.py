@@ -0,0 +1,340 @@
+import hashlib
+import logging
+import mimetypes
+import os
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi.responses import FileResponse, StreamingResponse
+
+from services.zipstream import COMPRESSED_EXTENSIONS, content_disposition
+
+# zstd and brotli are optional; gzip is always available
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# Below roughly one packet, compression saves nothing worth the CPU
+MIN_COMPRESS_SIZE = int(os.environ.get("COMPRESS_MIN_SIZE", "1400"))
+# Files above this are stream-compressed but never get a precompressed variant
+PRECOMPRESS_MAX_FILE_BYTES = int(os.environ.get("PRECOMPRESS_MAX_FILE_BYTES", str(64 * 1024 * 1024)))
+# A file served this many times (same mtime) is hot and gets a precompressed variant
+PRECOMPRESS_HOT_HITS = int(os.environ.get("PRECOMPRESS_HOT_HITS", "3"))
+PRECOMPRESS_CACHE_DIR = os.environ.get("PRECOMPRESS_CACHE_DIR",
+                                       os.path.join(tempfile.gettempdir(), "cloud_drive_precompressed"))
+PRECOMPRESS_CACHE_MAX_BYTES = int(os.environ.get("PRECOMPRESS_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+STREAM_CHUNK_SIZE = 256 * 1024
+
+# Fast levels for on-the-fly work, slow ones for variants that are written once and served many times
+STREAM_LEVELS = {"zstd": 3, "br": 4, "gzip": 6}
+PRECOMPRESS_LEVELS = {"zstd": 19, "br": 11, "gzip": 9}
+
+COMPRESSIBLE_TYPES = {
+    "application/json", "application/x-ndjson", "application/javascript", "application/xml",
+    "application/xhtml+xml", "application/x-yaml", "application/yaml", "application/sql",
+    "application/x-sh", "application/rtf", "image/svg+xml", "application/wasm",
+}
+# SSE streams are flushed per event by proxies and clients; leave them alone
+SKIPPED_TYPES = {"text/event-stream"}
+
+
+def available_encodings():
+    """Supported encodings, most preferred first."""
+    encodings = []
+    if zstandard is not None:
+        encodings.append("zstd")
+    if brotli is not None:
+        encodings.append("br")
+    encodings.append("gzip")
+    return encodings
+
+
+def negotiate(accept_encoding):
+    """Pick the best encoding the client accepts (q > 0), or None for identity."""
+    if not accept_encoding:
+        return None
+    accepted = {}
+    for part in accept_encoding.split(","):
+        token, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[token.strip().lower()] = q
+    wildcard = accepted.get("*", 0.0)
+    best, best_q = None, 0.0
+    for encoding in available_encodings():
+        q = accepted.get(encoding, wildcard)
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def is_compressible_type(content_type):
+    media_type = (content_type or "").split(";")[0].strip().lower()
+    if not media_type or media_type in SKIPPED_TYPES:
+        return False
+    return media_type.startswith("text/") or media_type in COMPRESSIBLE_TYPES or media_type.endswith("+json") \
+        or media_type.endswith("+xml")
+
+
+def is_compressible_file(filename):
+    ext = os.path.splitext(filename)[1].lower()
+    if ext in COMPRESSED_EXTENSIONS:
+        return False
+    return is_compressible_type(mimetypes.guess_type(filename)[0])
+
+
+class Encoder:
+    """Incremental compressor with the same interface for every encoding."""
+
+    def __init__(self, encoding, level=None):
+        self.encoding = encoding
+        level = STREAM_LEVELS[encoding] if level is None else level
+        if encoding == "zstd":
+            self._obj = zstandard.ZstdCompressor(level=level).compressobj()
+        elif encoding == "br":
+            self._obj = brotli.Compressor(quality=level)
+        else:
+            # wbits=31: gzip container
+            self._obj = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        if self.encoding == "br":
+            return self._obj.process(data)
+        return self._obj.compress(data)
+
+    def flush(self):
+        """Emit everything buffered so far without ending the stream."""
+        if self.encoding == "zstd":
+            return self._obj.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        if self.encoding == "br":
+            return self._obj.flush()
+        return self._obj.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        if self.encoding == "br":
+            return self._obj.finish()
+        return self._obj.flush()
+
+
+class CompressionMiddleware:
+    """Negotiated zstd/br/gzip for compressible responses above MIN_COMPRESS_SIZE.
+
+    Responses that already carry a Content-Encoding, partial content, and
+    media that is already compressed pass through untouched. Streamed
+    bodies are compressed chunk by chunk and flushed after each chunk, so
+    NDJSON and other incremental responses still arrive incrementally.
+    """
+
+    def __init__(self, app, minimum_size=MIN_COMPRESS_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_headers = dict(scope["headers"])
+        encoding = negotiate(request_headers.get(b"accept-encoding", b"").decode("latin-1"))
+        if encoding is None or b"range" in request_headers:
+            await self.app(scope, receive, send)
+            return
+
+        start = None
+        encoder = None
+        passthrough = False
+
+        async def compressing_send(message):
+            nonlocal start, encoder, passthrough
+            if message["type"] == "http.response.start":
+                headers = {k.lower(): v for k, v in message.get("headers", [])}
+                content_type = headers.get(b"content-type", b"").decode("latin-1")
+                passthrough = (
+                    b"content-encoding" in headers or b"content-range" in headers
+                    or message["status"] in (204, 206, 304) or not is_compressible_type(content_type)
+                )
+                if passthrough:
+                    await send(message)
+                else:
+                    start = message
+                return
+
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if encoder is None:
+                # A streamed body is compressed from its first chunk; a single small body is sent as is
+                if not more_body and len(body) < self.minimum_size:
+                    await send(start)
+                    await send(message)
+                    return
+                encoder = Encoder(encoding)
+                headers = [(k, v) for k, v in start.get("headers", [])
+                           if k.lower() not in (b"content-length", b"etag")]
+                vary = next((v for k, v in start.get("headers", []) if k.lower() == b"vary"), None)
+                headers = [(k, v) for k, v in headers if k.lower() != b"vary"]
+                headers.append((b"vary", vary + b", Accept-Encoding" if vary else b"Accept-Encoding"))
+                headers.append((b"content-encoding", encoding.encode()))
+                await send({**start, "headers": headers})
+
+            data = encoder.compress(body) + (encoder.flush() if more_body else encoder.finish())
+            await send({"type": "http.response.body", "body": data, "more_body": more_body})
+
+        await self.app(scope, receive, compressing_send)
+
+
+def encoded_etag(etag, encoding):
+    """Each encoding is a different representation, so it needs its own validator."""
+    return f'{etag[:-1]}-{encoding}"'
+
+
+class PrecompressedCache:
+    """On-disk compressed variants of frequently downloaded text files.
+
+    Variants are keyed by (path, mtime_ns, size, encoding), written at the
+    maximum level by a single background worker once a file version has
+    been requested PRECOMPRESS_HOT_HITS times, and evicted least recently
+    used first once the cache exceeds its byte budget.
+    """
+
+    def __init__(self, cache_dir=PRECOMPRESS_CACHE_DIR, max_bytes=PRECOMPRESS_CACHE_MAX_BYTES,
+                 hot_hits=PRECOMPRESS_HOT_HITS):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hot_hits = hot_hits
+        self._hits = OrderedDict()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="precompress")
+
+    def _variant_path(self, path, stat_result, encoding):
+        key = f"{os.path.abspath(path)}\0{stat_result.st_mtime_ns}\0{stat_result.st_size}"
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], f"{digest}.{encoding}")
+
+    def lookup(self, path, stat_result, encoding):
+        """Path of a ready variant, or None; counts the hit and schedules a build when hot."""
+        variant = self._variant_path(path, stat_result, encoding)
+        try:
+            cached = os.stat(variant)
+            os.utime(variant, ns=(time.time_ns(), cached.st_mtime_ns))
+            return variant
+        except FileNotFoundError:
+            pass
+
+        if stat_result.st_size > PRECOMPRESS_MAX_FILE_BYTES:
+            return None
+        with self._lock:
+            hits = self._hits.pop(variant, 0) + 1
+            self._hits[variant] = hits
+            while len(self._hits) > 10000:
+                self._hits.popitem(last=False)
+            if hits < self.hot_hits or variant in self._pending:
+                return None
+            self._pending.add(variant)
+        self._executor.submit(self._build, path, variant, encoding)
+        return None
+
+    def _build(self, path, variant, encoding):
+        try:
+            os.makedirs(os.path.dirname(variant), exist_ok=True)
+            tmp = f"{variant}.tmp"
+            encoder = Encoder(encoding, PRECOMPRESS_LEVELS[encoding])
+            with open(path, "rb") as src, open(tmp, "wb") as out:
+                while True:
+                    chunk = src.read(STREAM_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    out.write(encoder.compress(chunk))
+                out.write(encoder.finish())
+            os.replace(tmp, variant)
+            self._evict()
+        except Exception:
+            logger.exception("Failed to precompress %s", path)
+        finally:
+            with self._lock:
+                self._pending.discard(variant)
+                self._hits.pop(variant, None)
+
+    def _evict(self):
+        files = []
+        total = 0
+        for dirpath, _, names in os.walk(self.cache_dir):
+            for name in names:
+                full = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(full)
+                except FileNotFoundError:
+                    continue
+                files.append((st.st_atime, st.st_size, full))
+                total += st.st_size
+        if total <= self.max_bytes:
+            return
+        for _, size, full in sorted(files):
+            if total <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(full)
+                total -= size
+            except FileNotFoundError:
+                pass
+
+
+precompressed_cache = PrecompressedCache()
+
+
+def _stream_file(path, encoding):
+    encoder = Encoder(encoding)
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            data = encoder.compress(chunk)
+            if data:
+                yield data
+    yield encoder.finish()
+
+
+def choose_file_encoding(request, filename, stat_result):
+    """Encoding for a whole-file download, or None to serve it as is."""
+    if "range" in request.headers or stat_result.st_size < MIN_COMPRESS_SIZE:
+        return None
+    if not is_compressible_file(filename):
+        return None
+    return negotiate(request.headers.get("accept-encoding"))
+
+
+def compressed_file_response(path, filename, media_type, headers, stat_result, encoding):
+    """Serve a precompressed variant if one is ready, otherwise compress while streaming."""
+    headers = {**headers, "content-encoding": encoding, "vary": "Accept-Encoding"}
+    variant = precompressed_cache.lookup(path, stat_result, encoding)
+    if variant is not None:
+        response = FileResponse(variant, filename=filename, media_type=media_type, stat_result=os.stat(variant))
+        # FileResponse derives validators from the variant file; use the original's instead
+        response.headers.update(headers)
+        # Byte ranges would address the encoded bytes; keep them to identity requests
+        del response.headers["accept-ranges"]
+        return response
+
+    headers["content-disposition"] = content_disposition(filename)
+    return StreamingResponse(_stream_file(path, encoding), media_type=media_type, headers=headers)
@@ -0,0 +1,137 @@
+import os
+import time
+from email.utils import formatdate, parsedate_to_datetime
+
+from fastapi import HTTPException, Request
+from fastapi.responses import FileResponse, Response
+
+from services import compression
+
+# A file touched within this window may still be changing, so its ETag is only weak
+WEAK_ETAG_WINDOW_SECONDS = 1.0
+
+
+class ConditionalFileResponse(FileResponse):
+    """FileResponse whose If-Range check uses strong comparison (RFC 9110 13.1.5)."""
+
+    def _should_use_range(self, http_if_range: str) -> bool:
+        if http_if_range.startswith("W/") or self.headers["etag"].startswith("W/"):
+            return False
+        return http_if_range == self.headers["etag"] or http_if_range == self.headers["last-modified"]
+
+    async def _handle_multiple_ranges(self, send, ranges, file_size, send_header_only):
+        # Starlette puts the multipart/byteranges type in Content-Range; move it to Content-Type
+        async def send_with_fixed_headers(message):
+            if message["type"] == "http.response.start":
+                self.headers["content-type"] = self.headers["content-range"]
+                del self.headers["content-range"]
+                message = {**message, "headers": self.raw_headers}
+            await send(message)
+
+        await super()._handle_multiple_ranges(send_with_fixed_headers, ranges, file_size, send_header_only)
+
+
+def strong_etag(stat_result):
+    """ETag derived from inode, mtime and size, never weak.
+
+    For handshakes that re-check the exact stat before acting on it, such as
+    signature and delta, where the weak window would only cause spurious 412s.
+    """
+    return f'"{stat_result.st_ino:x}-{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"'
+
+
+def make_etag(stat_result, now=None):
+    """ETag derived from inode, mtime and size; weak while the file may still be written."""
+    tag = strong_etag(stat_result)
+    now = time.time() if now is None else now
+    if now - stat_result.st_mtime < WEAK_ETAG_WINDOW_SECONDS:
+        return f"W/{tag}"
+    return tag
+
+
+def _opaque(tag):
+    return tag[2:] if tag.startswith("W/") else tag
+
+
+def _etag_list(header):
+    return [tag.strip() for tag in header.split(",") if tag.strip()]
+
+
+def _parse_http_date(value):
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def is_not_modified(request: Request, etag, mtime):
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        # Weak comparison: W/"x" matches "x"
+        tags = _etag_list(if_none_match)
+        return "*" in tags or _opaque(etag) in {_opaque(tag) for tag in tags}
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        since = _parse_http_date(if_modified_since)
+        return since is not None and int(mtime) <= since
+    return False
+
+
+def precondition_failed(request: Request, etag, mtime):
+    if_match = request.headers.get("if-match")
+    if if_match is not None:
+        # Strong comparison: a weak validator never satisfies If-Match
+        tags = _etag_list(if_match)
+        if "*" in tags:
+            return False
+        return etag.startswith("W/") or etag not in tags
+
+    if_unmodified_since = request.headers.get("if-unmodified-since")
+    if if_unmodified_since is not None:
+        since = _parse_http_date(if_unmodified_since)
+        return since is not None and int(mtime) > since
+    return False
+
+
+def validator_headers(stat_result):
+    return {
+        "etag": make_etag(stat_result),
+        "last-modified": formatdate(stat_result.st_mtime, usegmt=True),
+    }
+
+
+def file_response(request: Request, path, filename, media_type="application/octet-stream", stat_result=None):
+    """Serve a file with ETag/Last-Modified validators, 304/412 handling and byte ranges.
+
+    Single and multi-range requests (206/416) are served by Starlette's
+    FileResponse; this adds the conditional request logic on top of it.
+    """
+    if stat_result is None:
+        try:
+            stat_result = os.stat(path)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail="File not found")
+
+    headers = validator_headers(stat_result)
+    encoding = compression.choose_file_encoding(request, filename, stat_result)
+    if encoding:
+        headers["etag"] = compression.encoded_etag(headers["etag"], encoding)
+    if compression.is_compressible_file(filename):
+        headers["vary"] = "Accept-Encoding"
+
+    if precondition_failed(request, headers["etag"], stat_result.st_mtime):
+        return Response(status_code=412, headers=headers)
+    if is_not_modified(request, headers["etag"], stat_result.st_mtime):
+        return Response(status_code=304, headers=headers)
+
+    if encoding:
+        return compression.compressed_file_response(path, filename, media_type, headers, stat_result, encoding)
+
+    return ConditionalFileResponse(
+        path,
+        filename=filename,
+        media_type=media_type,
+        headers=headers,
+        stat_result=stat_result
+    )
@@ -0,0 +1,261 @@
+"""rsync-style delta updates of existing files.
+
+Signature (GET, application/octet-stream), all integers big-endian:
+
+    header   "CDSG" | u32 block_size | u64 file_size
+    per block  u32 adler32 | 16 bytes blake2b-128
+
+The last block may be shorter than block_size. adler32 is the weak,
+rolling checksum a client slides over its new version one byte at a time;
+blake2b confirms a weak match.
+
+Delta (POST body): a sequence of operations that rebuild the new file.
+
+    "C" | u64 offset | u64 length   copy a range of the current (base) file
+    "D" | u32 length | bytes         literal data
+    "E" | 32 bytes sha256            end; sha256 of the whole new file
+
+The new version is written to a temporary file next to the target and
+only renamed over it once it is complete, its SHA-256 matches, and the
+base file is still the version the delta was computed against.
+"""
+import hashlib
+import os
+import stat
+import struct
+import uuid
+import zlib
+
+from fastapi import HTTPException
+
+from services import cas
+
+DEFAULT_MIN_BLOCK_SIZE = 2 * 1024
+MIN_BLOCK_SIZE = 512
+MAX_BLOCK_SIZE = 8 * 1024 * 1024
+# Bounds what one literal op can make the server buffer
+MAX_LITERAL_BYTES = int(os.environ.get("DELTA_MAX_LITERAL_BYTES", str(16 * 1024 * 1024)))
+COPY_CHUNK = 64 * 1024 * 1024
+
+SIGNATURE_MAGIC = b"CDSG"
+_HEADER = struct.Struct(">4sIQ")
+_BLOCK = struct.Struct(">I16s")
+_COPY = struct.Struct(">QQ")
+_DATA = struct.Struct(">I")
+ADLER_MOD = 65521
+
+
+def default_block_size(size):
+    """About sqrt(size), as rsync does: 4 GiB gets 64 KiB blocks and a ~1.3 MB signature."""
+    block = int(size ** 0.5) // 1024 * 1024
+    return max(DEFAULT_MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, block))
+
+
+def strong_hash(block):
+    return hashlib.blake2b(block, digest_size=16).digest()
+
+
+def iter_signature(path, block_size):
+    """Yield the signature of the file at path in pieces, reading it once."""
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        yield _HEADER.pack(SIGNATURE_MAGIC, block_size, size)
+        pending = []
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            pending.append(_BLOCK.pack(zlib.adler32(block), strong_hash(block)))
+            if len(pending) >= 4096:
+                yield b"".join(pending)
+                pending = []
+        if pending:
+            yield b"".join(pending)
+
+
+def parse_signature(data):
+    """(block_size, file_size, [(adler32, strong), ...]) from a signature."""
+    magic, block_size, size = _HEADER.unpack_from(data)
+    if magic != SIGNATURE_MAGIC:
+        raise ValueError("Not a signature")
+    blocks = [_BLOCK.unpack_from(data, offset) for offset in range(_HEADER.size, len(data), _BLOCK.size)]
+    return block_size, size, blocks
+
+
+def roll_adler32(checksum, out_byte, in_byte, window):
+    """adler32 of the window shifted by one byte: out_byte leaves, in_byte enters."""
+    a = checksum & 0xFFFF
+    b = checksum >> 16
+    a = (a - out_byte + in_byte) % ADLER_MOD
+    b = (b - window * out_byte - 1 + a) % ADLER_MOD
+    return (b << 16) | a
+
+
+def encode_delta(signature, data):
+    """Reference encoder: the delta turning the signed base into data (bytes).
+
+    Pure Python and byte-at-a-time on mismatches, so meant for tests and
+    small files; real clients use a native implementation of the same format.
+    """
+    block_size, base_size, blocks = parse_signature(signature)
+    lookup = {}
+    for index, (weak, strong) in enumerate(blocks):
+        lookup.setdefault(weak, {}).setdefault(strong, index)
+
+    ops = []
+    literal = bytearray()
+    copy_start = copy_len = 0
+
+    def flush_copy():
+        nonlocal copy_len
+        if copy_len:
+            ops.append(b"C" + _COPY.pack(copy_start, copy_len))
+            copy_len = 0
+
+    def flush_literal():
+        for start in range(0, len(literal), MAX_LITERAL_BYTES):
+            piece = literal[start:start + MAX_LITERAL_BYTES]
+            ops.append(b"D" + _DATA.pack(len(piece)) + bytes(piece))
+        literal.clear()
+
+    pos = 0
+    weak = zlib.adler32(data[:block_size]) if len(data) >= block_size else None
+    while pos < len(data):
+        window = data[pos:pos + block_size]
+        if len(window) < block_size:
+            # Only the base's (short) last block can match a tail this size
+            weak = zlib.adler32(window)
+        index = lookup.get(weak, {}).get(strong_hash(window)) if weak in lookup else None
+        if index is not None and (len(window) == block_size or index == len(blocks) - 1):
+            flush_literal()
+            offset = index * block_size
+            if copy_len and copy_start + copy_len == offset:
+                copy_len += len(window)
+            else:
+                flush_copy()
+                copy_start, copy_len = offset, len(window)
+            pos += len(window)
+            if pos + block_size <= len(data):
+                weak = zlib.adler32(data[pos:pos + block_size])
+            continue
+        flush_copy()
+        literal.append(data[pos])
+        if pos + block_size < len(data):
+            weak = roll_adler32(weak, data[pos], data[pos + block_size], block_size)
+        pos += 1
+    flush_copy()
+    flush_literal()
+    ops.append(b"E" + hashlib.sha256(data).digest())
+    return b"".join(ops)
+
+
+class DeltaApplier:
+    """Rebuilds a new version of base_path into a temporary file from a streamed delta.
+
+    Feed request body chunks to feed(); ranges of the base are copied with
+    copy_file_range, which stays in the kernel and shares extents on
+    filesystems that support reflinks.
+    """
+
+    def __init__(self, base_path):
+        self.base_path = base_path
+        self.tmp_path = os.path.join(os.path.dirname(base_path),
+                                     f".{os.path.basename(base_path)}.{uuid.uuid4().hex}.delta")
+        self.base = open(base_path, "rb")
+        self.base_size = os.fstat(self.base.fileno()).st_size
+        self.out = open(self.tmp_path, "wb")
+        self.buffer = bytearray()
+        self.expected_sha256 = None
+        self.copied_bytes = 0
+        self.literal_bytes = 0
+
+    def feed(self, data):
+        if self.expected_sha256 is not None:
+            if data:
+                raise HTTPException(status_code=400, detail="Data after end of delta")
+            return
+        self.buffer.extend(data)
+        while self.buffer and self.expected_sha256 is None:
+            op = self.buffer[:1]
+            if op == b"C":
+                if len(self.buffer) < 1 + _COPY.size:
+                    return
+                offset, length = _COPY.unpack_from(self.buffer, 1)
+                del self.buffer[:1 + _COPY.size]
+                self._copy(offset, length)
+            elif op == b"D":
+                if len(self.buffer) < 1 + _DATA.size:
+                    return
+                (length,) = _DATA.unpack_from(self.buffer, 1)
+                if length > MAX_LITERAL_BYTES:
+                    raise HTTPException(status_code=400, detail=f"Literal op exceeds {MAX_LITERAL_BYTES} bytes")
+                end = 1 + _DATA.size + length
+                if len(self.buffer) < end:
+                    return
+                self.out.write(self.buffer[1 + _DATA.size:end])
+                self.literal_bytes += length
+                del self.buffer[:end]
+            elif op == b"E":
+                if len(self.buffer) < 33:
+                    return
+                self.expected_sha256 = bytes(self.buffer[1:33]).hex()
+                if len(self.buffer) > 33:
+                    raise HTTPException(status_code=400, detail="Data after end of delta")
+                del self.buffer[:33]
+            else:
+                raise HTTPException(status_code=400, detail="Invalid delta operation")
+
+    def _copy(self, offset, length):
+        if offset + length > self.base_size:
+            raise HTTPException(status_code=400, detail="Copy op outside the base file")
+        self.out.flush()
+        src, dst = self.base.fileno(), self.out.fileno()
+        remaining = length
+        try:
+            while remaining:
+                n = os.copy_file_range(src, dst, min(remaining, COPY_CHUNK), offset)
+                if n == 0:
+                    break
+                offset += n
+                remaining -= n
+        except (AttributeError, OSError):
+            pass
+        while remaining:
+            chunk = os.pread(src, min(remaining, 1024 * 1024), offset)
+            if not chunk:
+                break
+            self.out.write(chunk)
+            offset += len(chunk)
+            remaining -= len(chunk)
+        # copy_file_range moved the kernel file offset; keep the Python object in step
+        self.out.seek(0, os.SEEK_END)
+        self.copied_bytes += length
+
+    def finish(self):
+        """Verify the rebuilt file; returns its sha256."""
+        if self.expected_sha256 is None or self.buffer:
+            raise HTTPException(status_code=400, detail="Delta ended without an end marker")
+        self.out.flush()
+        os.fsync(self.out.fileno())
+        self.out.close()
+        digest = cas.hash_file(self.tmp_path)
+        if digest != self.expected_sha256:
+            raise HTTPException(status_code=422, detail="Checksum mismatch for rebuilt file")
+        os.chmod(self.tmp_path, stat.S_IMODE(os.fstat(self.base.fileno()).st_mode))
+        return digest
+
+    def commit(self, digest, blob_store=None):
+        if blob_store is not None:
+            blob_store.adopt(self.tmp_path, digest, self.base_path)
+        else:
+            os.replace(self.tmp_path, self.base_path)
+        self.base.close()
+
+    def abort(self):
+        self.base.close()
+        if not self.out.closed:
+            self.out.close()
+        try:
+            os.remove(self.tmp_path)
+        except FileNotFoundError:
+            pass
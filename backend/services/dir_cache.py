@@ -0,0 +1,164 @@
+import base64
+import json
+import mimetypes
+import os
+import threading
+from collections import OrderedDict
+
+from services import metrics
+
+MAX_CACHED_DIRECTORIES = 256
+# Bound on the total number of entries held across all snapshots
+MAX_CACHED_ENTRIES = 500_000
+
+SORT_KEYS = {
+    "name": lambda item: (item["name"].lower(), item["name"]),
+    "size": lambda item: (item["size"] or 0, item["name"].lower()),
+    "mtime": lambda item: (item["mtime"], item["name"].lower()),
+    "type": lambda item: (item["mime_type"] or "", item["name"].lower()),
+}
+
+
+def encode_cursor(last_name, offset, mtime_ns):
+    raw = json.dumps({"n": last_name, "o": offset, "m": mtime_ns}).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        data = json.loads(raw)
+        return data["n"], int(data["o"]), int(data["m"])
+    except (ValueError, KeyError, TypeError):
+        raise ValueError("Invalid cursor")
+
+
+class _Snapshot:
+    def __init__(self, mtime_ns, entries):
+        self.mtime_ns = mtime_ns
+        self.entries = entries
+        self.views = {}
+
+    def view(self, sort, descending):
+        """Sorted copy of the entries (directories first) plus a name -> position map."""
+        key = (sort, descending)
+        if key not in self.views:
+            sort_key = SORT_KEYS[sort]
+            dirs = sorted((e for e in self.entries if e["type"] == "directory"), key=sort_key, reverse=descending)
+            files = sorted((e for e in self.entries if e["type"] != "directory"), key=sort_key, reverse=descending)
+            ordered = dirs + files
+            self.views[key] = (ordered, {item["name"]: i for i, item in enumerate(ordered)})
+        return self.views[key]
+
+
+class DirectoryCache:
+    """Bounded LRU of directory listings, revalidated against the directory mtime.
+
+    Paging through a large folder reuses one scandir and one sort per
+    (directory, sort order) instead of redoing both on every page. A
+    directory on several storage volumes is one merged listing, current
+    while none of its copies has changed.
+    """
+
+    def __init__(self, pool, max_directories=MAX_CACHED_DIRECTORIES, max_entries=MAX_CACHED_ENTRIES):
+        self.pool = pool
+        self.root = pool.root
+        self.max_directories = max_directories
+        self.max_entries = max_entries
+        self._snapshots = OrderedDict()
+        self._entry_count = 0
+        self._lock = threading.Lock()
+
+    def _scan(self, rel_dir, skip):
+        entries = []
+        for entry in self.pool.scandir(rel_dir):
+            if entry.name in skip:
+                continue
+            try:
+                is_dir = entry.is_dir()
+                stat_result = entry.stat()
+            except OSError:
+                continue
+            if is_dir:
+                entries.append({"name": entry.name, "type": "directory", "size": None,
+                                "mtime": stat_result.st_mtime, "mime_type": None})
+            elif entry.is_file():
+                entries.append({"name": entry.name, "type": "file", "size": stat_result.st_size,
+                                "mtime": stat_result.st_mtime,
+                                "mime_type": mimetypes.guess_type(entry.name)[0]})
+        return entries
+
+    def _version(self, rel_dir):
+        """The directory's mtime_ns; with copies on several volumes, a value that moves with any of them."""
+        mtimes = []
+        for path in self.pool.full_paths(rel_dir):
+            try:
+                mtimes.append(os.stat(path).st_mtime_ns)
+            except FileNotFoundError:
+                continue
+        if not mtimes:
+            raise FileNotFoundError(f"No such directory: {rel_dir}")
+        return mtimes[0] if len(mtimes) == 1 else hash(tuple(mtimes)) & (2 ** 63 - 1)
+
+    def _snapshot(self, full_dir, skip):
+        full_dir = os.path.normpath(full_dir)
+        rel_dir = self.pool.relpath(full_dir)
+        mtime_ns = self._version(rel_dir)
+        with self._lock:
+            snapshot = self._snapshots.get(full_dir)
+            if snapshot is not None and snapshot.mtime_ns == mtime_ns:
+                self._snapshots.move_to_end(full_dir)
+                return snapshot
+
+        with metrics.scandir_duration.time():
+            snapshot = _Snapshot(mtime_ns, self._scan(rel_dir, skip))
+        with self._lock:
+            previous = self._snapshots.pop(full_dir, None)
+            if previous is not None:
+                self._entry_count -= len(previous.entries)
+            self._snapshots[full_dir] = snapshot
+            self._entry_count += len(snapshot.entries)
+            while len(self._snapshots) > 1 and (
+                len(self._snapshots) > self.max_directories or self._entry_count > self.max_entries
+            ):
+                _, evicted = self._snapshots.popitem(last=False)
+                self._entry_count -= len(evicted.entries)
+        return snapshot
+
+    def page(self, full_dir, sort="name", descending=False, limit=None, cursor=None, skip=()):
+        """Return one page of a directory listing and the cursor for the next one.
+
+        The cursor remembers the last name returned, so if the directory
+        changes between pages the listing resumes after that entry rather
+        than at a stale offset.
+        """
+        snapshot = self._snapshot(full_dir, set(skip))
+        ordered, positions = snapshot.view(sort, descending)
+
+        start = 0
+        if cursor:
+            last_name, offset, mtime_ns = decode_cursor(cursor)
+            if mtime_ns == snapshot.mtime_ns or last_name not in positions:
+                start = offset
+            else:
+                start = positions[last_name] + 1
+
+        end = len(ordered) if limit is None else min(len(ordered), start + limit)
+        items = ordered[start:end]
+        next_cursor = None
+        if end < len(ordered) and items:
+            next_cursor = encode_cursor(items[-1]["name"], end, snapshot.mtime_ns)
+        return {"items": items, "total": len(ordered), "next_cursor": next_cursor}
+
+    def invalidate(self, full_dir):
+        with self._lock:
+            snapshot = self._snapshots.pop(os.path.normpath(full_dir), None)
+            if snapshot is not None:
+                self._entry_count -= len(snapshot.entries)
+
+    def handle_event(self, event):
+        # In-place writes leave the directory mtime alone, so drop the parent explicitly
+        for rel_path in (event.get("path"), event.get("old_path")):
+            if rel_path:
+                parent = os.path.dirname(rel_path)
+                self.invalidate(os.path.join(self.root, parent) if parent else self.root)
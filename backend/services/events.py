@@ -0,0 +1,74 @@
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Filesystem change events published by the file index:
+#   {"type": "created" | "modified" | "deleted" | "moved",
+#    "path": "rel/path", "old_path": "rel/old" (moves only), "is_dir": bool}
+#
+# With several server processes, events are also forwarded to the others
+# through the shared state store, so their caches stay coherent.
+
+CHANNEL = "file-events"
+
+_subscribers = []
+_lock = threading.Lock()
+_store = None
+
+
+def subscribe(callback, local_only=False):
+    """Register callback(event); it runs on the publishing thread and must be quick.
+
+    local_only subscribers do not see events forwarded from other processes;
+    use it for consumers that write each event to shared storage exactly once.
+    """
+    with _lock:
+        _subscribers.append((callback, local_only))
+    return callback
+
+
+def unsubscribe(callback):
+    with _lock:
+        _subscribers[:] = [(cb, local_only) for cb, local_only in _subscribers if cb != callback]
+
+
+def attach(store):
+    """Forward events to other processes through store, and deliver theirs here."""
+    global _store
+    _store = store
+    store.subscribe(CHANNEL, _deliver_remote)
+
+
+def _deliver(events, remote):
+    with _lock:
+        subscribers = [cb for cb, local_only in _subscribers if not (remote and local_only)]
+    for event in events:
+        for callback in subscribers:
+            try:
+                callback(event)
+            except Exception:
+                logger.exception("Error in event subscriber %r", callback)
+
+
+def _deliver_remote(events):
+    _deliver(events, remote=True)
+
+
+def _forward(events):
+    if _store is not None and events:
+        try:
+            _store.publish(CHANNEL, events)
+        except Exception:
+            logger.exception("Failed to forward %d events to other processes", len(events))
+
+
+def publish(event):
+    _deliver([event], remote=False)
+    _forward([event])
+
+
+def publish_all(events):
+    events = list(events)
+    _deliver(events, remote=False)
+    _forward(events)
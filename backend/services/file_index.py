@@ -0,0 +1,538 @@
+import logging
+import os
+import sqlite3
+import stat
+import threading
+import time
+
+from services import events, metrics
+
+logger = logging.getLogger(__name__)
+
+INDEX_DB_PATH = os.environ.get("FILE_INDEX_PATH", "./file_index.db")
+BUILD_BATCH_SIZE = 5000
+MAX_PAGE_SIZE = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    parent TEXT NOT NULL,
+    name TEXT NOT NULL COLLATE NOCASE,
+    ext TEXT NOT NULL,
+    type TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_entries_parent ON entries(parent);
+CREATE INDEX IF NOT EXISTS ix_entries_name ON entries(name COLLATE NOCASE);
+CREATE VIRTUAL TABLE IF NOT EXISTS entries_fts USING fts5(
+    name, content='entries', content_rowid='id', tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS entries_ai AFTER INSERT ON entries BEGIN
+    INSERT INTO entries_fts(rowid, name) VALUES (new.id, new.name);
+END;
+CREATE TRIGGER IF NOT EXISTS entries_ad AFTER DELETE ON entries BEGIN
+    INSERT INTO entries_fts(entries_fts, rowid, name) VALUES ('delete', old.id, old.name);
+END;
+CREATE TRIGGER IF NOT EXISTS entries_au AFTER UPDATE OF name ON entries BEGIN
+    INSERT INTO entries_fts(entries_fts, rowid, name) VALUES ('delete', old.id, old.name);
+    INSERT INTO entries_fts(rowid, name) VALUES (new.id, new.name);
+END;
+CREATE TABLE IF NOT EXISTS dir_stats (
+    path TEXT PRIMARY KEY,
+    total_size INTEGER NOT NULL DEFAULT 0,
+    file_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS ix_dir_stats_size ON dir_stats(total_size);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def is_hidden(name):
+    return name.startswith(".")
+
+
+def _like_escape(value):
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def ancestors(rel_path):
+    """Directories containing rel_path, innermost first, ending with the root ("")."""
+    parent = os.path.dirname(rel_path)
+    while parent:
+        yield parent
+        parent = os.path.dirname(parent)
+    yield ""
+
+
+def _row_for(rel_path, stat_result, is_dir):
+    parent, name = os.path.split(rel_path)
+    ext = "" if is_dir else os.path.splitext(name)[1].lower().lstrip(".")
+    size = 0 if is_dir else stat_result.st_size
+    return (rel_path, parent, name, ext, "directory" if is_dir else "file", size, stat_result.st_mtime)
+
+
+class FileIndex:
+    """Persistent SQLite index of every visible path in a storage pool.
+
+    Names are indexed with an FTS5 trigram tokenizer, so substring searches
+    are answered from the index instead of walking the disk. Paths are
+    relative to the pool, whichever volume holds them.
+    """
+
+    def __init__(self, db_path, pool):
+        self.db_path = db_path
+        self.pool = pool
+        self.root = pool.root
+        # A different set of volumes is a different tree
+        self.root_key = os.pathsep.join(volume.path for volume in pool.volumes)
+        self.ready = False
+        self.ready_event = threading.Event()
+        self._write_lock = threading.Lock()
+        self._local = threading.local()
+        self._build_thread = None
+
+        with self._write_lock:
+            conn = self._connect()
+            conn.executescript(SCHEMA)
+            conn.commit()
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _get_meta(self, key):
+        row = self._connect().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, conn, key, value):
+        conn.execute("INSERT OR REPLACE INTO meta(key, value) VALUES (?, ?)", (key, str(value)))
+
+    def start(self):
+        """Build the index in the background unless a complete build for these volumes exists."""
+        if self._build_thread is not None and self._build_thread.is_alive():
+            # Re-elected while our own build is still running
+            return
+        if self._get_meta("root") == self.root_key and self._get_meta("built_at"):
+            if self._get_meta("dir_stats_version") is None:
+                # Index built before directory sizes were tracked
+                self.recompute_dir_stats()
+            self._mark_ready()
+            return
+        self._build_thread = threading.Thread(target=self.rebuild, name="file-index-build", daemon=True)
+        self._build_thread.start()
+
+    def follow(self, poll_interval=1.0):
+        """Become ready once another process has built the index (workers that are not the leader)."""
+        def wait_for_build():
+            while not self.ready and not self._get_meta("built_at"):
+                time.sleep(poll_interval)
+            self._mark_ready()
+
+        if not self.ready:
+            threading.Thread(target=wait_for_build, name="file-index-follow", daemon=True).start()
+
+    def _mark_ready(self):
+        self.ready = True
+        self.ready_event.set()
+
+    def wait_ready(self, timeout=None):
+        return self.ready_event.wait(timeout)
+
+    def built_at(self):
+        """Timestamp of the last full build; changes whenever the index is rebuilt from scratch."""
+        return self._get_meta("built_at")
+
+    def rebuild(self):
+        started = time.time()
+        with self._write_lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM entries")
+            conn.execute("DELETE FROM dir_stats")
+            conn.execute("DELETE FROM meta")
+            conn.commit()
+
+        batch = []
+        with metrics.walk_duration.time(operation="index_rebuild"):
+            for row in self._walk(""):
+                batch.append(row)
+                if len(batch) >= BUILD_BATCH_SIZE:
+                    self._write_rows(batch, [], track_sizes=False)
+                    batch = []
+            self._write_rows(batch, [], track_sizes=False)
+        self.recompute_dir_stats()
+
+        with self._write_lock:
+            conn = self._connect()
+            self._set_meta(conn, "root", self.root_key)
+            self._set_meta(conn, "built_at", started)
+            conn.commit()
+        self._mark_ready()
+        logger.info("File index built in %.1fs", time.time() - started)
+
+    def _walk(self, rel_top):
+        for rel_dir, dirs, files in self.pool.walk(rel_top):
+            dirs[:] = [d for d in dirs if not is_hidden(d)]
+            for name in dirs:
+                rel_path = os.path.join(rel_dir, name) if rel_dir else name
+                try:
+                    stat_result = self.pool.stat(rel_path)
+                except OSError:
+                    continue
+                yield _row_for(rel_path, stat_result, True)
+            for name, full_path in files:
+                if is_hidden(name):
+                    continue
+                try:
+                    stat_result = os.stat(full_path)
+                except OSError:
+                    continue
+                yield _row_for(os.path.join(rel_dir, name) if rel_dir else name, stat_result, False)
+
+    def _write_rows(self, rows, deleted_paths, track_sizes=True):
+        """Apply row upserts and deletions, keeping recursive directory totals in step.
+
+        Every file change adds its size and count delta to each ancestor in
+        dir_stats, so folder sizes never need a walk of their own.
+        """
+        if not rows and not deleted_paths:
+            return
+        with self._write_lock:
+            conn = self._connect()
+            deltas = {}
+            if track_sizes:
+                paths = [row[0] for row in rows] + list(deleted_paths)
+                previous = {}
+                for i in range(0, len(paths), 500):
+                    chunk = paths[i:i + 500]
+                    previous.update(
+                        (path, (entry_type, size)) for path, entry_type, size in conn.execute(
+                            f"SELECT path, type, size FROM entries WHERE path IN ({','.join('?' * len(chunk))})", chunk
+                        )
+                    )
+                changes = [(row[0], row[4], row[5]) for row in rows] + [(path, None, 0) for path in deleted_paths]
+                for path, entry_type, size in changes:
+                    old_type, old_size = previous.get(path, (None, 0))
+                    size_delta = (size if entry_type == "file" else 0) - (old_size if old_type == "file" else 0)
+                    count_delta = (entry_type == "file") - (old_type == "file")
+                    if size_delta or count_delta:
+                        for parent in ancestors(path):
+                            total = deltas.setdefault(parent, [0, 0])
+                            total[0] += size_delta
+                            total[1] += count_delta
+
+            conn.executemany("DELETE FROM entries WHERE path = ?", [(path,) for path in deleted_paths])
+            conn.executemany(
+                """INSERT INTO entries(path, parent, name, ext, type, size, mtime)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT(path) DO UPDATE SET
+                       size = excluded.size, mtime = excluded.mtime, type = excluded.type""",
+                rows
+            )
+            self._apply_dir_deltas(conn, deltas)
+            # After the deltas, so a removed directory is not recreated as an ancestor of its own files
+            conn.executemany("DELETE FROM dir_stats WHERE path = ?", [(path,) for path in deleted_paths])
+            conn.commit()
+
+    def _apply_dir_deltas(self, conn, deltas):
+        conn.executemany(
+            """INSERT INTO dir_stats(path, total_size, file_count) VALUES (?, ?, ?)
+               ON CONFLICT(path) DO UPDATE SET
+                   total_size = total_size + excluded.total_size,
+                   file_count = file_count + excluded.file_count""",
+            [(path, size, count) for path, (size, count) in deltas.items()]
+        )
+
+    def recompute_dir_stats(self):
+        """Rebuild dir_stats from the entries table (after a full build or an upgrade)."""
+        totals = {}
+        conn = self._connect()
+        for parent, size, count in conn.execute(
+            "SELECT parent, SUM(size), COUNT(*) FROM entries WHERE type = 'file' GROUP BY parent"
+        ):
+            for path in [parent] + (list(ancestors(parent)) if parent else []):
+                total = totals.setdefault(path, [0, 0])
+                total[0] += size
+                total[1] += count
+        with self._write_lock:
+            conn.execute("DELETE FROM dir_stats")
+            self._apply_dir_deltas(conn, totals)
+            self._set_meta(conn, "dir_stats_version", 1)
+            conn.commit()
+
+    def dir_stats(self, rel_paths):
+        """Recursive {"size", "files"} for each directory in rel_paths ("" is the root)."""
+        result = {}
+        rel_paths = list(rel_paths)
+        conn = self._connect()
+        for i in range(0, len(rel_paths), 500):
+            chunk = rel_paths[i:i + 500]
+            for path, size, count in conn.execute(
+                f"SELECT path, total_size, file_count FROM dir_stats WHERE path IN ({','.join('?' * len(chunk))})",
+                chunk
+            ):
+                result[path] = {"size": size, "files": count}
+        return {path: result.get(path, {"size": 0, "files": 0}) for path in rel_paths}
+
+    def largest_directories(self, rel_path="", limit=10, direct_children=False):
+        """Top directories by recursive size below rel_path."""
+        if direct_children:
+            sql = """SELECT d.path, d.total_size, d.file_count FROM dir_stats d
+                     JOIN entries e ON e.path = d.path
+                     WHERE e.parent = ? AND e.type = 'directory'
+                     ORDER BY d.total_size DESC LIMIT ?"""
+            params = (rel_path, limit)
+        elif rel_path:
+            sql = """SELECT path, total_size, file_count FROM dir_stats
+                     WHERE path LIKE ? ESCAPE '\\'
+                     ORDER BY total_size DESC LIMIT ?"""
+            params = (_like_escape(rel_path) + "/%", limit)
+        else:
+            sql = """SELECT path, total_size, file_count FROM dir_stats
+                     WHERE path != '' ORDER BY total_size DESC LIMIT ?"""
+            params = (limit,)
+        return [
+            {"path": path, "size": size, "files": count}
+            for path, size, count in self._connect().execute(sql, params)
+        ]
+
+    def _subtree_rows(self, rel_path):
+        prefix = _like_escape(rel_path) + "/%"
+        rows = self._connect().execute(
+            "SELECT path, type, size, mtime FROM entries WHERE path = ? OR path LIKE ? ESCAPE '\\'",
+            (rel_path, prefix)
+        ).fetchall()
+        return {path: (entry_type, size, mtime) for path, entry_type, size, mtime in rows}
+
+    def _sync(self, fresh_rows, known):
+        """Write the difference between what is on disk and what is indexed.
+
+        fresh_rows are rows read from disk, known maps indexed paths to
+        (type, size, mtime). Known paths missing from fresh_rows are deleted.
+        Returns the change events, which are also published.
+        """
+        changed = []
+        events_out = []
+        seen = set()
+        for row in fresh_rows:
+            path, entry_type, size, mtime = row[0], row[4], row[5], row[6]
+            seen.add(path)
+            previous = known.get(path)
+            if previous == (entry_type, size, mtime):
+                continue
+            changed.append(row)
+            if previous is None or previous[0] != entry_type:
+                events_out.append({"type": "created", "path": path, "is_dir": entry_type == "directory"})
+            elif entry_type == "file":
+                # Directory mtimes change with every child; only their children are reported
+                events_out.append({"type": "modified", "path": path, "is_dir": False})
+
+        deleted = [path for path in known if path not in seen]
+        for path in deleted:
+            events_out.append({"type": "deleted", "path": path, "is_dir": known[path][0] == "directory"})
+
+        self._write_rows(changed, deleted)
+        events.publish_all(events_out)
+        return events_out
+
+    def upsert_path(self, rel_path):
+        """Bring a created or modified path up to date; directories are synced recursively."""
+        rel_path = os.path.normpath(rel_path)
+        if rel_path == "." or any(is_hidden(part) for part in rel_path.split(os.sep)):
+            return []
+        try:
+            stat_result = self.pool.stat(rel_path)
+        except OSError:
+            return self.remove_path(rel_path)
+        is_dir = stat.S_ISDIR(stat_result.st_mode)
+        rows = [_row_for(rel_path, stat_result, is_dir)]
+        if is_dir:
+            rows.extend(self._walk(rel_path))
+            known = self._subtree_rows(rel_path)
+        else:
+            known = {k: v for k, v in self._subtree_rows(rel_path).items() if k == rel_path}
+        return self._sync(rows, known)
+
+    def remove_path(self, rel_path):
+        """Drop a path and, if it was a directory, everything under it."""
+        rel_path = os.path.normpath(rel_path)
+        return self._sync([], self._subtree_rows(rel_path))
+
+    def move_path(self, old_path, new_path):
+        """Re-key an indexed subtree after a rename instead of re-reading it from disk."""
+        old_path = os.path.normpath(old_path)
+        new_path = os.path.normpath(new_path)
+        if any(is_hidden(part) for part in new_path.split(os.sep)):
+            return self.remove_path(old_path)
+        known = self._subtree_rows(old_path)
+        if not known:
+            return self.upsert_path(new_path)
+
+        # Replace anything already indexed at the destination
+        self._write_rows([], list(self._subtree_rows(new_path)))
+        new_parent, new_name = os.path.split(new_path)
+        prefix = _like_escape(old_path) + "/%"
+        cut = len(old_path) + 1
+        if known[old_path][0] == "directory":
+            moved_size, moved_files = self.dir_stats([old_path])[old_path].values()
+        else:
+            moved_size, moved_files = known[old_path][1], 1
+        with self._write_lock:
+            conn = self._connect()
+            conn.execute(
+                """UPDATE entries SET
+                       path = ? || substr(path, ?),
+                       parent = ? || substr(parent, ?)
+                   WHERE path LIKE ? ESCAPE '\\'""",
+                (new_path, cut, new_path, cut, prefix)
+            )
+            conn.execute(
+                "UPDATE dir_stats SET path = ? || substr(path, ?) WHERE path = ? OR path LIKE ? ESCAPE '\\'",
+                (new_path, cut, old_path, prefix)
+            )
+            # Totals move from the old ancestors to the new ones; shared ancestors net out
+            deltas = {}
+            for path in ancestors(old_path):
+                deltas[path] = [-moved_size, -moved_files]
+            for path in ancestors(new_path):
+                total = deltas.setdefault(path, [0, 0])
+                total[0] += moved_size
+                total[1] += moved_files
+            self._apply_dir_deltas(conn, {path: d for path, d in deltas.items() if d != [0, 0]})
+            ext = "" if known[old_path][0] == "directory" else os.path.splitext(new_name)[1].lower().lstrip(".")
+            conn.execute(
+                "UPDATE entries SET path = ?, parent = ?, name = ?, ext = ? WHERE path = ?",
+                (new_path, new_parent, new_name, ext, old_path)
+            )
+            conn.commit()
+
+        event = {"type": "moved", "path": new_path, "old_path": old_path,
+                 "is_dir": known[old_path][0] == "directory"}
+        events.publish(event)
+        # Pick up anything that changed during the move itself
+        return [event] + self.upsert_path(new_path)
+
+    def sync_directory(self, rel_dir):
+        """Re-read one directory's direct children and reconcile them with the index.
+
+        New subdirectories are indexed recursively; existing ones are left for
+        the caller to descend into.
+        """
+        known = {
+            path: (entry_type, size, mtime)
+            for path, entry_type, size, mtime in self._connect().execute(
+                "SELECT path, type, size, mtime FROM entries WHERE parent = ? OR path = ?", (rel_dir, rel_dir)
+            )
+        }
+        rows = []
+        new_dirs = []
+        try:
+            if rel_dir:
+                # Refresh the directory's own mtime so the next pass sees it as unchanged
+                rows.append(_row_for(rel_dir, self.pool.stat(rel_dir), True))
+            for entry in self.pool.scandir(rel_dir):
+                if is_hidden(entry.name):
+                    continue
+                rel_path = os.path.join(rel_dir, entry.name) if rel_dir else entry.name
+                try:
+                    is_dir = entry.is_dir()
+                    # Directories on several volumes report their newest copy
+                    stat_result = entry.stat() if self.pool.single or not is_dir else self.pool.stat(rel_path)
+                except OSError:
+                    continue
+                rows.append(_row_for(rel_path, stat_result, is_dir))
+                if is_dir and rel_path not in known:
+                    new_dirs.append(rel_path)
+        except FileNotFoundError:
+            pass
+
+        # Removed subdirectories take their whole subtree with them
+        present = {row[0] for row in rows}
+        gone_dirs = [path for path, value in known.items()
+                     if value[0] == "directory" and path != rel_dir and path not in present]
+        changes = self._sync(rows, known)
+        for path in gone_dirs:
+            changes.extend(self.remove_path(path))
+        for path in new_dirs:
+            changes.extend(self.upsert_path(path))
+        return changes
+
+    def directory_mtimes(self):
+        """Indexed mtime of every directory, keyed by relative path ("" is the root)."""
+        mtimes = dict(self._connect().execute("SELECT path, mtime FROM entries WHERE type = 'directory'"))
+        root_mtime = self._get_meta("root_mtime")
+        if root_mtime is not None:
+            mtimes[""] = float(root_mtime)
+        return mtimes
+
+    def set_root_mtime(self, mtime):
+        with self._write_lock:
+            conn = self._connect()
+            self._set_meta(conn, "root_mtime", mtime)
+            conn.commit()
+
+    def search(self, q, limit=50, offset=0, type=None, extensions=None,
+               min_size=None, max_size=None, modified_after=None, modified_before=None):
+        """Ranked substring search over names with optional filters.
+
+        Queries of three or more characters use the trigram index; shorter ones
+        fall back to a prefix match on the name index.
+        """
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        where = []
+        params = []
+
+        if len(q) >= 3:
+            source = "entries_fts JOIN entries e ON e.id = entries_fts.rowid"
+            where.append("entries_fts MATCH ?")
+            params.append('"' + q.replace('"', '""') + '"')
+            rank = "bm25(entries_fts), "
+        else:
+            source = "entries e"
+            where.append("e.name LIKE ? ESCAPE '\\'")
+            params.append(_like_escape(q) + "%")
+            rank = ""
+
+        if type:
+            where.append("e.type = ?")
+            params.append(type)
+        if extensions:
+            where.append(f"e.ext IN ({','.join('?' * len(extensions))})")
+            params.extend(ext.lower().lstrip(".") for ext in extensions)
+        if min_size is not None:
+            where.append("e.size >= ?")
+            params.append(min_size)
+        if max_size is not None:
+            where.append("e.size <= ?")
+            params.append(max_size)
+        if modified_after is not None:
+            where.append("e.mtime >= ?")
+            params.append(modified_after)
+        if modified_before is not None:
+            where.append("e.mtime <= ?")
+            params.append(modified_before)
+
+        # Exact name, then prefix, then relevance, then shallower paths
+        sql = f"""
+            SELECT e.path, e.type, e.size, e.mtime FROM {source}
+            WHERE {' AND '.join(where)}
+            ORDER BY (e.name = ?) DESC, (e.name LIKE ? ESCAPE '\\') DESC, {rank}length(e.path), e.path
+            LIMIT ? OFFSET ?
+        """
+        params.extend([q, _like_escape(q) + "%", limit + 1, offset])
+
+        rows = self._connect().execute(sql, params).fetchall()
+        items = [
+            {"name": path, "type": entry_type, "size": size, "mtime": mtime}
+            for path, entry_type, size, mtime in rows[:limit]
+        ]
+        return {"items": items, "has_more": len(rows) > limit}
@@ -0,0 +1,417 @@
+import errno
+import fcntl
+import json
+import os
+import shutil
+import stat
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from fastapi import HTTPException
+
+from services.cas import BLOB_DIR_NAME
+from services.uploads import STAGING_DIR_NAME
+
+BATCH_WORKERS = int(os.environ.get("BATCH_WORKERS", "8"))
+# Batches longer than this run as a background job instead of inside the request
+BATCH_INLINE_LIMIT = int(os.environ.get("BATCH_INLINE_LIMIT", "500"))
+MAX_BATCH_OPERATIONS = int(os.environ.get("MAX_BATCH_OPERATIONS", "50000"))
+# Directory copies above this many bytes run as a background job
+COPY_INLINE_BYTES = int(os.environ.get("COPY_INLINE_BYTES", str(256 * 1024 * 1024)))
+COPY_BUFFER_SIZE = 8 * 1024 * 1024
+COPY_RANGE_CHUNK = 64 * 1024 * 1024
+
+# linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+# Errors meaning "this filesystem (pair) cannot do that", as opposed to a real I/O failure
+_UNSUPPORTED = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTTY, errno.EBADF, errno.EPERM}
+
+
+def resolve(root, rel_path):
+    """Absolute path for rel_path, refusing the root itself, escapes, the upload staging area and blob store."""
+    rel_path = os.path.normpath((rel_path or "").lstrip("/"))
+    full_path = os.path.normpath(os.path.join(root, rel_path))
+    if rel_path == "." or not full_path.startswith(root + os.sep):
+        raise HTTPException(status_code=403, detail="Access denied")
+    if rel_path.split(os.sep)[0] in (STAGING_DIR_NAME, BLOB_DIR_NAME):
+        raise HTTPException(status_code=403, detail="Access denied")
+    return rel_path, full_path
+
+
+def _sources(pool, rel_path):
+    """Every copy of rel_path (one per volume holding it); 404 if there is none."""
+    sources = pool.locations(rel_path)
+    if not sources:
+        raise HTTPException(status_code=404, detail="File or directory not found")
+    return sources
+
+
+def _check_destination(pool, rel_src, rel_dest, overwrite):
+    if rel_dest == rel_src or rel_dest.startswith(rel_src + os.sep):
+        raise HTTPException(status_code=400, detail="Cannot move or copy a folder into itself")
+    if not pool.isdir(os.path.dirname(rel_dest)):
+        raise HTTPException(status_code=404, detail="Destination folder not found")
+    existing = pool.locations(rel_dest)
+    if existing and not overwrite:
+        raise HTTPException(status_code=409, detail="Destination already exists")
+    # Left in place until the new data is complete; see _install() and _drop_stale()
+    return existing
+
+
+def _on_same_volume(pool, full_src, rel_dest):
+    # Each copy moves within its own volume, so a move stays a rename
+    volume = pool.volume_of(full_src)
+    full_dest = os.path.join(volume.path, rel_dest)
+    os.makedirs(os.path.dirname(full_dest), exist_ok=True)
+    return full_dest
+
+
+def _remove(full_path):
+    if os.path.isdir(full_path) and not os.path.islink(full_path):
+        shutil.rmtree(full_path)
+    else:
+        os.remove(full_path)
+
+
+def _is_dir(full_path):
+    return os.path.isdir(full_path) and not os.path.islink(full_path)
+
+
+def _install(ready, full_dest):
+    """Rename a complete file or tree over full_dest, replacing whatever is there.
+
+    A file replacing a file is a single os.replace. Anything involving a
+    directory cannot be replaced in one rename, so the old entry is renamed
+    aside under a hidden name first, put back if the swap fails, and only
+    deleted once the new one is in place.
+    """
+    if not os.path.lexists(full_dest) or not (_is_dir(full_dest) or _is_dir(ready)):
+        os.replace(ready, full_dest)
+        return
+    parent, name = os.path.split(full_dest)
+    aside = os.path.join(parent, f".{name}.replaced-{uuid.uuid4().hex[:8]}")
+    os.rename(full_dest, aside)
+    try:
+        os.rename(ready, full_dest)
+    except BaseException:
+        os.rename(aside, full_dest)
+        raise
+    _remove(aside)
+
+
+def _drop_stale(existing, installed):
+    """Remove overwritten copies on volumes that did not receive the new data."""
+    for full_dest in existing:
+        if full_dest not in installed and os.path.lexists(full_dest):
+            _remove(full_dest)
+
+
+def delete_path(pool, index, rel_path):
+    rel_path, _ = resolve(pool.root, rel_path)
+    for full_path in _sources(pool, rel_path):
+        _remove(full_path)
+    index.remove_path(rel_path)
+    return {"path": rel_path}
+
+
+def move_path(pool, index, rel_path, destination, overwrite=False):
+    rel_path, _ = resolve(pool.root, rel_path)
+    rel_dest, _ = resolve(pool.root, destination)
+    sources = _sources(pool, rel_path)
+    existing = _check_destination(pool, rel_path, rel_dest, overwrite)
+    installed = []
+    for full_path in sources:
+        full_dest = _on_same_volume(pool, full_path, rel_dest)
+        try:
+            # Same filesystem: an atomic rename, whatever the size of the tree
+            _install(full_path, full_dest)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            # The destination stays as it was until the copy is complete
+            _copy_any(full_path, full_dest)
+            _remove(full_path)
+        installed.append(full_dest)
+    _drop_stale(existing, installed)
+    index.move_path(rel_path, rel_dest)
+    return {"path": rel_path, "destination": rel_dest}
+
+
+def rename_path(pool, index, rel_path, name, overwrite=False):
+    if not name or os.path.basename(name) != name or name in (".", ".."):
+        raise HTTPException(status_code=400, detail="Invalid name")
+    rel_path = os.path.normpath((rel_path or "").lstrip("/"))
+    return move_path(pool, index, rel_path, os.path.join(os.path.dirname(rel_path), name), overwrite)
+
+
+def copy_file(src, dest, on_progress=None):
+    """Copy one regular file, cheapest method first.
+
+    1. FICLONE: a reflink (btrfs, XFS, bcachefs); shares extents, O(1).
+    2. copy_file_range: in-kernel copy, no user-space buffers; NFS and
+       some filesystems turn it into a server-side copy.
+    3. read/write with a large buffer.
+    on_progress(nbytes) is called as bytes are copied.
+    """
+    with open(src, "rb") as fsrc, open(dest, "wb") as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            if on_progress:
+                on_progress(size)
+            return "reflink"
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED:
+                raise
+
+        copied = 0
+        if hasattr(os, "copy_file_range"):
+            try:
+                while True:
+                    n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), COPY_RANGE_CHUNK)
+                    if n == 0:
+                        break
+                    copied += n
+                    if on_progress:
+                        on_progress(n)
+                if copied == size:
+                    return "copy_file_range"
+            except OSError as e:
+                if e.errno not in _UNSUPPORTED or copied:
+                    raise
+            if copied == 0 and size > 0:
+                # Some filesystems report success but copy nothing (e.g. procfs-like files)
+                fsrc.seek(0)
+                fdst.seek(0)
+                fdst.truncate()
+
+        buffer = bytearray(COPY_BUFFER_SIZE)
+        view = memoryview(buffer)
+        fsrc.seek(copied)
+        while True:
+            n = fsrc.readinto(buffer)
+            if not n:
+                break
+            fdst.write(view[:n])
+            if on_progress:
+                on_progress(n)
+        return "buffered"
+
+
+def copy_tree(src, dest, on_progress=None, check_cancelled=None):
+    """Copy a directory tree with copy_file; symlinks are recreated, not followed."""
+    os.makedirs(dest)
+    directories = [(src, dest)]
+    for dirpath, dirs, files in os.walk(src):
+        target_dir = os.path.join(dest, os.path.relpath(dirpath, src))
+        for name in dirs:
+            source = os.path.join(dirpath, name)
+            target = os.path.join(target_dir, name)
+            if os.path.islink(source):
+                os.symlink(os.readlink(source), target)
+            else:
+                os.mkdir(target)
+                directories.append((source, target))
+        for name in files:
+            if check_cancelled:
+                check_cancelled()
+            source = os.path.join(dirpath, name)
+            target = os.path.join(target_dir, name)
+            mode = os.lstat(source).st_mode
+            if stat.S_ISLNK(mode):
+                os.symlink(os.readlink(source), target)
+            elif stat.S_ISREG(mode):
+                copy_file(source, target, on_progress)
+                shutil.copystat(source, target)
+    # Directory mtimes last: creating entries inside them would bump the copies again
+    for source, target in reversed(directories):
+        shutil.copystat(source, target)
+
+
+def _copy_any(full_src, full_dest, on_progress=None, check_cancelled=None):
+    """Copy a file or tree under a hidden temporary name, then rename it into place.
+
+    The index and watcher ignore dot-names, so a half-finished copy is never
+    listed, and a failed or cancelled one leaves nothing behind and any
+    existing destination untouched.
+    """
+    parent, name = os.path.split(full_dest)
+    tmp = os.path.join(parent, f".{name}.copy-{uuid.uuid4().hex[:8]}")
+    try:
+        if os.path.isdir(full_src) and not os.path.islink(full_src):
+            copy_tree(full_src, tmp, on_progress, check_cancelled)
+        elif os.path.islink(full_src):
+            os.symlink(os.readlink(full_src), tmp)
+        else:
+            copy_file(full_src, tmp, on_progress)
+            shutil.copystat(full_src, tmp)
+        _install(tmp, full_dest)
+    except BaseException:
+        if os.path.lexists(tmp):
+            _remove(tmp)
+        raise
+
+
+def copy_path(pool, index, rel_path, destination, overwrite=False, on_progress=None, check_cancelled=None,
+              ledger=None, user_id=None):
+    """Copy a file or tree; with a quota ledger the copy is reserved against user_id's quota and recorded."""
+    rel_path, _ = resolve(pool.root, rel_path)
+    rel_dest, _ = resolve(pool.root, destination)
+    sources = _sources(pool, rel_path)
+    reservation = None
+    if ledger is not None and ledger.quota(user_id):
+        reservation = ledger.reserve(user_id, copy_size(sources), rel_dest if overwrite else None)
+    try:
+        existing = _check_destination(pool, rel_path, rel_dest, overwrite)
+        installed = []
+        for full_path in sources:
+            full_dest = _on_same_volume(pool, full_path, rel_dest)
+            _copy_any(full_path, full_dest, on_progress, check_cancelled)
+            installed.append(full_dest)
+        _drop_stale(existing, installed)
+        index.upsert_path(rel_dest)
+        if ledger is not None:
+            ledger.record_tree(user_id, rel_dest)
+    finally:
+        if reservation is not None:
+            ledger.release(reservation)
+    return {"path": rel_path, "destination": rel_dest}
+
+
+def copy_size(full_paths):
+    """Bytes copy_path will copy from these copies of a path: regular files only, symlinks are not followed."""
+    total = 0
+    for full_path in full_paths:
+        if not os.path.isdir(full_path) or os.path.islink(full_path):
+            total += os.lstat(full_path).st_size if os.path.isfile(full_path) else 0
+            continue
+        for dirpath, _, files in os.walk(full_path):
+            for name in files:
+                try:
+                    st = os.lstat(os.path.join(dirpath, name))
+                except OSError:
+                    continue
+                if stat.S_ISREG(st.st_mode):
+                    total += st.st_size
+    return total
+
+
+def copy_job(pool, index, ledger=None):
+    """Job runner for large copies; progress is reported in bytes."""
+    def run(ctx):
+        ctx.set_total(copy_size(pool.locations(resolve(pool.root, ctx.params["path"])[0])))
+        copy_path(pool, index, ctx.params["path"], ctx.params["destination"], ctx.params.get("overwrite", False),
+                  on_progress=ctx.advance, check_cancelled=ctx.check_cancelled, ledger=ledger, user_id=ctx.user_id)
+        return None
+    return run
+
+
+def apply(pool, index, operation, ledger=None, user_id=None):
+    """Run one batch operation and describe the outcome; never raises."""
+    op = operation.get("op")
+    try:
+        if op == "delete":
+            detail = delete_path(pool, index, operation["path"])
+        elif op == "move":
+            detail = move_path(pool, index, operation["path"], operation.get("destination"),
+                               operation.get("overwrite", False))
+        elif op == "copy":
+            detail = copy_path(pool, index, operation["path"], operation.get("destination"),
+                               operation.get("overwrite", False), ledger=ledger, user_id=user_id)
+        elif op == "rename":
+            detail = rename_path(pool, index, operation["path"], operation.get("name"),
+                                 operation.get("overwrite", False))
+        else:
+            raise HTTPException(status_code=400, detail=f"Unknown operation: {op}")
+        return {"op": op, "status": "ok", **detail}
+    except HTTPException as e:
+        return {"op": op, "path": operation.get("path"), "status": "error", "code": e.status_code,
+                "detail": e.detail}
+    except FileNotFoundError:
+        return {"op": op, "path": operation.get("path"), "status": "error", "code": 404,
+                "detail": "File or directory not found"}
+    except Exception as e:
+        return {"op": op, "path": operation.get("path"), "status": "error", "code": 500, "detail": str(e)}
+
+
+def _touched(operation):
+    paths = [os.path.normpath(operation.get("path") or "")]
+    if operation.get("destination"):
+        paths.append(os.path.normpath(operation["destination"]))
+    if operation.get("op") == "rename" and operation.get("name"):
+        paths.append(os.path.join(os.path.dirname(paths[0]), operation["name"]))
+    return paths
+
+
+def _overlaps(a_paths, b_paths):
+    for a in a_paths:
+        for b in b_paths:
+            if a == b or a.startswith(b + os.sep) or b.startswith(a + os.sep):
+                return True
+    return False
+
+
+def iter_batch(pool, index, operations, workers=BATCH_WORKERS, cancel_event=None, ledger=None, user_id=None):
+    """Run operations on a thread pool, yielding results as they finish.
+
+    Independent operations run concurrently. An operation whose paths
+    overlap (equal, parent or child) an earlier unfinished one waits for
+    it, so "move a -> b" followed by "delete b/x" behaves as written.
+    Each result carries the operation's position in the request as "index".
+    Stops submitting new work once cancel_event is set. Copies are charged
+    to user_id through ledger, as with copy_path().
+    """
+    executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="batch-op")
+    pending = {}  # future -> (index, touched paths)
+    max_pending = max(1, workers) * 4
+
+    def finished(futures):
+        for future in futures:
+            position, _ = pending.pop(future)
+            yield {"index": position, **future.result()}
+
+    try:
+        for position, operation in enumerate(operations):
+            if cancel_event is not None and cancel_event.is_set():
+                break
+            touched = _touched(operation)
+            while True:
+                blockers = [f for f, (_, paths) in pending.items() if _overlaps(paths, touched)]
+                if not blockers and len(pending) < max_pending:
+                    break
+                done, _ = wait(blockers or list(pending), return_when=FIRST_COMPLETED)
+                yield from finished(done)
+            future = executor.submit(apply, pool, index, operation, ledger, user_id)
+            pending[future] = (position, touched)
+            done = [f for f in pending if f.done()]
+            yield from finished(done)
+
+        while pending:
+            done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+            yield from finished(done)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def ndjson(results):
+    for result in results:
+        yield json.dumps(result) + "\n"
+
+
+def batch_job(pool, index, ledger=None):
+    """Job runner for large batches: progress counts operations, results go to an NDJSON file."""
+    def run(ctx):
+        operations = ctx.params["operations"]
+        ctx.set_total(len(operations))
+        output = ctx.output_path(".ndjson")
+        failed = 0
+        with open(output, "w") as out:
+            for result in iter_batch(pool, index, operations, cancel_event=ctx.cancel_event,
+                                     ledger=ledger, user_id=ctx.user_id):
+                failed += result["status"] != "ok"
+                out.write(json.dumps(result) + "\n")
+                ctx.advance(1)
+            ctx.check_cancelled()
+            out.write(json.dumps({"summary": True, "total": len(operations), "failed": failed}) + "\n")
+        return {"result_path": output}
+    return run
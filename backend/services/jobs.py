@@ -0,0 +1,474 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import inspect, text
+
+from models.job import Job
+from services import metrics, progress, state
+
+logger = logging.getLogger(__name__)
+
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", min(4, os.cpu_count() or 1)))
+JOB_OUTPUT_DIR = os.environ.get("JOB_OUTPUT_DIR", os.path.join(tempfile.gettempdir(), "cloud_drive_jobs"))
+JOB_RESULT_TTL_SECONDS = int(os.environ.get("JOB_RESULT_TTL", "3600"))
+MAX_QUEUED_PER_USER = int(os.environ.get("JOB_MAX_QUEUED_PER_USER", "20"))
+REAPER_INTERVAL_SECONDS = 60
+PROGRESS_FLUSH_SECONDS = 1.0
+# Idle workers look for jobs at least this often, in case a wake-up message was missed
+POLL_INTERVAL_SECONDS = 2.0
+HEARTBEAT_INTERVAL_SECONDS = 2.0
+# A running job whose worker has not reported for this long is queued again
+JOB_STALE_SECONDS = int(os.environ.get("JOB_STALE_SECONDS", "30"))
+# Queued rows considered when picking the next job
+CLAIM_SCAN_LIMIT = 200
+CHANNEL = "jobs"
+
+ACTIVE_STATUSES = ("queued", "processing")
+FINISHED_STATUSES = ("complete", "error", "cancelled")
+
+
+def ensure_schema(engine):
+    """Add columns and indexes introduced after the jobs table existed; create_all skips existing tables."""
+    existing = {column["name"] for column in inspect(engine).get_columns(Job.__tablename__)}
+    with engine.begin() as conn:
+        for column in Job.__table__.columns:
+            if column.name not in existing:
+                ddl = column.type.compile(dialect=engine.dialect)
+                conn.execute(text(f"ALTER TABLE {Job.__tablename__} ADD COLUMN {column.name} {ddl}"))
+    for index in Job.__table__.indexes:
+        index.create(bind=engine, checkfirst=True)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobContext:
+    """Handle given to a job runner for reporting progress and honouring cancellation."""
+
+    def __init__(self, manager, job_id, user_id, params):
+        self.manager = manager
+        self.job_id = job_id
+        self.user_id = user_id
+        self.params = params
+        self.kind = None
+        self.bytes_total = 0
+        self.bytes_done = 0
+        self.cancel_event = threading.Event()
+        self._last_flush = 0.0
+
+    def output_path(self, suffix):
+        return os.path.join(self.manager.output_dir, f"{self.job_id}{suffix}")
+
+    def set_total(self, bytes_total):
+        self.bytes_total = bytes_total
+        self.manager._persist(self.job_id, bytes_total=bytes_total)
+        self.manager._push(self)
+
+    def advance(self, nbytes):
+        self.bytes_done += nbytes
+        now = time.monotonic()
+        if now - self._last_flush >= PROGRESS_FLUSH_SECONDS:
+            self._last_flush = now
+            self.manager._persist(self.job_id, bytes_done=self.bytes_done)
+            self.manager._push(self)
+
+    def check_cancelled(self):
+        if self.cancel_event.is_set():
+            raise JobCancelled()
+
+
+class JobManager:
+    """Bounded worker pool for long-running jobs with persisted state.
+
+    The jobs table is the queue, shared by every server process: a worker
+    claims a queued row with a conditional UPDATE, so each job runs exactly
+    once wherever it was submitted, and status, progress and results can be
+    read from any process. Workers pick round-robin across users, so one
+    user queueing twenty archives cannot starve everyone else.
+
+    Running jobs are heartbeated; the leader process queues again any job
+    whose worker stopped reporting (crash, kill, restart), and a cancel
+    request reaches the running worker through the cancel_requested flag.
+    Finished results are deleted by a reaper once they outlive the TTL.
+
+    Runners are registered per job kind and called as runner(ctx); they return
+    {"result_path": ..., "filename": ...} or None.
+    """
+
+    def __init__(self, session_factory, workers=JOB_WORKERS, output_dir=JOB_OUTPUT_DIR,
+                 result_ttl=JOB_RESULT_TTL_SECONDS):
+        self.session_factory = session_factory
+        self.workers = max(1, workers)
+        self.output_dir = output_dir
+        self.result_ttl = result_ttl
+        self._runners = {}
+        self._contexts = {}
+        # user_id -> monotonic time a job of theirs was last claimed here
+        self._served = {}
+        self._wakeups = 0
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._threads = []
+        state.store.subscribe(CHANNEL, self._on_message)
+
+    def register(self, kind, runner):
+        self._runners[kind] = runner
+
+    def start(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"job-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        for target, name in ((self._heartbeat, "job-heartbeat"), (self._reaper, "job-reaper")):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+        with self._cond:
+            for ctx in self._contexts.values():
+                ctx.cancel_event.set()
+            self._cond.notify_all()
+
+    def _wake(self):
+        with self._cond:
+            self._wakeups += 1
+            self._cond.notify()
+
+    def _on_message(self, message):
+        if message.get("cancel"):
+            with self._cond:
+                ctx = self._contexts.get(message["cancel"])
+            if ctx is not None:
+                ctx.cancel_event.set()
+        else:
+            self._wake()
+
+    def requeue_stale(self):
+        """Queue again jobs left processing by a worker that stopped heartbeating; returns how many."""
+        cutoff = datetime.utcnow() - timedelta(seconds=JOB_STALE_SECONDS)
+        db = self.session_factory()
+        stale = (Job.status == "processing") & ((Job.heartbeat_at == None) | (Job.heartbeat_at < cutoff))
+        try:
+            # A cancel that never reached the dead worker still counts
+            db.query(Job).filter(stale, Job.cancel_requested == 1) \
+                .update({"status": "cancelled", "finished_at": datetime.utcnow()}, synchronize_session=False)
+            requeued = (db.query(Job)
+                        .filter(stale)
+                        .update({"status": "queued", "bytes_done": 0, "worker_id": None, "heartbeat_at": None},
+                                synchronize_session=False))
+            db.commit()
+        finally:
+            db.close()
+        if requeued:
+            logger.warning("Queued %d interrupted jobs again", requeued)
+            self._wake()
+            state.store.publish(CHANNEL, {})
+        return requeued
+
+    def _next_job(self):
+        while not self._stop.is_set():
+            with self._cond:
+                wakeups = self._wakeups
+            ctx = self._claim()
+            if ctx is not None:
+                return ctx
+            with self._cond:
+                # A job submitted while we were looking has already bumped the counter
+                if self._wakeups == wakeups and not self._stop.is_set():
+                    self._cond.wait(POLL_INTERVAL_SECONDS)
+        return None
+
+    def _claim(self):
+        db = self.session_factory()
+        try:
+            queued = (db.query(Job.id, Job.user_id)
+                      .filter(Job.status == "queued")
+                      .order_by(Job.created_at)
+                      .limit(CLAIM_SCAN_LIMIT)
+                      .all())
+            # Round-robin over users: each user's oldest job, least recently served user first
+            oldest = {}
+            for job_id, user_id in queued:
+                oldest.setdefault(user_id, job_id)
+            with self._cond:
+                order = sorted(oldest, key=lambda user_id: self._served.get(user_id, 0.0))
+            for user_id in order:
+                job_id = oldest[user_id]
+                now = datetime.utcnow()
+                claimed = (db.query(Job)
+                           .filter(Job.id == job_id, Job.status == "queued")
+                           .update({"status": "processing", "started_at": now, "heartbeat_at": now,
+                                    "worker_id": state.PROCESS_ID, "cancel_requested": 0},
+                                   synchronize_session=False))
+                db.commit()
+                if not claimed:
+                    # Another worker, here or in another process, got there first
+                    continue
+                job = db.query(Job).filter(Job.id == job_id).first()
+                ctx = JobContext(self, job.id, job.user_id, json.loads(job.params or "{}"))
+                ctx.kind = job.kind
+                with self._cond:
+                    self._served[user_id] = time.monotonic()
+                    self._contexts[job_id] = ctx
+                self._push(ctx)
+                return ctx
+            return None
+        finally:
+            db.close()
+
+    def submit(self, user_id, kind, params, filename=None):
+        if kind not in self._runners:
+            raise ValueError(f"Unknown job kind: {kind}")
+
+        job_id = str(uuid.uuid4())
+        db = self.session_factory()
+        try:
+            queued = db.query(Job).filter(Job.user_id == user_id, Job.status == "queued").count()
+            if queued >= MAX_QUEUED_PER_USER:
+                raise QueueFull()
+            db.add(Job(
+                id=job_id,
+                user_id=user_id,
+                kind=kind,
+                status="queued",
+                params=json.dumps(params),
+                filename=filename,
+                created_at=datetime.utcnow()
+            ))
+            db.commit()
+        finally:
+            db.close()
+        self._wake()
+        state.store.publish(CHANNEL, {})
+        progress.hub.publish(user_id, {"job_id": job_id, "kind": kind, "status": "queued", "progress": 0,
+                                       "bytes_done": 0, "bytes_total": 0, "filename": filename})
+        return job_id
+
+    def _persist(self, job_id, **fields):
+        db = self.session_factory()
+        try:
+            db.query(Job).filter(Job.id == job_id).update(fields)
+            db.commit()
+        finally:
+            db.close()
+
+    def _push(self, ctx, status="processing"):
+        """Push a running job's live counters to its owner's progress streams."""
+        progress.hub.publish(ctx.user_id, {
+            "job_id": ctx.job_id,
+            "kind": ctx.kind,
+            "status": status,
+            "progress": progress.percent(status, ctx.bytes_done, ctx.bytes_total),
+            "bytes_done": ctx.bytes_done,
+            "bytes_total": ctx.bytes_total,
+        })
+
+    def _notify(self, job_id):
+        """Push a job's persisted state (after a status change) to its owner's progress streams."""
+        db = self.session_factory()
+        try:
+            job = db.query(Job).filter(Job.id == job_id).first()
+            if job is None:
+                return
+            update = {key: value.isoformat() if isinstance(value, datetime) else value
+                      for key, value in self._serialize(job).items()}
+            user_id = job.user_id
+        finally:
+            db.close()
+        progress.hub.publish(user_id, update)
+
+    def _worker(self):
+        while not self._stop.is_set():
+            ctx = self._next_job()
+            if ctx is None:
+                continue
+            self._run(ctx)
+
+    def _run(self, ctx):
+        kind = ctx.kind
+        started = time.perf_counter()
+        status = "error"
+        try:
+            ctx.check_cancelled()
+            result = self._runners[kind](ctx) or {}
+            status = "complete"
+            self._persist(ctx.job_id, status=status, bytes_done=ctx.bytes_done,
+                          finished_at=datetime.utcnow(), **result)
+        except JobCancelled:
+            # Jobs interrupted by shutdown go back to the queue for another worker
+            status = "queued" if self._stop.is_set() else "cancelled"
+            self._persist(ctx.job_id, status=status, bytes_done=0, worker_id=None, heartbeat_at=None,
+                          finished_at=None if status == "queued" else datetime.utcnow())
+            self._remove_outputs(ctx.job_id)
+        except Exception as e:
+            logger.exception("Job %s failed", ctx.job_id, extra={"job_id": ctx.job_id, "kind": kind})
+            self._persist(ctx.job_id, status="error", error=str(e), finished_at=datetime.utcnow())
+            self._remove_outputs(ctx.job_id)
+        finally:
+            with self._cond:
+                self._contexts.pop(ctx.job_id, None)
+            self._notify(ctx.job_id)
+            metrics.jobs_finished.inc(kind=kind, status=status)
+            metrics.job_duration.observe(time.perf_counter() - started, kind=kind)
+            metrics.job_bytes.inc(ctx.bytes_done, kind=kind)
+
+    def _remove_outputs(self, job_id):
+        for name in os.listdir(self.output_dir):
+            if name.startswith(job_id):
+                try:
+                    os.remove(os.path.join(self.output_dir, name))
+                except FileNotFoundError:
+                    pass
+
+    def get(self, job_id, user_id):
+        db = self.session_factory()
+        try:
+            job = db.query(Job).filter(Job.id == job_id, Job.user_id == user_id).first()
+            if job is None:
+                return None
+            return self._serialize(job)
+        finally:
+            db.close()
+
+    def list_jobs(self, user_id, limit=50):
+        db = self.session_factory()
+        try:
+            jobs = (db.query(Job)
+                    .filter(Job.user_id == user_id)
+                    .order_by(Job.created_at.desc())
+                    .limit(limit)
+                    .all())
+            return [self._serialize(job) for job in jobs]
+        finally:
+            db.close()
+
+    def _serialize(self, job):
+        bytes_done = job.bytes_done or 0
+        bytes_total = job.bytes_total or 0
+        with self._cond:
+            ctx = self._contexts.get(job.id)
+            if ctx is not None and job.status == "processing":
+                # Live counters are fresher than the throttled database copy
+                bytes_done, bytes_total = ctx.bytes_done, ctx.bytes_total
+        return {
+            "job_id": job.id,
+            "kind": job.kind,
+            "status": job.status,
+            "progress": progress.percent(job.status, bytes_done, bytes_total),
+            "bytes_done": bytes_done,
+            "bytes_total": bytes_total,
+            "filename": job.filename,
+            "error": job.error,
+            "created_at": job.created_at,
+            "finished_at": job.finished_at,
+        }
+
+    def result_path(self, job_id, user_id):
+        db = self.session_factory()
+        try:
+            job = db.query(Job).filter(Job.id == job_id, Job.user_id == user_id).first()
+            if job is None or job.status != "complete" or not job.result_path:
+                return None, None
+            return job.result_path, job.filename
+        finally:
+            db.close()
+
+    def cancel(self, job_id, user_id):
+        """Cancel a queued or running job. Returns False if it is not active."""
+        db = self.session_factory()
+        try:
+            job = db.query(Job).filter(Job.id == job_id, Job.user_id == user_id).first()
+            if job is None or job.status not in ACTIVE_STATUSES:
+                return False
+            cancelled = (db.query(Job)
+                         .filter(Job.id == job_id, Job.status == "queued")
+                         .update({"status": "cancelled", "finished_at": datetime.utcnow()},
+                                 synchronize_session=False))
+            if not cancelled:
+                # Running, here or elsewhere: its worker stops at the next check
+                db.query(Job).filter(Job.id == job_id, Job.status == "processing") \
+                    .update({"cancel_requested": 1}, synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+        if cancelled:
+            self._notify(job_id)
+        else:
+            self._on_message({"cancel": job_id})
+            state.store.publish(CHANNEL, {"cancel": job_id})
+        return True
+
+    def queue_depth(self):
+        db = self.session_factory()
+        try:
+            return db.query(Job).filter(Job.status == "queued").count()
+        finally:
+            db.close()
+
+    def _heartbeat(self):
+        while not self._stop.wait(HEARTBEAT_INTERVAL_SECONDS):
+            with self._cond:
+                running = list(self._contexts)
+            if not running:
+                continue
+            db = self.session_factory()
+            try:
+                db.query(Job).filter(Job.id.in_(running), Job.worker_id == state.PROCESS_ID) \
+                    .update({"heartbeat_at": datetime.utcnow()}, synchronize_session=False)
+                db.commit()
+                # Covers cancel messages lost on the way (or sent before the job was claimed)
+                for (job_id,) in db.query(Job.id).filter(Job.id.in_(running), Job.cancel_requested == 1):
+                    self._on_message({"cancel": job_id})
+            except Exception:
+                logger.exception("Error heartbeating jobs")
+            finally:
+                db.close()
+
+    def _reaper(self):
+        while not self._stop.wait(REAPER_INTERVAL_SECONDS):
+            if not state.is_leader():
+                continue
+            try:
+                self.requeue_stale()
+                self.reap()
+            except Exception:
+                logger.exception("Error reaping jobs")
+
+    def reap(self):
+        """Delete results of jobs finished more than result_ttl ago, plus orphaned files."""
+        cutoff = datetime.utcnow() - timedelta(seconds=self.result_ttl)
+        db = self.session_factory()
+        try:
+            expired = (db.query(Job)
+                       .filter(Job.status.in_(FINISHED_STATUSES), Job.finished_at < cutoff)
+                       .all())
+            for job in expired:
+                self._remove_outputs(job.id)
+                job.status = "expired"
+            db.commit()
+
+            live = {job_id for (job_id,) in db.query(Job.id).filter(Job.status.in_(ACTIVE_STATUSES + ("complete",)))}
+        finally:
+            db.close()
+
+        for name in os.listdir(self.output_dir):
+            path = os.path.join(self.output_dir, name)
+            if name[:36] not in live and os.path.getmtime(path) < time.time() - self.result_ttl:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,292 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds; covers a cached stat (sub-millisecond) up to a multi-minute archive
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = self.header()
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        super().__init__(name, documentation, labelnames)
+        # Unlabelled gauges can be computed at scrape time instead of being kept up to date
+        self.callback = callback
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def render(self):
+        lines = self.header()
+        if self.callback is not None:
+            try:
+                lines.append(f"{self.name} {_format_value(self.callback())}")
+            except Exception:
+                pass
+            return lines
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket (non-cumulative) counts, then sum and count
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self):
+        lines = self.header()
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += bucket_count
+                    labels = _format_labels(self.labelnames, key, [("le", _format_value(bound))])
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(self.labelnames, key)
+                lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+                lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                # Module reloads (uvicorn --reload, tests) re-declare metrics; keep the first
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def counter(name, documentation, labelnames=()):
+    return registry.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name, documentation, labelnames=(), callback=None):
+    return registry.register(Gauge(name, documentation, labelnames, callback))
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return registry.register(Histogram(name, documentation, labelnames, buckets))
+
+
+# HTTP
+http_requests = counter("http_requests_total", "HTTP requests by route, method and status.",
+                        ("method", "route", "status"))
+http_request_duration = histogram("http_request_duration_seconds",
+                                  "Time from request start to the last response byte.", ("method", "route"))
+http_request_bytes = counter("http_request_bytes_total", "Request body bytes received.", ("method", "route"))
+http_response_bytes = counter("http_response_bytes_total", "Response body bytes sent.", ("method", "route"))
+http_in_flight = gauge("http_requests_in_flight", "Requests currently being served.")
+
+# Filesystem
+scandir_duration = histogram("fs_scandir_duration_seconds", "Time to list one directory (listing cache misses).")
+walk_duration = histogram("fs_walk_duration_seconds", "Time for full-tree walks.", ("operation",))
+
+# Jobs
+job_queue_depth = gauge("job_queue_depth", "Jobs waiting for a worker.")
+jobs_finished = counter("jobs_finished_total", "Jobs that left the queue, by kind and final status.",
+                        ("kind", "status"))
+job_duration = histogram("job_duration_seconds", "Run time of finished jobs.", ("kind",))
+job_bytes = counter("job_bytes_total", "Bytes processed by jobs.", ("kind",))
+progress_streams = gauge("progress_streams", "Open progress streams, by transport.", ("transport",))
+progress_updates = counter("progress_updates_sent_total", "Progress updates pushed to clients, after coalescing.")
+
+# Auth
+password_hash_duration = histogram("password_hash_duration_seconds", "bcrypt hash/verify time, excluding queueing.",
+                                   ("operation",))
+
+# Content-addressed storage
+cas_dedup_hits = counter("cas_dedup_hits_total", "Uploads satisfied by an already stored blob.")
+cas_bytes_saved = counter("cas_dedup_bytes_saved_total", "Bytes not stored (or not transferred) thanks to dedup.")
+cas_blobs_collected = counter("cas_blobs_collected_total", "Unreferenced blobs removed by garbage collection.")
+cas_scrub_bytes = counter("cas_scrub_bytes_total", "Blob bytes re-verified by the scrubber.")
+cas_corrupt_blobs = counter("cas_corrupt_blobs_total", "Blobs that failed verification and were quarantined.")
+
+# Storage pool
+storage_migrations = counter("storage_migrations_total", "Files moved between volumes, by reason.", ("reason",))
+storage_migrated_bytes = counter("storage_migrated_bytes_total", "Bytes moved between volumes, by reason.",
+                                 ("reason",))
+
+# Database
+db_query_duration = histogram("db_query_duration_seconds", "SQL statement execution time.", ("engine",))
+
+
+def instrument_engine(engine, label):
+    """Time every statement executed on a (sync) SQLAlchemy engine."""
+    from sqlalchemy import event
+
+    def before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    def after(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["query_started"].pop()
+        db_query_duration.observe(time.perf_counter() - started, engine=label)
+
+    def failed(context):
+        # A failed statement never reaches after_cursor_execute; drop its start time
+        pending = context.connection.info.get("query_started") if context.connection is not None else None
+        if pending:
+            pending.pop()
+
+    event.listen(engine, "before_cursor_execute", before)
+    event.listen(engine, "after_cursor_execute", after)
+    event.listen(engine, "handle_error", failed)
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording latency, status, body bytes and in-flight count per route.
+
+    Routes are labelled by their template (/files/download/{filename:path})
+    rather than the raw path, so label cardinality stays bounded.
+    Written as plain ASGI so streamed responses pass through untouched.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        started = time.perf_counter()
+        status = 500
+        bytes_in = 0
+        bytes_out = 0
+
+        async def counting_receive():
+            nonlocal bytes_in
+            message = await receive()
+            if message["type"] == "http.request":
+                bytes_in += len(message.get("body", b""))
+            return message
+
+        async def counting_send(message):
+            nonlocal status, bytes_out
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                bytes_out += len(message.get("body", b""))
+            await send(message)
+
+        http_in_flight.inc()
+        try:
+            await self.app(scope, counting_receive, counting_send)
+        finally:
+            http_in_flight.dec()
+            route = scope.get("route")
+            route = getattr(route, "path_format", None) or "unmatched"
+            http_requests.inc(method=method, route=route, status=status)
+            http_request_duration.observe(time.perf_counter() - started, method=method, route=route)
+            if bytes_in:
+                http_request_bytes.inc(bytes_in, method=method, route=route)
+            if bytes_out:
+                http_response_bytes.inc(bytes_out, method=method, route=route)
@@ -0,0 +1,123 @@
+import asyncio
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Progress updates (one dict per job, or per upload):
+#   {"job_id": ..., "kind": "zip" | "copy" | "batch" | "upload", "status": ...,
+#    "progress": 0-100, "bytes_done": int, "bytes_total": int, ...}
+# Uploads use their upload_id as job_id.
+
+# A stream sends at most one batch of updates per interval; updates in between are coalesced per job
+PUSH_INTERVAL_SECONDS = float(os.environ.get("PROGRESS_PUSH_INTERVAL", "0.5"))
+# Idle streams send a comment this often, so proxies do not close them and dead clients are noticed
+KEEPALIVE_SECONDS = 15
+CHANNEL = "progress"
+TERMINAL_STATUSES = ("complete", "error", "cancelled", "expired")
+
+
+def percent(status, bytes_done, bytes_total):
+    if status == "complete":
+        return 100
+    if bytes_total:
+        return min(99, int(bytes_done * 100 / bytes_total))
+    return 0
+
+
+class Subscription:
+    """One client's stream: the latest update of each job since its last batch."""
+
+    def __init__(self, user_id, job_ids, loop):
+        self.user_id = user_id
+        self.job_ids = job_ids
+        self.loop = loop
+        self.pending = {}
+        self.event = asyncio.Event()
+
+    def offer(self, update):
+        # Called with the hub lock held, from any thread
+        if self.job_ids is not None and update["job_id"] not in self.job_ids:
+            return
+        self.pending[update["job_id"]] = update
+        self.loop.call_soon_threadsafe(self.event.set)
+
+
+class ProgressHub:
+    """Pushes job and upload progress to the streams of the user who owns them.
+
+    Producers call publish() from any thread, as often as they like: each
+    subscription only keeps the latest update per job, and streams flush
+    at most once per interval, so a client costs one write per interval
+    however many jobs it watches and however chatty they are. With several
+    server processes, updates are forwarded through the state store to
+    streams connected elsewhere.
+    """
+
+    def __init__(self, interval=PUSH_INTERVAL_SECONDS, keepalive=KEEPALIVE_SECONDS):
+        self.interval = interval
+        self.keepalive = keepalive
+        self._subscriptions = {}
+        self._lock = threading.Lock()
+        self._store = None
+
+    def attach(self, store):
+        self._store = store
+        store.subscribe(CHANNEL, self._deliver_remote)
+
+    def publish(self, user_id, update):
+        self._deliver(user_id, update)
+        if self._store is not None:
+            try:
+                self._store.publish(CHANNEL, {"user_id": user_id, "update": update})
+            except Exception:
+                logger.exception("Failed to forward progress of %s", update.get("job_id"))
+
+    def _deliver(self, user_id, update):
+        with self._lock:
+            for subscription in self._subscriptions.get(user_id, ()):
+                subscription.offer(update)
+
+    def _deliver_remote(self, message):
+        self._deliver(message["user_id"], message["update"])
+
+    def subscribe(self, user_id, job_ids=None):
+        """Start collecting updates for user_id (only job_ids, if given); call from the event loop."""
+        subscription = Subscription(user_id, None if job_ids is None else set(job_ids), asyncio.get_running_loop())
+        with self._lock:
+            self._subscriptions.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.user_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.user_id]
+
+    async def batches(self, subscription):
+        """Yield lists of updates, rate-limited to one per interval; an empty list means keepalive."""
+        loop = asyncio.get_running_loop()
+        last_sent = 0.0
+        while True:
+            try:
+                await asyncio.wait_for(subscription.event.wait(), self.keepalive)
+            except asyncio.TimeoutError:
+                yield []
+                continue
+            delay = last_sent + self.interval - loop.time()
+            if delay > 0:
+                # Whatever arrives meanwhile replaces older updates of the same job
+                await asyncio.sleep(delay)
+            with self._lock:
+                subscription.event.clear()
+                batch = list(subscription.pending.values())
+                subscription.pending.clear()
+            last_sent = loop.time()
+            if batch:
+                yield batch
+
+
+hub = ProgressHub()
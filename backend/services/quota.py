@@ -0,0 +1,190 @@
+import os
+import sqlite3
+import stat
+import threading
+
+from fastapi import HTTPException
+
+from services import events, state, uploads
+from services.file_index import _like_escape
+
+# Bytes each user may store through uploads; 0 means unlimited
+USER_QUOTA_BYTES = int(os.environ.get("USER_QUOTA_BYTES", "0"))
+# Reservations of a process that died free themselves after this long
+RESERVATION_TTL_SECONDS = 3600
+# Chunked upload sessions hold theirs until finalized, aborted or purged
+SESSION_RESERVATION_TTL_SECONDS = uploads.SESSION_TTL_SECONDS
+# Index events are applied lazily, but never more than this many at a time are held in memory
+MAX_PENDING_EVENTS = 10000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS file_owners (
+    path TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_file_owners_user ON file_owners(user_id);
+CREATE TABLE IF NOT EXISTS user_quotas (
+    user_id INTEGER PRIMARY KEY,
+    quota_bytes INTEGER NOT NULL
+);
+"""
+
+
+def _reservation_key(user_id, session):
+    if session:
+        return f"quota-sessions:{user_id}", SESSION_RESERVATION_TTL_SECONDS
+    return f"quota-reserved:{user_id}", RESERVATION_TTL_SECONDS
+
+
+class QuotaLedger:
+    """Per-user storage accounting for files written through the API.
+
+    Uploads, delta writes and copies record which user stored which path;
+    index events keep the records current when files are deleted, moved or
+    rewritten, however that happens. Files that predate the ledger or were
+    placed on the disk directly belong to nobody and count against no quota.
+
+    reserve() checks a pending upload against the quota and holds its
+    bytes until the upload finishes, so concurrent uploads cannot overshoot
+    the quota together, in this process or any other (the reservation
+    counters live in the shared state store). Chunked upload sessions keep
+    their reservation for days, so they are counted apart from the
+    short-lived ones and expire on their own clock. The one connection is
+    only used under the lock.
+    """
+
+    def __init__(self, db_path, pool, default_quota=USER_QUOTA_BYTES):
+        self.pool = pool
+        self.default_quota = default_quota
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        self._conn.commit()
+        self._lock = threading.Lock()
+        self._pending = []
+        # Each process applies the events it produced; the ledger itself is shared
+        events.subscribe(self.handle_event, local_only=True)
+
+    def handle_event(self, event):
+        with self._lock:
+            self._pending.append(event)
+            if len(self._pending) >= MAX_PENDING_EVENTS:
+                self._apply_pending()
+
+    def _apply_pending(self):
+        # Caller holds self._lock
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        conn = self._conn
+        for event in pending:
+            path = event["path"]
+            if event["type"] == "deleted":
+                if self.pool.exists(path):
+                    # Recreated since (an overwriting copy or upload), and recorded again by whoever did it
+                    continue
+                conn.execute("DELETE FROM file_owners WHERE path = ? OR path LIKE ? ESCAPE '\\'",
+                             (path, _like_escape(path) + "/%"))
+            elif event["type"] == "moved":
+                old = event["old_path"]
+                conn.execute("DELETE FROM file_owners WHERE path = ? OR path LIKE ? ESCAPE '\\'",
+                             (path, _like_escape(path) + "/%"))
+                conn.execute(
+                    "UPDATE file_owners SET path = ? || substr(path, ?) WHERE path = ? OR path LIKE ? ESCAPE '\\'",
+                    (path, len(old) + 1, old, _like_escape(old) + "/%")
+                )
+            elif event["type"] == "modified":
+                try:
+                    size = os.stat(self.pool.locate(path)).st_size
+                except OSError:
+                    continue
+                conn.execute("UPDATE file_owners SET size = ? WHERE path = ?", (size, path))
+        conn.commit()
+
+    def quota(self, user_id):
+        with self._lock:
+            return self._quota(user_id)
+
+    def _quota(self, user_id):
+        row = self._conn.execute("SELECT quota_bytes FROM user_quotas WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else self.default_quota
+
+    def usage(self, user_id):
+        with self._lock:
+            self._apply_pending()
+            return self._usage(user_id)
+
+    def _usage(self, user_id):
+        row = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM file_owners WHERE user_id = ?",
+                                 (user_id,)).fetchone()
+        return row[0]
+
+    def reserve(self, user_id, nbytes, replacing=None, session=False):
+        """Hold nbytes for an upload or raise 507; replacing is a path the upload will overwrite.
+
+        Returns the reservation, to be passed to release() once the upload is
+        recorded or abandoned. It is a plain list, so a session can keep it
+        in its metadata.
+        """
+        with self._lock:
+            quota = self._quota(user_id)
+            if not quota:
+                return [user_id, 0, session]
+            self._apply_pending()
+            freed = 0
+            if replacing is not None:
+                row = self._conn.execute("SELECT size FROM file_owners WHERE path = ? AND user_id = ?",
+                                         (replacing, user_id)).fetchone()
+                freed = row[0] if row else 0
+            used = self._usage(user_id)
+        # Reserve first, then check: concurrent reservations always see each other's bytes
+        key, ttl = _reservation_key(user_id, session)
+        reserved = state.store.incr(key, nbytes, ttl)
+        reserved += max(state.store.get(_reservation_key(user_id, not session)[0]) or 0, 0)
+        if used - freed + reserved > quota:
+            state.store.incr(key, -nbytes, ttl)
+            raise HTTPException(
+                status_code=507,
+                detail=f"Storage quota exceeded: {used} of {quota} bytes used, upload needs {nbytes}"
+            )
+        return [user_id, nbytes, session]
+
+    def release(self, reservation):
+        user_id, nbytes, session = reservation
+        if nbytes:
+            key, ttl = _reservation_key(user_id, session)
+            state.store.incr(key, -nbytes, ttl)
+
+    def record(self, user_id, rel_path, size):
+        with self._lock:
+            # Events queued before the upload finished must not act on the new record
+            self._apply_pending()
+            self._conn.execute("INSERT OR REPLACE INTO file_owners(path, user_id, size) VALUES (?, ?, ?)",
+                               (os.path.normpath(rel_path), user_id, size))
+            self._conn.commit()
+
+    def record_tree(self, user_id, rel_path):
+        """record() every regular file at or under rel_path, as it is on disk now (copies)."""
+        rel_path = os.path.normpath(rel_path)
+        rows = []
+        if self.pool.isdir(rel_path):
+            for rel_dir, _, files in self.pool.walk(rel_path):
+                for name, full_path in files:
+                    try:
+                        st = os.lstat(full_path)
+                    except OSError:
+                        continue
+                    if stat.S_ISREG(st.st_mode):
+                        rows.append((os.path.join(rel_dir, name), user_id, st.st_size))
+        else:
+            try:
+                st = os.lstat(self.pool.locate(rel_path))
+            except OSError:
+                return
+            if stat.S_ISREG(st.st_mode):
+                rows.append((rel_path, user_id, st.st_size))
+        with self._lock:
+            self._apply_pending()
+            self._conn.executemany("INSERT OR REPLACE INTO file_owners(path, user_id, size) VALUES (?, ?, ?)", rows)
+            self._conn.commit()
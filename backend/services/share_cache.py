@@ -0,0 +1,94 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+SHARE_CACHE_TTL_SECONDS = int(os.environ.get("SHARE_CACHE_TTL", "60"))
+SHARE_CACHE_SIZE = int(os.environ.get("SHARE_CACHE_SIZE", "10000"))
+
+
+class ShareCache:
+    """Bounded, expiry-aware cache of resolved share links.
+
+    Each entry holds the link row's fields plus the stat metadata of its
+    target, so a link hammered from a group chat resolves without a query
+    or a stat. Entries never outlive min(ttl, expires_at), are dropped when
+    a link is deactivated, and are dropped when the file index reports a
+    change to the target or anything above or below it.
+    """
+
+    def __init__(self, ttl=SHARE_CACHE_TTL_SECONDS, max_size=SHARE_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()  # token -> (entry, evict_at)
+        self._tokens_by_path = {}
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        with self._lock:
+            cached = self._entries.get(token)
+            if cached is None:
+                return None
+            entry, evict_at = cached
+            if time.time() >= evict_at:
+                self._drop(token)
+                return None
+            self._entries.move_to_end(token)
+            return entry
+
+    def put(self, token, entry):
+        """Cache a resolved link; entry must contain rel_path and a naive-UTC expires_at."""
+        evict_at = time.time() + self.ttl
+        expires_at = entry.get("expires_at")
+        if expires_at is not None:
+            seconds_left = (expires_at - datetime.utcnow()).total_seconds()
+            evict_at = min(evict_at, time.time() + seconds_left)
+        with self._lock:
+            self._drop(token)
+            self._entries[token] = (entry, evict_at)
+            self._tokens_by_path.setdefault(entry["rel_path"], set()).add(token)
+            while len(self._entries) > self.max_size:
+                oldest = next(iter(self._entries))
+                self._drop(oldest)
+
+    def invalidate(self, token):
+        with self._lock:
+            self._drop(token)
+
+    def _drop(self, token):
+        cached = self._entries.pop(token, None)
+        if cached is None:
+            return
+        path = cached[0]["rel_path"]
+        tokens = self._tokens_by_path.get(path)
+        if tokens:
+            tokens.discard(token)
+            if not tokens:
+                del self._tokens_by_path[path]
+
+    def invalidate_path(self, rel_path, recursive=False):
+        """Drop links to rel_path and to any directory containing it.
+
+        With recursive=True, links to anything below rel_path go too (used
+        when a directory is deleted or renamed).
+        """
+        rel_path = os.path.normpath(rel_path)
+        with self._lock:
+            paths = [rel_path]
+            parent = os.path.dirname(rel_path)
+            while parent:
+                paths.append(parent)
+                parent = os.path.dirname(parent)
+            if recursive:
+                prefix = rel_path + os.sep
+                paths.extend(path for path in self._tokens_by_path if path.startswith(prefix))
+            for path in paths:
+                for token in list(self._tokens_by_path.get(path, ())):
+                    self._drop(token)
+
+    def handle_event(self, event):
+        recursive = event["is_dir"] and event["type"] in ("deleted", "moved")
+        self.invalidate_path(event["path"], recursive)
+        if event.get("old_path"):
+            self.invalidate_path(event["old_path"], recursive)
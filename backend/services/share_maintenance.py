@@ -0,0 +1,88 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, insert, or_, select
+
+from models.shared_link import SharedLink, SharedLinkArchive
+from services import state
+
+logger = logging.getLogger(__name__)
+
+REAPER_INTERVAL_SECONDS = int(os.environ.get("SHARE_REAPER_INTERVAL", "3600"))
+REAPER_BATCH_SIZE = int(os.environ.get("SHARE_REAPER_BATCH_SIZE", "500"))
+# Expired links stay visible (as expired) in the owner's list for this long before being purged
+EXPIRED_RETENTION_HOURS = int(os.environ.get("SHARE_EXPIRED_RETENTION_HOURS", "168"))
+ARCHIVE_REAPED_LINKS = os.environ.get("SHARE_ARCHIVE_REAPED", "true").lower() in ("1", "true", "yes")
+
+
+def ensure_indexes(engine):
+    """Create indexes added after the table existed; create_all skips existing tables."""
+    for index in SharedLink.__table__.indexes:
+        index.create(bind=engine, checkfirst=True)
+
+
+async def reap_share_links(session_factory, now=None, batch_size=REAPER_BATCH_SIZE, archive=ARCHIVE_REAPED_LINKS,
+                           stop=None):
+    """Purge deactivated links and links expired for longer than the retention window.
+
+    Rows are moved in batches (copied to shared_links_archive first when
+    archive is set) with a commit per batch, so the writer lock is never
+    held for long. Stops after the current batch once stop (an
+    asyncio.Event) is set. Returns the number of rows removed.
+    """
+    now = now or datetime.utcnow()
+    cutoff = now - timedelta(hours=EXPIRED_RETENTION_HOURS)
+    reapable = or_(SharedLink.is_active == False, SharedLink.expires_at < cutoff)
+    removed = 0
+
+    while stop is None or not stop.is_set():
+        async with session_factory() as db:
+            links = (await db.execute(
+                select(SharedLink).where(reapable).limit(batch_size)
+            )).scalars().all()
+            if not links:
+                break
+
+            if archive:
+                await db.execute(insert(SharedLinkArchive), [
+                    {
+                        "token": link.token,
+                        "file_path": link.file_path,
+                        "created_at": link.created_at,
+                        "expires_at": link.expires_at,
+                        "user_id": link.user_id,
+                        "is_active": link.is_active,
+                        "archived_at": now
+                    }
+                    for link in links
+                ])
+            await db.execute(delete(SharedLink).where(SharedLink.id.in_([link.id for link in links])))
+            await db.commit()
+            removed += len(links)
+
+        # Let request handlers in between batches
+        await asyncio.sleep(0)
+
+    return removed
+
+
+async def run_share_reaper(session_factory, stop, interval=REAPER_INTERVAL_SECONDS):
+    """Reap every interval on the leader until stop is set.
+
+    Shutdown sets stop and awaits this instead of cancelling it, so a pass
+    ends between batches, never inside a transaction.
+    """
+    while not stop.is_set():
+        if state.is_leader():
+            try:
+                removed = await reap_share_links(session_factory, stop=stop)
+                if removed:
+                    logger.info("Reaped %d share links", removed)
+            except Exception:
+                logger.exception("Error reaping share links")
+        try:
+            await asyncio.wait_for(stop.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
@@ -0,0 +1,398 @@
+"""Runtime state shared between server processes.
+
+With one uvicorn worker (the default) everything stays in process. With
+several (WEB_CONCURRENCY > 1, or --workers), the processes coordinate
+through a store:
+
+- sqlite: a small database file on the local disk; works for any number
+  of workers on one host.
+- redis: any Redis-compatible server; needs the optional redis package
+  and REDIS_URL, and also works across hosts that share RAID_DIR.
+
+The store carries cross-process messages (file events for cache
+invalidation, job wake-ups), counters such as quota reservations, and the
+lease that elects one process as leader for singleton work: building the
+file index, watching the disk, and periodic maintenance.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", "1"))
+STATE_BACKEND = os.environ.get("STATE_BACKEND") or ("sqlite" if WEB_CONCURRENCY > 1 else "local")
+STATE_DB_PATH = os.environ.get("STATE_DB_PATH", "./cloud_drive_state.db")
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+STATE_POLL_INTERVAL = float(os.environ.get("STATE_POLL_INTERVAL", "0.2"))
+# Messages are only for processes that are running; late joiners do not need old ones
+MESSAGE_RETENTION_SECONDS = 60
+LEADER_LEASE_SECONDS = int(os.environ.get("LEADER_LEASE_SECONDS", "15"))
+
+# Identifies this process as a message origin and lease owner
+PROCESS_ID = uuid.uuid4().hex
+
+
+class StateStore:
+    """In-process store: the single-worker default. Messages have nobody else to reach."""
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+        self._handlers = {}
+
+    def start(self):
+        pass
+
+    def close(self):
+        pass
+
+    def _live(self, key, now):
+        value, expires_at = self._values.get(key, (None, None))
+        if expires_at is not None and expires_at <= now:
+            self._values.pop(key, None)
+            return None
+        return value
+
+    def get(self, key):
+        with self._lock:
+            return self._live(key, time.time())
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._values[key] = (value, time.time() + ttl if ttl else None)
+
+    def delete(self, key):
+        with self._lock:
+            self._values.pop(key, None)
+
+    def incr(self, key, amount=1, ttl=None):
+        """Add amount to an integer counter and return the new value; ttl restarts on every change."""
+        with self._lock:
+            value = (self._live(key, time.time()) or 0) + amount
+            self._values[key] = (value, time.time() + ttl if ttl else None)
+            return value
+
+    def acquire(self, name, owner, ttl):
+        """Take or renew a lease; True if owner holds it afterwards."""
+        with self._lock:
+            holder = self._live(f"lease:{name}", time.time())
+            if holder not in (None, owner):
+                return False
+            self._values[f"lease:{name}"] = (owner, time.time() + ttl)
+            return True
+
+    def release(self, name, owner):
+        with self._lock:
+            if self._live(f"lease:{name}", time.time()) == owner:
+                self._values.pop(f"lease:{name}", None)
+
+    def publish(self, channel, message):
+        """Send a JSON-serialisable message to the other processes subscribed to channel."""
+
+    def subscribe(self, channel, handler):
+        """Call handler(message) for messages other processes publish on channel."""
+        self._handlers.setdefault(channel, []).append(handler)
+
+    def _dispatch(self, channel, message):
+        for handler in self._handlers.get(channel, ()):
+            try:
+                handler(message)
+            except Exception:
+                logger.exception("Error handling %s message", channel)
+
+
+class SQLiteStateStore(StateStore):
+    """Store in a SQLite file shared by the workers of one host; messages are polled."""
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS kv (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL,
+        expires_at REAL
+    );
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        channel TEXT NOT NULL,
+        origin TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        created_at REAL NOT NULL
+    );
+    """
+
+    def __init__(self, path=STATE_DB_PATH, poll_interval=STATE_POLL_INTERVAL):
+        super().__init__()
+        self.path = path
+        self.poll_interval = poll_interval
+        self._local = threading.local()
+        self._stop = threading.Event()
+        self._thread = None
+        conn = self._connect()
+        conn.executescript(self.SCHEMA)
+        conn.commit()
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # Autocommit; multi-statement updates take the write lock up front with BEGIN IMMEDIATE
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _transaction(self, func):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = func(conn, time.time())
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return result
+
+    @staticmethod
+    def _read(conn, key, now):
+        row = conn.execute("SELECT value, expires_at FROM kv WHERE key = ?", (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] <= now):
+            return None
+        return json.loads(row[0])
+
+    @staticmethod
+    def _write(conn, key, value, expires_at):
+        conn.execute("INSERT OR REPLACE INTO kv(key, value, expires_at) VALUES (?, ?, ?)",
+                     (key, json.dumps(value), expires_at))
+
+    def get(self, key):
+        return self._read(self._connect(), key, time.time())
+
+    def set(self, key, value, ttl=None):
+        self._write(self._connect(), key, value, time.time() + ttl if ttl else None)
+
+    def delete(self, key):
+        self._connect().execute("DELETE FROM kv WHERE key = ?", (key,))
+
+    def incr(self, key, amount=1, ttl=None):
+        def update(conn, now):
+            value = (self._read(conn, key, now) or 0) + amount
+            self._write(conn, key, value, now + ttl if ttl else None)
+            return value
+        return self._transaction(update)
+
+    def acquire(self, name, owner, ttl):
+        def update(conn, now):
+            holder = self._read(conn, f"lease:{name}", now)
+            if holder not in (None, owner):
+                return False
+            self._write(conn, f"lease:{name}", owner, now + ttl)
+            return True
+        return self._transaction(update)
+
+    def release(self, name, owner):
+        def update(conn, now):
+            if self._read(conn, f"lease:{name}", now) == owner:
+                conn.execute("DELETE FROM kv WHERE key = ?", (f"lease:{name}",))
+        self._transaction(update)
+
+    def publish(self, channel, message):
+        self._connect().execute(
+            "INSERT INTO messages(channel, origin, payload, created_at) VALUES (?, ?, ?, ?)",
+            (channel, PROCESS_ID, json.dumps(message), time.time())
+        )
+
+    def start(self):
+        self._thread = threading.Thread(target=self._listen, name="state-listener", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    def _listen(self):
+        conn = self._connect()
+        last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+        next_prune = 0.0
+        while not self._stop.wait(self.poll_interval):
+            try:
+                rows = conn.execute(
+                    "SELECT id, channel, origin, payload FROM messages WHERE id > ? ORDER BY id", (last_id,)
+                ).fetchall()
+                for message_id, channel, origin, payload in rows:
+                    last_id = message_id
+                    if origin != PROCESS_ID:
+                        self._dispatch(channel, json.loads(payload))
+                if time.monotonic() >= next_prune:
+                    next_prune = time.monotonic() + MESSAGE_RETENTION_SECONDS
+                    now = time.time()
+                    conn.execute("DELETE FROM messages WHERE created_at < ?", (now - MESSAGE_RETENTION_SECONDS,))
+                    conn.execute("DELETE FROM kv WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,))
+            except sqlite3.Error:
+                logger.exception("Error reading shared state messages")
+
+
+class RedisStateStore(StateStore):
+    """Store on a Redis-compatible server; messages use Redis pub/sub."""
+
+    # Renew only our own lease, take it only if free: one round trip, atomic on the server
+    ACQUIRE_SCRIPT = """
+    local holder = redis.call('GET', KEYS[1])
+    if holder == false or holder == ARGV[1] then
+        redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+        return 1
+    end
+    return 0
+    """
+    RELEASE_SCRIPT = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('DEL', KEYS[1])
+    end
+    return 0
+    """
+    PREFIX = "cloud_drive:"
+
+    def __init__(self, url=REDIS_URL):
+        super().__init__()
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("STATE_BACKEND=redis needs the redis package (pip install redis)")
+        self._redis = redis.Redis.from_url(url, decode_responses=True)
+        self._acquire = self._redis.register_script(self.ACQUIRE_SCRIPT)
+        self._release = self._redis.register_script(self.RELEASE_SCRIPT)
+        self._pubsub = None
+        self._thread = None
+
+    def get(self, key):
+        value = self._redis.get(self.PREFIX + key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl=None):
+        self._redis.set(self.PREFIX + key, json.dumps(value), px=int(ttl * 1000) if ttl else None)
+
+    def delete(self, key):
+        self._redis.delete(self.PREFIX + key)
+
+    def incr(self, key, amount=1, ttl=None):
+        pipe = self._redis.pipeline()
+        pipe.incrby(self.PREFIX + key, amount)
+        if ttl:
+            pipe.pexpire(self.PREFIX + key, int(ttl * 1000))
+        return pipe.execute()[0]
+
+    def acquire(self, name, owner, ttl):
+        return bool(self._acquire(keys=[f"{self.PREFIX}lease:{name}"], args=[owner, int(ttl * 1000)]))
+
+    def release(self, name, owner):
+        self._release(keys=[f"{self.PREFIX}lease:{name}"], args=[owner])
+
+    def publish(self, channel, message):
+        self._redis.publish(self.PREFIX + channel, json.dumps({"origin": PROCESS_ID, "payload": message}))
+
+    def subscribe(self, channel, handler):
+        super().subscribe(channel, handler)
+        if self._pubsub is not None:
+            self._pubsub.subscribe(**{self.PREFIX + channel: self._on_message})
+
+    def start(self):
+        if not self._handlers:
+            return
+        self._pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.subscribe(**{self.PREFIX + channel: self._on_message for channel in self._handlers})
+        self._thread = self._pubsub.run_in_thread(sleep_time=1.0, daemon=True)
+
+    def _on_message(self, raw):
+        message = json.loads(raw["data"])
+        if message["origin"] != PROCESS_ID:
+            self._dispatch(raw["channel"][len(self.PREFIX):], message["payload"])
+
+    def close(self):
+        if self._thread is not None:
+            self._thread.stop()
+        if self._pubsub is not None:
+            self._pubsub.close()
+
+
+def create_store(backend=STATE_BACKEND):
+    if backend == "local":
+        return StateStore()
+    if backend == "sqlite":
+        return SQLiteStateStore()
+    if backend == "redis":
+        return RedisStateStore()
+    raise ValueError(f"Unknown STATE_BACKEND: {backend}")
+
+
+class Leadership:
+    """Keeps one process in charge of singleton work through a renewed lease.
+
+    Every process campaigns; the winner runs on_elected once and renews
+    the lease every third of its lifetime. If a leader dies its lease runs
+    out and another process takes over. A leader that fails to renew in
+    time (stalled, or the store unreachable) steps down and runs on_demoted,
+    so two processes never keep doing leader work side by side; it keeps
+    campaigning, and runs on_elected again if it wins the lease back.
+    """
+
+    def __init__(self, store, name="leader", ttl=LEADER_LEASE_SECONDS):
+        self.store = store
+        self.name = name
+        self.ttl = ttl
+        self.is_leader = False
+        self._stop = threading.Event()
+        self._thread = None
+        self._on_elected = None
+        self._on_demoted = None
+
+    def start(self, on_elected, on_demoted=None):
+        """Campaign once synchronously (a single worker is leader before this returns), then keep trying."""
+        self._on_elected = on_elected
+        self._on_demoted = on_demoted
+        self._campaign()
+        self._thread = threading.Thread(target=self._run, name="leader-election", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+        if self.is_leader:
+            self.is_leader = False
+            # Hand over now instead of making the others wait for the lease to run out
+            try:
+                self.store.release(self.name, PROCESS_ID)
+            except Exception:
+                logger.exception("Failed to release the leader lease")
+
+    def _campaign(self):
+        try:
+            held = self.store.acquire(self.name, PROCESS_ID, self.ttl)
+        except Exception:
+            logger.exception("Leader election failed")
+            held = False
+        if held and not self.is_leader:
+            self.is_leader = True
+            logger.info("This process (%s) is now the leader", PROCESS_ID)
+            self._on_elected()
+        elif not held and self.is_leader:
+            self.is_leader = False
+            logger.error("Lost the leader lease; stepping down")
+            if self._on_demoted:
+                self._on_demoted()
+
+    def _run(self):
+        while not self._stop.wait(self.ttl / 3):
+            self._campaign()
+
+
+store = create_store()
+leadership = Leadership(store)
+
+
+def is_leader():
+    return leadership.is_leader
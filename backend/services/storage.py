@@ -0,0 +1,629 @@
+"""Several storage volumes presented as one tree.
+
+RAID_DIR is the primary volume; STORAGE_VOLUMES adds more as a comma
+separated list of paths, each optionally suffixed with ":hot" or ":cold":
+
+    STORAGE_VOLUMES=/mnt/ssd:hot,/mnt/disk2,/mnt/disk3
+
+Every volume holds the same directory tree, created lazily: a directory
+exists on whichever volumes hold something inside it, and listings merge
+the copies. Each file lives on exactly one volume. New files go where the
+placement policy says; overwrites stay where the file already is, and
+moves and renames stay on the file's volume, so they remain renames.
+
+Hot volumes (SSDs) take new files first, plus the files read most often;
+the rebalancer demotes what has gone cold when the hot tier fills up and
+evens out the fill level of the volumes within a tier.
+"""
+import errno
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import stat
+import threading
+import time
+import uuid
+
+from fastapi import HTTPException
+
+from services import metrics, state
+from services.file_index import is_hidden
+from services.fileops import copy_file
+
+logger = logging.getLogger(__name__)
+
+VOLUMES = os.environ.get("STORAGE_VOLUMES", "")
+PRIMARY_TIER = os.environ.get("STORAGE_PRIMARY_TIER", "cold")
+TIERS = ("hot", "cold")
+# mfs: most free space; ff: first volume, in order, with room; hash: spread by path, stable across restarts
+PLACEMENT_POLICY = os.environ.get("STORAGE_PLACEMENT", "mfs").lower()
+# A volume with less free space than this takes no new files
+MIN_FREE_BYTES = int(os.environ.get("STORAGE_MIN_FREE_BYTES", str(1024 ** 3)))
+
+REBALANCE_INTERVAL_SECONDS = int(os.environ.get("STORAGE_REBALANCE_INTERVAL", "3600"))
+# Volumes of one tier whose fill levels differ by more than this are evened out
+REBALANCE_THRESHOLD = float(os.environ.get("STORAGE_REBALANCE_THRESHOLD", "0.1"))
+# Bytes moved per volume per pass, so one pass does not keep the disks busy for hours
+REBALANCE_MAX_BYTES = int(os.environ.get("STORAGE_REBALANCE_MAX_BYTES", str(50 * 1024 ** 3)))
+# Reads within one window that promote a file to the hot tier
+TIER_PROMOTE_HITS = int(os.environ.get("STORAGE_TIER_PROMOTE_HITS", "3"))
+TIER_WINDOW_SECONDS = int(os.environ.get("STORAGE_TIER_WINDOW", str(24 * 3600)))
+# Above the high watermark the hot tier is demoted down to the low one; promotions stop at the low one
+HOT_HIGH_WATERMARK = float(os.environ.get("STORAGE_HOT_HIGH_WATERMARK", "0.85"))
+HOT_LOW_WATERMARK = float(os.environ.get("STORAGE_HOT_LOW_WATERMARK", "0.7"))
+MAX_PROMOTIONS_PER_PASS = 1000
+ACCESS_FLUSH_SECONDS = 30
+# Read counts of files nobody has read for this long are dropped
+ACCESS_RETENTION_SECONDS = 30 * 24 * 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS file_access (
+    path TEXT PRIMARY KEY,
+    hits INTEGER NOT NULL,
+    window_start REAL NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_file_access_hits ON file_access(hits);
+"""
+
+
+def _clean(rel_path):
+    rel_path = os.path.normpath(rel_path or "")
+    return "" if rel_path == "." else rel_path
+
+
+class Volume:
+    def __init__(self, path, tier=PRIMARY_TIER):
+        if tier not in TIERS:
+            raise ValueError(f"Unknown storage tier: {tier}")
+        self.path = path
+        self.tier = tier
+
+    def usage(self):
+        return shutil.disk_usage(self.path)
+
+    def device(self):
+        return os.stat(self.path).st_dev
+
+
+def _fill(usage):
+    return usage.used / usage.total if usage.total else 1.0
+
+
+def volumes_from_env(primary, spec=VOLUMES):
+    """The primary volume followed by the ones listed in spec ("path[:tier],...")."""
+    volumes = [Volume(primary)]
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        path, _, tier = item.rpartition(":")
+        if not path or tier not in TIERS:
+            path, tier = item, "cold"
+        volumes.append(Volume(path, tier))
+    return volumes
+
+
+def walk(tops):
+    """os.walk over several copies of one tree at once.
+
+    Yields (rel_dir, dirs, files) with rel_dir relative to the tops ("" first)
+    and files as (name, full_path) pairs; where copies share a name, the
+    first top wins. Prune dirs in place as with os.walk. Symlinked
+    directories are listed but not entered.
+    """
+    if len(tops) == 1:
+        top = tops[0]
+        for dirpath, dirs, files in os.walk(top):
+            rel_dir = os.path.relpath(dirpath, top)
+            yield "" if rel_dir == "." else rel_dir, dirs, [(name, os.path.join(dirpath, name)) for name in files]
+        return
+
+    pending = [""]
+    while pending:
+        rel_dir = pending.pop()
+        dirs, files, links, seen = [], [], set(), set()
+        listed = False
+        for top in tops:
+            try:
+                with os.scandir(os.path.join(top, rel_dir) if rel_dir else top) as entries:
+                    listed = True
+                    for entry in entries:
+                        if entry.name in seen:
+                            continue
+                        seen.add(entry.name)
+                        try:
+                            is_dir = entry.is_dir()
+                        except OSError:
+                            is_dir = False
+                        if is_dir:
+                            dirs.append(entry.name)
+                            if entry.is_symlink():
+                                links.add(entry.name)
+                        else:
+                            files.append((entry.name, entry.path))
+            except OSError:
+                continue
+        if not listed:
+            continue
+        yield rel_dir, dirs, files
+        pending.extend(os.path.join(rel_dir, d) if rel_dir else d for d in reversed(dirs) if d not in links)
+
+
+class StoragePool:
+    """The volumes as one tree of relative paths; see the module docstring.
+
+    With a single volume every method reduces to the plain os call on
+    root, so the default setup pays nothing for the pool.
+    """
+
+    def __init__(self, volumes, db_path=None, policy=PLACEMENT_POLICY, min_free=MIN_FREE_BYTES):
+        if policy not in ("mfs", "ff", "hash"):
+            raise ValueError(f"Unknown placement policy: {policy}")
+        self.volumes = list(volumes)
+        self.root = self.volumes[0].path
+        self.single = len(self.volumes) == 1
+        self.tiered = {volume.tier for volume in self.volumes} == set(TIERS)
+        self.policy = policy
+        self.min_free = min_free
+        self.tracker = AccessTracker(db_path) if db_path and not self.single else None
+
+    def full_paths(self, rel_path):
+        rel_path = _clean(rel_path)
+        return [os.path.join(volume.path, rel_path) if rel_path else volume.path for volume in self.volumes]
+
+    def locations(self, rel_path):
+        """Existing copies of rel_path: one for a file, one per volume holding a directory."""
+        return [path for path in self.full_paths(rel_path) if os.path.lexists(path)]
+
+    def locate(self, rel_path):
+        """Full path of rel_path, or where it would be on the primary volume if it exists nowhere."""
+        paths = self.full_paths(rel_path)
+        if not self.single:
+            for path in paths:
+                if os.path.lexists(path):
+                    return path
+        return paths[0]
+
+    def dir_copies(self, rel_dir):
+        return [path for path in self.full_paths(rel_dir) if os.path.isdir(path)]
+
+    def isdir(self, rel_path):
+        return any(os.path.isdir(path) for path in self.full_paths(rel_path))
+
+    def exists(self, rel_path):
+        return any(os.path.exists(path) for path in self.full_paths(rel_path))
+
+    def stat(self, rel_path):
+        """os.stat() of rel_path; a directory reports the newest mtime among its copies."""
+        paths = self.full_paths(rel_path)
+        if self.single:
+            return os.stat(paths[0])
+        copies = []
+        for path in paths:
+            try:
+                stat_result = os.stat(path)
+            except OSError:
+                continue
+            if not stat.S_ISDIR(stat_result.st_mode):
+                if not copies:
+                    return stat_result
+                continue
+            copies.append(stat_result)
+        if not copies:
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), paths[0])
+        return max(copies, key=lambda stat_result: stat_result.st_mtime_ns)
+
+    def volume_of(self, full_path):
+        best = None
+        for volume in self.volumes:
+            if full_path == volume.path or full_path.startswith(volume.path + os.sep):
+                if best is None or len(volume.path) > len(best.path):
+                    best = volume
+        return best
+
+    def relpath(self, full_path):
+        volume = self.volume_of(full_path)
+        rel_path = os.path.relpath(full_path, volume.path if volume else self.root)
+        return "" if rel_path == "." else rel_path
+
+    def scandir(self, rel_dir):
+        """DirEntry objects for rel_dir's children on every volume; the first volume wins a name."""
+        paths = self.full_paths(rel_dir)
+        if self.single:
+            with os.scandir(paths[0]) as entries:
+                return list(entries)
+        merged, seen = [], set()
+        listed = False
+        for path in paths:
+            try:
+                with os.scandir(path) as entries:
+                    listed = True
+                    for entry in entries:
+                        if entry.name not in seen:
+                            seen.add(entry.name)
+                            merged.append(entry)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+        if not listed:
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), paths[0])
+        return merged
+
+    def walk(self, rel_top=""):
+        """walk() over every copy of rel_top, with rel_dir relative to the pool instead."""
+        rel_top = _clean(rel_top)
+        tops = self.full_paths(rel_top)[:1] if self.single else self.dir_copies(rel_top)
+        if not tops:
+            return
+        for rel_dir, dirs, files in walk(tops):
+            if rel_top:
+                rel_dir = os.path.join(rel_top, rel_dir) if rel_dir else rel_top
+            yield rel_dir, dirs, files
+
+    def place(self, rel_path, size=0):
+        """Full path to write rel_path to, with its parent directory created.
+
+        An existing file is rewritten where it is; a new one goes to the
+        volume the placement policy picks for size bytes.
+        """
+        rel_path = _clean(rel_path)
+        paths = self.full_paths(rel_path)
+        if self.single:
+            full_path = paths[0]
+        else:
+            full_path = next((path for path in paths if os.path.lexists(path)), None)
+            if full_path is None:
+                full_path = os.path.join(self.choose(rel_path, size).path, rel_path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        return full_path
+
+    def choose(self, rel_path, size=0):
+        """Volume for a new file of size bytes: a hot one while the hot tier has room, else by policy."""
+        usable = []
+        for volume in self.volumes:
+            try:
+                usage = volume.usage()
+            except OSError:
+                continue
+            if usage.free - size >= self.min_free:
+                usable.append((volume, usage))
+        if not usable:
+            raise HTTPException(status_code=507, detail="No storage volume has room for this file")
+
+        hot = [(v, u) for v, u in usable if v.tier == "hot" and (u.used + size) / u.total <= HOT_HIGH_WATERMARK]
+        cold = [(v, u) for v, u in usable if v.tier != "hot"]
+        candidates = hot or cold or usable
+        if self.policy == "ff":
+            return candidates[0][0]
+        if self.policy == "hash":
+            # Rendezvous hashing: adding a volume only re-homes the paths that now prefer it
+            return max(candidates, key=lambda c: hashlib.blake2b(
+                f"{c[0].path}\0{rel_path}".encode(), digest_size=8).digest())[0]
+        return max(candidates, key=lambda c: c[1].free)[0]
+
+    def usage(self):
+        """Capacity of each volume and of the pool; volumes sharing a filesystem are counted once."""
+        volumes, devices = [], set()
+        total = used = free = 0
+        for volume in self.volumes:
+            usage = volume.usage()
+            volumes.append({"path": volume.path, "tier": volume.tier, "total_bytes": usage.total,
+                            "used_bytes": usage.used, "free_bytes": usage.free})
+            device = volume.device()
+            if device in devices:
+                continue
+            devices.add(device)
+            total += usage.total
+            used += usage.used
+            free += usage.free
+        return {"total_bytes": total, "used_bytes": used, "free_bytes": free, "volumes": volumes}
+
+    def record_access(self, rel_path):
+        if self.tracker is not None:
+            self.tracker.record(_clean(rel_path))
+
+
+class AccessTracker:
+    """Read counts per file, for tier placement.
+
+    Reads are counted in memory and written to the index database every
+    ACCESS_FLUSH_SECONDS, so a download costs a dict update. Counts are
+    per window: the first read after a window has passed starts a new one.
+    """
+
+    def __init__(self, db_path, window=TIER_WINDOW_SECONDS):
+        self.window = window
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        self._conn.commit()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+
+    def record(self, rel_path):
+        now = time.time()
+        with self._lock:
+            hits = self._pending.get(rel_path, (0, now))[0]
+            self._pending[rel_path] = (hits + 1, now)
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        now = time.time()
+        expired = now - self.window
+        with self._db_lock:
+            self._conn.executemany(
+                """INSERT INTO file_access(path, hits, window_start, last_access) VALUES (?, ?, ?, ?)
+                   ON CONFLICT(path) DO UPDATE SET
+                       hits = CASE WHEN window_start < ? THEN excluded.hits ELSE hits + excluded.hits END,
+                       window_start = CASE WHEN window_start < ? THEN excluded.window_start ELSE window_start END,
+                       last_access = MAX(last_access, excluded.last_access)""",
+                [(path, hits, now, last, expired, expired) for path, (hits, last) in pending.items()]
+            )
+            self._conn.commit()
+
+    def hot(self, min_hits, limit=MAX_PROMOTIONS_PER_PASS):
+        """Paths read at least min_hits times in their current window, most read first."""
+        with self._db_lock:
+            rows = self._conn.execute(
+                "SELECT path FROM file_access WHERE hits >= ? AND window_start >= ? ORDER BY hits DESC LIMIT ?",
+                (min_hits, time.time() - self.window, limit)
+            ).fetchall()
+        return [path for (path,) in rows]
+
+    def last_access(self, rel_paths):
+        result = {}
+        rel_paths = list(rel_paths)
+        with self._db_lock:
+            for i in range(0, len(rel_paths), 500):
+                chunk = rel_paths[i:i + 500]
+                result.update(self._conn.execute(
+                    f"SELECT path, last_access FROM file_access WHERE path IN ({','.join('?' * len(chunk))})", chunk
+                ))
+        return result
+
+    def prune(self, retention=ACCESS_RETENTION_SECONDS):
+        with self._db_lock:
+            self._conn.execute("DELETE FROM file_access WHERE last_access < ?", (time.time() - retention,))
+            self._conn.commit()
+
+
+def _signature(st):
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+class Rebalancer:
+    """Moves files between volumes in the background; passes run on the leader only.
+
+    A pass demotes the least recently read files from hot volumes above
+    HOT_HIGH_WATERMARK until they are back at HOT_LOW_WATERMARK, promotes
+    files read TIER_PROMOTE_HITS times within the window while the hot tier
+    is below HOT_LOW_WATERMARK, then moves the coldest files from the
+    fullest to the emptiest volume of each tier when their fill levels are
+    more than REBALANCE_THRESHOLD apart.
+
+    A file is copied under a hidden name next to its new location, renamed
+    into place and only then removed from the old one. Its relative path
+    never changes, so the index, shares and the change journal see nothing.
+    Files hardlinked into the blob store are left where they are.
+    """
+
+    def __init__(self, pool, interval=REBALANCE_INTERVAL_SECONDS):
+        self.pool = pool
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.pool.single:
+            return
+        self._thread = threading.Thread(target=self._run, name="storage-rebalancer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+        if self.pool.tracker is not None:
+            self.pool.tracker.flush()
+
+    def _run(self):
+        next_pass = time.monotonic() + self.interval
+        while not self._stop.wait(min(ACCESS_FLUSH_SECONDS, self.interval)):
+            # Every process counts the reads it serves
+            try:
+                self.pool.tracker.flush()
+            except Exception:
+                logger.exception("Failed to record file reads")
+            if time.monotonic() < next_pass:
+                continue
+            next_pass = time.monotonic() + self.interval
+            if not state.is_leader():
+                continue
+            try:
+                moved = self.run_once()
+            except Exception:
+                logger.exception("Storage rebalance failed")
+                continue
+            if moved:
+                logger.info("Rebalanced %d files across storage volumes", moved)
+
+    def run_once(self):
+        """One pass; returns the number of files moved."""
+        moved = 0
+        if self.pool.tiered:
+            moved += self._demote()
+            moved += self._promote()
+        for tier in TIERS:
+            moved += self._balance([volume for volume in self.pool.volumes if volume.tier == tier])
+        if self.pool.tracker is not None:
+            self.pool.tracker.prune()
+        return moved
+
+    def _files(self, volume):
+        """(rel_path, size, last_read) of the movable files on volume, least recently read first."""
+        files = []
+        for rel_dir, dirs, names in walk([volume.path]):
+            dirs[:] = [d for d in dirs if not is_hidden(d)]
+            for name, full_path in names:
+                if is_hidden(name):
+                    continue
+                try:
+                    stat_result = os.lstat(full_path)
+                except OSError:
+                    continue
+                if not stat.S_ISREG(stat_result.st_mode) or stat_result.st_nlink > 1:
+                    continue
+                files.append((os.path.join(rel_dir, name) if rel_dir else name,
+                              stat_result.st_size, stat_result.st_mtime))
+        if self.pool.tracker is not None:
+            last = self.pool.tracker.last_access(rel_path for rel_path, _, _ in files)
+            files = [(rel_path, size, max(mtime, last.get(rel_path, 0))) for rel_path, size, mtime in files]
+        files.sort(key=lambda item: item[2])
+        return files
+
+    def _target(self, volumes, size, max_fill=None):
+        best = None
+        for volume in volumes:
+            usage = volume.usage()
+            if usage.free - size < self.pool.min_free:
+                continue
+            if max_fill is not None and (usage.used + size) / usage.total > max_fill:
+                continue
+            if best is None or usage.free > best[1].free:
+                best = (volume, usage)
+        return best[0] if best else None
+
+    def _drain(self, source, targets, nbytes, reason):
+        moved = moved_bytes = 0
+        for rel_path, size, _ in self._files(source):
+            if moved_bytes >= nbytes or self._stop.is_set():
+                break
+            target = self._target(targets, size)
+            if target is None:
+                break
+            if self.migrate(rel_path, source, target, reason):
+                moved += 1
+                moved_bytes += size
+        return moved
+
+    def _demote(self):
+        hot = [volume for volume in self.pool.volumes if volume.tier == "hot"]
+        cold = [volume for volume in self.pool.volumes if volume.tier != "hot"]
+        moved = 0
+        for volume in hot:
+            usage = volume.usage()
+            if _fill(usage) > HOT_HIGH_WATERMARK:
+                moved += self._drain(volume, cold, usage.used - HOT_LOW_WATERMARK * usage.total, "demote")
+        return moved
+
+    def _promote(self):
+        if self.pool.tracker is None:
+            return 0
+        hot = [volume for volume in self.pool.volumes if volume.tier == "hot"]
+        moved = 0
+        for rel_path in self.pool.tracker.hot(TIER_PROMOTE_HITS):
+            if self._stop.is_set():
+                break
+            full_path = self.pool.locate(rel_path)
+            source = self.pool.volume_of(full_path)
+            if source is None or source.tier == "hot":
+                continue
+            try:
+                stat_result = os.lstat(full_path)
+            except OSError:
+                continue
+            if not stat.S_ISREG(stat_result.st_mode) or stat_result.st_nlink > 1:
+                continue
+            target = self._target(hot, stat_result.st_size, HOT_LOW_WATERMARK)
+            if target is not None and self.migrate(rel_path, source, target, "promote"):
+                moved += 1
+        return moved
+
+    def _balance(self, volumes):
+        distinct, devices = [], set()
+        for volume in volumes:
+            device = volume.device()
+            if device not in devices:
+                devices.add(device)
+                distinct.append((volume, volume.usage()))
+        if len(distinct) < 2:
+            return 0
+        fullest = max(distinct, key=lambda item: _fill(item[1]))
+        emptiest = min(distinct, key=lambda item: _fill(item[1]))
+        gap = _fill(fullest[1]) - _fill(emptiest[1])
+        if gap <= REBALANCE_THRESHOLD:
+            return 0
+        nbytes = min(gap / 2 * min(fullest[1].total, emptiest[1].total), REBALANCE_MAX_BYTES)
+        return self._drain(fullest[0], [emptiest[0]], nbytes, "balance")
+
+    def migrate(self, rel_path, source, target, reason="balance"):
+        """Move one file from the source volume to target; False if it changed or moved meanwhile.
+
+        The copy is linked into place on the target first, so the file never
+        disappears. The source is then renamed aside, which takes it away
+        from anyone opening it by name, and checked against the stat taken
+        before the copy; if it was written or replaced in between, the
+        target copy is removed and the source put back.
+        """
+        src = os.path.join(source.path, rel_path)
+        dest = os.path.join(target.path, rel_path)
+        try:
+            before = os.lstat(src)
+        except FileNotFoundError:
+            return False
+        if os.path.lexists(dest):
+            return False
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        tmp = os.path.join(os.path.dirname(dest), f".{os.path.basename(dest)}.{uuid.uuid4().hex}.migrate")
+        try:
+            copy_file(src, tmp)
+            shutil.copystat(src, tmp)
+            # link() refuses to replace a file created at dest meanwhile, where rename() would not
+            os.link(tmp, dest)
+            copied = os.lstat(dest)
+        except FileExistsError:
+            return False
+        finally:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+
+        aside = os.path.join(os.path.dirname(src), f".{os.path.basename(src)}.{uuid.uuid4().hex}.migrate")
+        try:
+            os.rename(src, aside)
+        except FileNotFoundError:
+            # Deleted or moved away since the copy; so is the file this would have kept
+            self._discard(dest, copied)
+            return False
+        after = os.lstat(aside)
+        if _signature(after) != _signature(before) or os.path.lexists(src):
+            # Written while it was being copied, or recreated since: the source stays; the next pass tries again
+            if self._discard(dest, copied):
+                try:
+                    os.link(aside, src)
+                except FileExistsError:
+                    # A newer file took the name in the meantime and wins
+                    pass
+            os.remove(aside)
+            return False
+        os.remove(aside)
+        metrics.storage_migrations.inc(reason=reason)
+        metrics.storage_migrated_bytes.inc(before.st_size, reason=reason)
+        logger.debug("Moved %s from %s to %s (%s)", rel_path, source.path, target.path, reason)
+        return True
+
+    @staticmethod
+    def _discard(dest, copied):
+        """Remove the copy made at dest, unless it was rewritten since (then it is the newest version and stays)."""
+        try:
+            if _signature(os.lstat(dest)) != _signature(copied):
+                return False
+            os.remove(dest)
+        except FileNotFoundError:
+            pass
+        return True
@@ -0,0 +1,231 @@
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+# Pillow is optional: without it image thumbnails are unavailable
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+FFMPEG = shutil.which("ffmpeg")
+
+SIZES = {"small": 128, "medium": 256, "large": 512}
+# Size generated ahead of time for the grid view
+PREFETCH_SIZE = os.environ.get("THUMBNAIL_PREFETCH_SIZE", "small")
+PREFETCH_MAX_PER_DIRECTORY = int(os.environ.get("THUMBNAIL_PREFETCH_MAX", "500"))
+THUMBNAIL_WORKERS = int(os.environ.get("THUMBNAIL_WORKERS", min(4, os.cpu_count() or 1)))
+THUMBNAIL_CACHE_DIR = os.environ.get("THUMBNAIL_CACHE_DIR", os.path.join(tempfile.gettempdir(), "cloud_drive_thumbnails"))
+THUMBNAIL_CACHE_MAX_BYTES = int(os.environ.get("THUMBNAIL_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+# Source files above this size are not decoded (a 2 GB TIFF would stall a worker)
+MAX_SOURCE_BYTES = int(os.environ.get("THUMBNAIL_MAX_SOURCE_BYTES", str(200 * 1024 * 1024)))
+VIDEO_TIMEOUT_SECONDS = 30
+JPEG_QUALITY = 80
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".bmp", ".webp", ".tif", ".tiff"}
+VIDEO_EXTENSIONS = {".mp4", ".mov", ".mkv", ".webm", ".avi", ".m4v"}
+
+
+def source_kind(filename):
+    """'image', 'video' or None if no available backend can render the file."""
+    ext = os.path.splitext(filename)[1].lower()
+    if ext in IMAGE_EXTENSIONS and Image is not None:
+        return "image"
+    if ext in VIDEO_EXTENSIONS and FFMPEG:
+        return "video"
+    return None
+
+
+def _render(kind, source, dest, px):
+    """Runs in a pool process: write a JPEG thumbnail of source to dest."""
+    tmp = f"{dest}.{os.getpid()}.tmp"
+    try:
+        if kind == "image":
+            with Image.open(source) as img:
+                # JPEG decoders can downscale while decoding, which is far cheaper than a full decode
+                img.draft("RGB", (px, px))
+                img = ImageOps.exif_transpose(img)
+                img.thumbnail((px, px))
+                img.convert("RGB").save(tmp, "JPEG", quality=JPEG_QUALITY, optimize=True)
+        else:
+            subprocess.run(
+                [FFMPEG, "-v", "error", "-y", "-ss", "1", "-i", source, "-frames:v", "1",
+                 "-vf", f"scale={px}:{px}:force_original_aspect_ratio=decrease", "-f", "image2", tmp],
+                check=True, timeout=VIDEO_TIMEOUT_SECONDS, stdin=subprocess.DEVNULL
+            )
+            if not os.path.exists(tmp):
+                # Clips shorter than the seek offset produce nothing; take the first frame
+                subprocess.run(
+                    [FFMPEG, "-v", "error", "-y", "-i", source, "-frames:v", "1",
+                     "-vf", f"scale={px}:{px}:force_original_aspect_ratio=decrease", "-f", "image2", tmp],
+                    check=True, timeout=VIDEO_TIMEOUT_SECONDS, stdin=subprocess.DEVNULL
+                )
+        os.replace(tmp, dest)
+        return os.path.getsize(dest)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+class ThumbnailCache:
+    """Thumbnails rendered on a bounded process pool and kept in a disk cache.
+
+    Cache files are named by a hash of (path, mtime, size, pixels), so an
+    edited file gets a new thumbnail and the stale one simply ages out.
+    The cache is bounded by total bytes and evicts least recently used
+    files first; a hit refreshes the file's atime. Concurrent requests for
+    the same thumbnail share one render.
+    """
+
+    def __init__(self, pool, cache_dir=THUMBNAIL_CACHE_DIR, max_bytes=THUMBNAIL_CACHE_MAX_BYTES,
+                 workers=THUMBNAIL_WORKERS):
+        self.pool = pool
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.workers = max(1, workers)
+        self._pool = None
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._total_bytes = None
+        self._prefetched = OrderedDict()
+        self._prefetch_slots = threading.BoundedSemaphore(self.workers * 2)
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            return self._pool
+
+    def shutdown(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def _cache_path(self, rel_path, stat_result, px):
+        key = f"{rel_path}\0{stat_result.st_mtime_ns}\0{stat_result.st_size}\0{px}"
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], f"{digest}.jpg")
+
+    def thumbnail(self, full_path, size):
+        """Start (or join) rendering a thumbnail; returns (cache_path, future).
+
+        future is None when the cache already holds the thumbnail. Raises
+        ValueError if the file type cannot be thumbnailed.
+        """
+        kind = source_kind(full_path)
+        if kind is None:
+            raise ValueError("Thumbnails are not available for this file type")
+        stat_result = os.stat(full_path)
+        if stat_result.st_size > MAX_SOURCE_BYTES and kind == "image":
+            raise ValueError("File is too large to thumbnail")
+
+        cache_path = self._cache_path(self.pool.relpath(full_path), stat_result, SIZES[size])
+        try:
+            # Recency lives in atime; mtime stays put so the thumbnail's ETag is stable
+            cached = os.stat(cache_path)
+            os.utime(cache_path, ns=(time.time_ns(), cached.st_mtime_ns))
+            return cache_path, None
+        except FileNotFoundError:
+            pass
+
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        executor = self._executor()
+        with self._lock:
+            future = self._inflight.get(cache_path)
+            if future is not None:
+                return cache_path, future
+            future = executor.submit(_render, kind, full_path, cache_path, SIZES[size])
+            self._inflight[cache_path] = future
+        future.add_done_callback(lambda f: self._rendered(cache_path, f))
+        return cache_path, future
+
+    def _rendered(self, cache_path, future):
+        with self._lock:
+            self._inflight.pop(cache_path, None)
+        if future.cancelled() or future.exception() is not None:
+            return
+        with self._lock:
+            if self._total_bytes is not None:
+                self._total_bytes += future.result()
+            over = self._total_bytes is None or self._total_bytes > self.max_bytes
+        if over:
+            # Done callbacks run on the pool's management thread; walk the cache elsewhere
+            threading.Thread(target=self.evict, name="thumbnail-evict", daemon=True).start()
+
+    def evict(self):
+        """Delete least recently used thumbnails until the cache fits in max_bytes."""
+        files = []
+        total = 0
+        for dirpath, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if not name.endswith(".jpg"):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    stat_result = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat_result.st_atime, stat_result.st_size, path))
+                total += stat_result.st_size
+
+        if total > self.max_bytes:
+            # Evict down to 90% so the next few renders do not trigger another walk
+            target = self.max_bytes * 0.9
+            files.sort()
+            for _, file_size, path in files:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                    total -= file_size
+                except FileNotFoundError:
+                    pass
+        with self._lock:
+            self._total_bytes = total
+
+    def prefetch_directory(self, full_dir, names):
+        """Queue thumbnails for a directory the first time it is listed (per directory mtime)."""
+        rel_dir = self.pool.relpath(full_dir)
+        try:
+            mtime_ns = self.pool.stat(rel_dir).st_mtime_ns
+        except OSError:
+            return
+        key = os.path.normpath(full_dir)
+        with self._lock:
+            if self._prefetched.get(key) == mtime_ns:
+                return
+            self._prefetched[key] = mtime_ns
+            self._prefetched.move_to_end(key)
+            while len(self._prefetched) > 1024:
+                self._prefetched.popitem(last=False)
+        paths = [self.pool.locate(os.path.join(rel_dir, name)) for name in names if source_kind(name)]
+        self.prefetch(paths[:PREFETCH_MAX_PER_DIRECTORY])
+
+    def prefetch(self, full_paths):
+        """Render thumbnails in the background at PREFETCH_SIZE, a few at a time."""
+        if not full_paths or PREFETCH_SIZE not in SIZES:
+            return
+        threading.Thread(target=self._prefetch, args=(full_paths,), name="thumbnail-prefetch",
+                         daemon=True).start()
+
+    def _prefetch(self, full_paths):
+        # Keep at most workers * 2 prefetch renders outstanding so on-demand requests are not starved
+        for full_path in full_paths:
+            try:
+                self._prefetch_slots.acquire()
+                _, future = self.thumbnail(full_path, PREFETCH_SIZE)
+            except Exception:
+                self._prefetch_slots.release()
+                continue
+            if future is None:
+                self._prefetch_slots.release()
+            else:
+                future.add_done_callback(lambda f: self._prefetch_slots.release())
@@ -0,0 +1,353 @@
+import errno
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+
+from fastapi import HTTPException
+
+from services import cas
+
+# Staging lives inside the storage root (the primary volume) so the final rename never crosses filesystems;
+# a file placed on another volume is copied over once at finalize
+STAGING_DIR_NAME = ".cloud_drive_uploads"
+
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+MIN_CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+SESSION_TTL_SECONDS = 7 * 24 * 3600
+# Raw uploads are written in whole multiples of the page size
+RAW_WRITE_BUFFER = int(os.environ.get("RAW_UPLOAD_BUFFER", str(4 * 1024 * 1024))) // 4096 * 4096 or 4096
+# none: leave it to the kernel; file: fsync the data before the rename; full: also fsync the directory after it
+UPLOAD_FSYNC = os.environ.get("UPLOAD_FSYNC", "file").lower()
+
+
+def staging_dir(root):
+    path = os.path.join(root, STAGING_DIR_NAME)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _meta_path(root, upload_id):
+    return os.path.join(staging_dir(root), f"{upload_id}.json")
+
+
+def _part_path(root, upload_id):
+    return os.path.join(staging_dir(root), f"{upload_id}.part")
+
+
+def _chunks_dir(root, upload_id):
+    return os.path.join(staging_dir(root), f"{upload_id}.chunks")
+
+
+def _validate_upload_id(upload_id):
+    try:
+        return str(uuid.UUID(upload_id))
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Upload not found")
+
+
+def clean_filename(filename):
+    safe_filename = os.path.basename(filename or "")
+    if not safe_filename or safe_filename in (".", ".."):
+        raise HTTPException(status_code=400, detail="Invalid filename")
+    return safe_filename
+
+
+def create_session(root, user_id, path, filename, size, chunk_size=DEFAULT_CHUNK_SIZE, sha256=None,
+                   reservation=None, on_removed=None):
+    """Reserve an upload id and preallocate the part file that chunks are written into.
+
+    reservation (a quota reservation) is kept in the session metadata until
+    the session ends. on_removed(meta) is called for every session that
+    ends, here (stale ones are purged) or in finalize_session()/abort_session().
+    """
+    if size < 0:
+        raise HTTPException(status_code=400, detail="Invalid file size")
+    if not MIN_CHUNK_SIZE <= chunk_size <= MAX_CHUNK_SIZE:
+        raise HTTPException(status_code=400, detail=f"chunk_size must be between {MIN_CHUNK_SIZE} and {MAX_CHUNK_SIZE}")
+
+    safe_filename = clean_filename(filename)
+
+    purge_stale_sessions(root, on_removed=on_removed)
+
+    upload_id = str(uuid.uuid4())
+    meta = {
+        "upload_id": upload_id,
+        "user_id": user_id,
+        "path": path,
+        "filename": safe_filename,
+        "size": size,
+        "chunk_size": chunk_size,
+        "total_chunks": max(1, -(-size // chunk_size)),
+        "sha256": sha256.lower() if sha256 else None,
+        "created_at": time.time(),
+        "reservation": reservation,
+    }
+
+    os.makedirs(_chunks_dir(root, upload_id))
+    with open(_part_path(root, upload_id), "wb") as part:
+        part.truncate(size)
+    _write_json_atomic(_meta_path(root, upload_id), meta)
+    return meta
+
+
+def load_session(root, upload_id, user_id):
+    upload_id = _validate_upload_id(upload_id)
+    try:
+        with open(_meta_path(root, upload_id)) as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    if meta["user_id"] != user_id:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return meta
+
+
+def chunk_length(meta, index):
+    if not 0 <= index < meta["total_chunks"]:
+        raise HTTPException(status_code=400, detail="Chunk index out of range")
+    start = index * meta["chunk_size"]
+    return min(meta["chunk_size"], meta["size"] - start)
+
+
+def write_chunk(root, meta, index, data, checksum):
+    """Verify a chunk against its SHA-256 and write it at its offset.
+
+    Chunks land in the shared part file with positional writes, so several
+    clients (or several streams from one client) can upload out of order.
+    """
+    if not checksum:
+        raise HTTPException(status_code=400, detail="X-Chunk-SHA256 header required")
+    expected = chunk_length(meta, index)
+    if len(data) != expected:
+        raise HTTPException(status_code=400, detail=f"Chunk {index} must be {expected} bytes, got {len(data)}")
+
+    digest = hashlib.sha256(data).hexdigest()
+    if digest != checksum.lower():
+        raise HTTPException(status_code=422, detail=f"Checksum mismatch for chunk {index}")
+
+    fd = os.open(_part_path(root, meta["upload_id"]), os.O_WRONLY)
+    try:
+        view = memoryview(data)
+        offset = index * meta["chunk_size"]
+        while view:
+            written = os.pwrite(fd, view, offset)
+            view = view[written:]
+            offset += written
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+    # The marker is only published once the bytes are durable
+    _write_text_atomic(os.path.join(_chunks_dir(root, meta["upload_id"]), str(index)), digest)
+    return digest
+
+
+def received_chunks(root, meta):
+    try:
+        names = os.listdir(_chunks_dir(root, meta["upload_id"]))
+    except FileNotFoundError:
+        return []
+    return sorted(int(name) for name in names if name.isdigit())
+
+
+def session_status(root, meta):
+    received = received_chunks(root, meta)
+    received_set = set(received)
+
+    # Contiguous offset a sequential client can resume from
+    contiguous = 0
+    while contiguous in received_set:
+        contiguous += 1
+    offset = min(contiguous * meta["chunk_size"], meta["size"])
+
+    return {
+        "upload_id": meta["upload_id"],
+        "filename": meta["filename"],
+        "path": meta["path"],
+        "size": meta["size"],
+        "chunk_size": meta["chunk_size"],
+        "total_chunks": meta["total_chunks"],
+        "received_chunks": received,
+        "missing_chunks": [i for i in range(meta["total_chunks"]) if i not in received_set],
+        "received_bytes": sum(chunk_length(meta, i) for i in received),
+        "offset": offset,
+    }
+
+
+def finalize_session(root, meta, destination_dir, blob_store=None, on_removed=None):
+    """Move the assembled part file into place with an atomic rename; returns (file_path, sha256).
+
+    With a blob store the file is hashed even without a client checksum, and
+    stored through it so identical content is kept once. A destination on
+    another volume gets the part file copied next to it first, so the rename
+    into place stays atomic there too.
+    """
+    missing = meta["total_chunks"] - len(received_chunks(root, meta))
+    if missing:
+        raise HTTPException(status_code=409, detail=f"{missing} chunks still missing")
+
+    part_path = _part_path(root, meta["upload_id"])
+    digest = None
+    if meta["sha256"] or blob_store is not None:
+        digest = cas.hash_file(part_path)
+        if meta["sha256"] and digest != meta["sha256"]:
+            raise HTTPException(status_code=422, detail="Checksum mismatch for assembled file")
+
+    os.makedirs(destination_dir, exist_ok=True)
+    file_path = os.path.join(destination_dir, meta["filename"])
+    if os.stat(part_path).st_dev != os.stat(destination_dir).st_dev:
+        moved = os.path.join(destination_dir, f".{meta['filename']}.{meta['upload_id']}.part")
+        shutil.move(part_path, moved)
+        part_path = moved
+    if blob_store is not None:
+        blob_store.adopt(part_path, digest, file_path)
+    else:
+        os.replace(part_path, file_path)
+    _remove_session_files(root, meta, on_removed)
+    return file_path, digest
+
+
+def abort_session(root, meta, on_removed=None):
+    _remove_session_files(root, meta, on_removed)
+
+
+def purge_stale_sessions(root, ttl=SESSION_TTL_SECONDS, on_removed=None):
+    cutoff = time.time() - ttl
+    directory = staging_dir(root)
+    for name in os.listdir(directory):
+        if not name.endswith(".json"):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            if os.path.getmtime(path) >= cutoff:
+                continue
+            with open(path) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            continue
+        except ValueError:
+            meta = {"upload_id": name[:-len(".json")]}
+        _remove_session_files(root, meta, on_removed)
+
+
+def _remove_session_files(root, meta, on_removed=None):
+    upload_id = meta["upload_id"]
+    try:
+        os.remove(_meta_path(root, upload_id))
+    except FileNotFoundError:
+        # Already ended by a concurrent finalize, abort or purge, which ran on_removed
+        on_removed = None
+    try:
+        os.remove(_part_path(root, upload_id))
+    except FileNotFoundError:
+        pass
+    shutil.rmtree(_chunks_dir(root, upload_id), ignore_errors=True)
+    if on_removed is not None:
+        on_removed(meta)
+
+
+class RawUpload:
+    """Writes a raw request body straight into a hidden temp file next to its destination.
+
+    The file is preallocated from Content-Length, filled with page-aligned
+    writes of RAW_WRITE_BUFFER bytes and hashed on the way, then renamed
+    into place. Nothing is spooled anywhere else first.
+    """
+
+    def __init__(self, file_path, length=None):
+        self.file_path = file_path
+        self.length = length
+        self.tmp_path = os.path.join(os.path.dirname(file_path),
+                                     f".{os.path.basename(file_path)}.{uuid.uuid4().hex}.upload")
+        self.written = 0
+        self._digest = hashlib.sha256()
+        self._buffer = bytearray()
+        self._fd = os.open(self.tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_CLOEXEC, 0o644)
+        if length:
+            try:
+                os.posix_fallocate(self._fd, 0, length)
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    self.abort()
+                    raise HTTPException(status_code=507, detail="Not enough free space for this upload")
+                # Filesystems without fallocate support still take the upload
+                if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS):
+                    self.abort()
+                    raise
+
+    def append(self, data):
+        """Buffer data; returns True when a full buffer is ready for write()."""
+        if self.length is not None and self.written + len(self._buffer) + len(data) > self.length:
+            raise HTTPException(status_code=400, detail="Body is longer than Content-Length")
+        self._buffer.extend(data)
+        return len(self._buffer) >= RAW_WRITE_BUFFER
+
+    def write(self, final=False):
+        """Write out whole buffers (and the remainder when final); runs in a worker thread."""
+        view = memoryview(self._buffer)
+        end = len(view) if final else len(view) // RAW_WRITE_BUFFER * RAW_WRITE_BUFFER
+        offset = 0
+        try:
+            while offset < end:
+                n = os.pwrite(self._fd, view[offset:end], self.written)
+                self._digest.update(view[offset:offset + n])
+                offset += n
+                self.written += n
+        finally:
+            view.release()
+        del self._buffer[:offset]
+
+    def pending(self):
+        return len(self._buffer)
+
+    def finish(self, expected_sha256=None):
+        """Flush, verify and sync the temp file; returns its sha256."""
+        self.write(final=True)
+        if self.length is not None and self.written != self.length:
+            raise HTTPException(status_code=400, detail=f"Expected {self.length} bytes, got {self.written}")
+        # Preallocation may have reserved more than arrived
+        os.ftruncate(self._fd, self.written)
+        digest = self._digest.hexdigest()
+        if expected_sha256 and digest != expected_sha256.lower():
+            raise HTTPException(status_code=422, detail="Checksum mismatch for uploaded file")
+        if UPLOAD_FSYNC in ("file", "full"):
+            os.fsync(self._fd)
+        os.close(self._fd)
+        self._fd = None
+        return digest
+
+    def commit(self, digest, blob_store=None):
+        if blob_store is not None:
+            blob_store.adopt(self.tmp_path, digest, self.file_path)
+        else:
+            os.replace(self.tmp_path, self.file_path)
+        if UPLOAD_FSYNC == "full":
+            dir_fd = os.open(os.path.dirname(self.file_path), os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+    def abort(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        try:
+            os.remove(self.tmp_path)
+        except FileNotFoundError:
+            pass
+
+
+def _write_json_atomic(path, data):
+    _write_text_atomic(path, json.dumps(data))
+
+
+def _write_text_atomic(path, text):
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
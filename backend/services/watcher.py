@@ -0,0 +1,285 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+from services import metrics
+from services.file_index import is_hidden
+
+logger = logging.getLogger(__name__)
+
+RECONCILE_INTERVAL_SECONDS = int(os.environ.get("WATCHER_RECONCILE_INTERVAL", "300"))
+# Every Nth reconciliation re-stats every file, not just directories whose mtime changed
+DEEP_RECONCILE_EVERY = int(os.environ.get("WATCHER_DEEP_RECONCILE_EVERY", "12"))
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_CLOSE_WRITE | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+              | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+class _Inotify:
+    """Minimal ctypes binding for the Linux inotify API."""
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def add_watch(self, path, mask):
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def read_events(self):
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        parsed = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            parsed.append((wd, mask, cookie, os.fsdecode(name)))
+        return parsed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FileWatcher:
+    """Keeps a FileIndex current while the server runs.
+
+    On Linux every visible directory gets an inotify watch and changes are
+    applied as they happen. A periodic reconciliation compares directory mtimes
+    with the index, which catches changes made while the server was down, on
+    filesystems inotify cannot see (NFS, SMB) and after a queue overflow.
+    Only directories whose mtime moved are re-read, so an intact index does not
+    need a full rescan at startup. With several storage volumes, each copy
+    of a directory has its own watch.
+    """
+
+    def __init__(self, index, reconcile_interval=RECONCILE_INTERVAL_SECONDS,
+                 deep_every=DEEP_RECONCILE_EVERY):
+        self.index = index
+        self.pool = index.pool
+        self.reconcile_interval = reconcile_interval
+        self.deep_every = deep_every
+        self._inotify = None
+        self._wd_to_path = {}
+        self._path_to_wd = {}
+        self._stop = threading.Event()
+        self._reconcile_requested = threading.Event()
+        self._thread = None
+        self._reconcile_count = 0
+
+    def start(self):
+        # Also after stop(): a process that lost leadership may win it back
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="file-watcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+        self._disable_inotify()
+
+    def request_reconcile(self):
+        self._reconcile_requested.set()
+
+    def _run(self):
+        self.index.wait_ready()
+        if sys.platform.startswith("linux"):
+            try:
+                self._inotify = _Inotify()
+                self._watch_tree("")
+            except OSError as e:
+                logger.warning("inotify unavailable, falling back to periodic reconciliation: %s", e)
+                self._disable_inotify()
+
+        # Watches are in place before this pass, so nothing slips between the two
+        self._reconcile()
+        next_reconcile = time.monotonic() + self.reconcile_interval
+
+        while not self._stop.is_set():
+            if self._inotify:
+                ready, _, _ = select.select([self._inotify.fd], [], [], 1.0)
+                if ready:
+                    self._handle_events(self._inotify.read_events())
+            else:
+                self._reconcile_requested.wait(1.0)
+
+            if self._reconcile_requested.is_set() or time.monotonic() >= next_reconcile:
+                self._reconcile_requested.clear()
+                self._reconcile()
+                next_reconcile = time.monotonic() + self.reconcile_interval
+
+    def _disable_inotify(self):
+        if self._inotify:
+            self._inotify.close()
+        self._inotify = None
+        self._wd_to_path.clear()
+        self._path_to_wd.clear()
+
+    def _watch_tree(self, rel_dir):
+        for rel, dirs, _ in self.pool.walk(rel_dir):
+            dirs[:] = [d for d in dirs if not is_hidden(d)]
+            self._add_watch(rel)
+
+    def _add_watch(self, rel_dir):
+        for full_path in self.pool.dir_copies(rel_dir):
+            if not self._inotify:
+                return
+            try:
+                wd = self._inotify.add_watch(full_path, WATCH_MASK)
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    # fs.inotify.max_user_watches exhausted: rely on reconciliation instead
+                    logger.warning("inotify watch limit reached, falling back to periodic reconciliation")
+                    self._disable_inotify()
+                continue
+            self._wd_to_path[wd] = rel_dir
+            self._path_to_wd.setdefault(rel_dir, set()).add(wd)
+
+    def _forget_watches(self, rel_dir):
+        prefix = rel_dir + os.sep
+        for path in [p for p in self._path_to_wd if p == rel_dir or p.startswith(prefix)]:
+            for wd in self._path_to_wd.pop(path):
+                self._wd_to_path.pop(wd, None)
+
+    def _rekey_watches(self, old_dir, new_dir):
+        prefix = old_dir + os.sep
+        for path in [p for p in self._path_to_wd if p == old_dir or p.startswith(prefix)]:
+            wds = self._path_to_wd.pop(path)
+            moved = new_dir + path[len(old_dir):]
+            self._path_to_wd.setdefault(moved, set()).update(wds)
+            for wd in wds:
+                self._wd_to_path[wd] = moved
+
+    def _handle_events(self, raw_events):
+        pending_moves = {}
+        for wd, mask, cookie, name in raw_events:
+            if mask & IN_Q_OVERFLOW:
+                self.request_reconcile()
+                continue
+            if mask & IN_IGNORED:
+                path = self._wd_to_path.pop(wd, None)
+                wds = self._path_to_wd.get(path)
+                if wds is not None:
+                    wds.discard(wd)
+                    if not wds:
+                        del self._path_to_wd[path]
+                continue
+
+            parent = self._wd_to_path.get(wd)
+            if parent is None or not name or is_hidden(name):
+                continue
+            rel_path = os.path.join(parent, name) if parent else name
+            is_dir = bool(mask & IN_ISDIR)
+
+            try:
+                if mask & IN_MOVED_FROM:
+                    pending_moves[cookie] = (rel_path, is_dir)
+                elif mask & IN_MOVED_TO:
+                    source = pending_moves.pop(cookie, None)
+                    if source:
+                        self.index.move_path(source[0], rel_path)
+                        if is_dir:
+                            self._rekey_watches(source[0], rel_path)
+                        if not self.pool.single:
+                            # Other volumes may still hold the source (a directory moved one copy at a time)
+                            self.index.upsert_path(source[0])
+                    else:
+                        self._path_created(rel_path, is_dir)
+                elif mask & IN_CREATE:
+                    self._path_created(rel_path, is_dir)
+                elif mask & IN_DELETE:
+                    self._path_removed(rel_path, is_dir)
+                elif mask & (IN_CLOSE_WRITE | IN_ATTRIB):
+                    self.index.upsert_path(rel_path)
+            except Exception:
+                logger.exception("Error applying change for %s", rel_path)
+
+        # A move whose destination is outside the watched tree is a delete
+        for rel_path, is_dir in pending_moves.values():
+            self._path_removed(rel_path, is_dir)
+
+    def _path_removed(self, rel_path, is_dir):
+        if self.pool.single:
+            self.index.remove_path(rel_path)
+        else:
+            # Gone from one volume; another may still hold it (or the file was just moved there)
+            self.index.upsert_path(rel_path)
+        if is_dir and not self.pool.isdir(rel_path):
+            self._forget_watches(rel_path)
+
+    def _path_created(self, rel_path, is_dir):
+        if is_dir:
+            # Watch first so files created inside right after mkdir are not missed
+            self._watch_tree(rel_path)
+        self.index.upsert_path(rel_path)
+
+    def _reconcile(self):
+        """Re-read directories whose mtime differs from the index (or all of them on a deep pass).
+
+        Only indexed directories are stat()ed; unchanged ones are never listed.
+        New subdirectories are discovered when their parent's mtime moves.
+        """
+        self._reconcile_count += 1
+        deep = self.deep_every > 0 and self._reconcile_count % self.deep_every == 0
+        started = time.time()
+        changes = 0
+        try:
+            indexed_mtimes = self.index.directory_mtimes()
+            indexed_mtimes.setdefault("", None)
+            # Parents first, so a removed directory is dropped before it is visited
+            for rel in sorted(indexed_mtimes, key=lambda path: (path.count(os.sep), path)):
+                try:
+                    mtime = self.pool.stat(rel).st_mtime
+                except OSError:
+                    continue
+                if deep or indexed_mtimes[rel] != mtime:
+                    for change in self.index.sync_directory(rel):
+                        changes += 1
+                        if change["is_dir"] and change["type"] == "created":
+                            self._watch_tree(change["path"])
+                if rel == "":
+                    self.index.set_root_mtime(mtime)
+        except Exception:
+            logger.exception("Error during reconciliation")
+        elapsed = time.time() - started
+        metrics.walk_duration.observe(elapsed, operation="deep_reconcile" if deep else "reconcile")
+        if changes:
+            logger.info("Reconciled %d changes in %.1fs", changes, elapsed)
@@ -0,0 +1,113 @@
+import os
+import zipfile
+from urllib.parse import quote
+
+from services import metrics
+from services.file_index import is_hidden
+from services.storage import walk
+
+READ_CHUNK_SIZE = 1024 * 1024
+
+# Formats that are already compressed; deflating them again only burns CPU
+COMPRESSED_EXTENSIONS = {
+    ".zip", ".gz", ".tgz", ".bz2", ".xz", ".zst", ".7z", ".rar",
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic", ".avif",
+    ".mp4", ".mkv", ".mov", ".avi", ".webm", ".m4v",
+    ".mp3", ".aac", ".ogg", ".opus", ".flac", ".m4a",
+    ".pdf", ".docx", ".xlsx", ".pptx", ".odt", ".apk", ".jar", ".iso",
+}
+
+
+class _StreamBuffer:
+    """Write-only sink handed to ZipFile; the generator drains it after every write.
+
+    It has no seek(), so ZipFile falls back to data descriptors and never needs
+    to go back and patch local headers.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        if self._chunks:
+            yield b"".join(self._chunks)
+            self._chunks.clear()
+
+
+def content_disposition(filename):
+    """Attachment header that survives non-ASCII folder names."""
+    return f"attachment; filename*=utf-8''{quote(filename)}"
+
+
+def _walk_visible(source_dirs):
+    """walk() of the source dirs without dot-names: upload staging, the blob store, half-written temp files."""
+    tops = [source_dirs] if isinstance(source_dirs, str) else list(source_dirs)
+    for rel_root, dirs, files in walk(tops):
+        dirs[:] = [d for d in dirs if not is_hidden(d)]
+        yield rel_root, dirs, [(name, path) for name, path in files if not is_hidden(name)]
+
+
+def tree_size(source_dirs):
+    """Total bytes of regular files under source_dirs, for progress reporting."""
+    total = 0
+    with metrics.walk_duration.time(operation="zip_tree_size"):
+        for _, _, files in _walk_visible(source_dirs):
+            for _, file_path in files:
+                try:
+                    total += os.stat(file_path).st_size
+                except OSError:
+                    pass
+    return total
+
+
+def _compress_type(path, store_compressed):
+    if store_compressed and os.path.splitext(path)[1].lower() in COMPRESSED_EXTENSIONS:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def stream_zip(source_dirs, store_compressed=True, chunk_size=READ_CHUNK_SIZE, on_read=None):
+    """Yield a ZIP archive of a directory as it is produced.
+
+    source_dirs is the directory, or its copies on several storage volumes
+    (merged into one archive); hidden entries are left out, as in listings.
+    Entries are read in chunk_size pieces, so memory stays bounded by one
+    chunk plus deflate state, and ZIP64 extensions are used for any entry
+    that may exceed 4 GiB. on_read, if given, is called with the number of
+    source bytes consumed after every read.
+    """
+    sink = _StreamBuffer()
+    with zipfile.ZipFile(sink, "w", allowZip64=True) as zf:
+        for rel_root, dirs, files in _walk_visible(source_dirs):
+            dirs.sort()
+
+            if rel_root and not files and not dirs:
+                # Keep empty directories in the archive
+                zf.writestr(zipfile.ZipInfo(rel_root.replace(os.sep, "/") + "/"), b"")
+                yield from sink.drain()
+
+            for name, file_path in sorted(files):
+                arcname = os.path.join(rel_root, name) if rel_root else name
+                try:
+                    if not os.path.isfile(file_path):
+                        continue
+                    zinfo = zipfile.ZipInfo.from_file(file_path, arcname, strict_timestamps=False)
+                    zinfo.compress_type = _compress_type(name, store_compressed)
+                    with open(file_path, "rb") as src, zf.open(zinfo, "w") as dest:
+                        for block in iter(lambda: src.read(chunk_size), b""):
+                            dest.write(block)
+                            if on_read:
+                                on_read(len(block))
+                            yield from sink.drain()
+                except (FileNotFoundError, PermissionError):
+                    # Files that vanish or are unreadable mid-walk are skipped
+                    continue
+                yield from sink.drain()
+    yield from sink.drain()
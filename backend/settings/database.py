@@ -1,11 +1,56 @@
-from sqlalchemy import create_engine
+import os
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 
-SQLALCHEMY_DATABASE_URL = 'sqlite:///./cloudapp.db'
+# sqlite:///./cloudapp.db by default; a postgresql:// URL also works
+# (needs asyncpg for request handlers and psycopg2 for background threads)
+SQLALCHEMY_DATABASE_URL = os.environ.get("DATABASE_URL", 'sqlite:///./cloudapp.db')
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={'check_same_thread': False})
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", "20"))
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+
+is_sqlite = SQLALCHEMY_DATABASE_URL.startswith("sqlite")
+
+
+def _async_url(url):
+    if url.startswith("sqlite://"):
+        return url.replace("sqlite://", "sqlite+aiosqlite://", 1)
+    if url.startswith("postgresql://") or url.startswith("postgres://"):
+        return "postgresql+asyncpg://" + url.split("://", 1)[1]
+    return url
+
+
+def _tune_sqlite(dbapi_connection, connection_record):
+    # WAL lets readers run alongside a writer; busy_timeout waits out the
+    # writer lock instead of failing with "database is locked"
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+
+engine_options = {"pool_size": DB_POOL_SIZE, "max_overflow": DB_MAX_OVERFLOW, "pool_pre_ping": not is_sqlite}
+connect_args = {'check_same_thread': False} if is_sqlite else {}
+
+# Synchronous engine: schema creation and background worker threads
+engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args=connect_args, **engine_options)
+
+# Async engine: everything that runs inside request handlers
+async_engine = create_async_engine(_async_url(SQLALCHEMY_DATABASE_URL), connect_args=connect_args, **engine_options)
+
+if is_sqlite:
+    event.listen(engine, "connect", _tune_sqlite)
+    event.listen(async_engine.sync_engine, "connect", _tune_sqlite)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
-Base = declarative_base()
\ No newline at end of file
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+Base = declarative_base()
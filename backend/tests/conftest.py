@@ -0,0 +1,57 @@
+import os
+import shutil
+import tempfile
+
+import pytest
+
+# Must run before anything imports the app: these are read at import time
+WORKDIR = tempfile.mkdtemp(prefix="cloud-drive-tests-")
+RAID_DIR = os.path.join(WORKDIR, "raid")
+os.makedirs(RAID_DIR)
+os.environ["RAID_DIR"] = RAID_DIR
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(WORKDIR, 'app.db')}"
+os.environ["FILE_INDEX_PATH"] = os.path.join(WORKDIR, "file_index.db")
+os.environ["JOB_OUTPUT_DIR"] = os.path.join(WORKDIR, "jobs")
+os.environ["THUMBNAIL_CACHE_DIR"] = os.path.join(WORKDIR, "thumbnails")
+os.environ["STATE_DB_PATH"] = os.path.join(WORKDIR, "state.db")
+os.environ["THUMBNAIL_PREFETCH_SIZE"] = "none"
+
+TEST_USER = {"email": "tester@example.com", "user_id": 1}
+
+
+@pytest.fixture(scope="session")
+def app():
+    from auth.auth import get_current_user
+    from main import app
+
+    app.dependency_overrides[get_current_user] = lambda: TEST_USER
+    yield app
+    app.dependency_overrides.pop(get_current_user, None)
+    shutil.rmtree(WORKDIR, ignore_errors=True)
+
+
+@pytest.fixture(scope="session")
+def client(app):
+    from starlette.testclient import TestClient
+
+    with TestClient(app) as client:
+        yield client
+
+
+@pytest.fixture
+def raid_dir():
+    return RAID_DIR
+
+
+@pytest.fixture
+def write_file():
+    def write(path, data, age=None):
+        """Write data to path (creating parents); age backdates its mtime by that many seconds."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+        if age:
+            st = os.stat(path)
+            os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns - int(age * 1e9)))
+        return path
+    return write
@@ -0,0 +1,64 @@
+import os
+
+import pytest
+
+DATA = bytes(range(256)) * 16
+
+
+@pytest.fixture
+def settled(raid_dir, write_file):
+    # Old enough that its ETag is strong
+    write_file(os.path.join(raid_dir, "cond", "settled.bin"), DATA, age=60)
+    return "/files/download/cond/settled.bin"
+
+
+def test_download_carries_validators_and_revalidates_to_304(client, settled):
+    response = client.get(settled)
+    assert response.status_code == 200
+    etag = response.headers["etag"]
+    assert not etag.startswith("W/")
+
+    assert client.get(settled, headers={"if-none-match": etag}).status_code == 304
+    assert client.get(settled, headers={"if-none-match": f"W/{etag}"}).status_code == 304
+    assert client.get(settled, headers={"if-modified-since": response.headers["last-modified"]}).status_code == 304
+    assert client.get(settled, headers={"if-none-match": '"other"'}).status_code == 200
+
+
+def test_if_match_with_a_different_etag_fails_with_412(client, settled):
+    etag = client.get(settled).headers["etag"]
+    assert client.get(settled, headers={"if-match": etag}).status_code == 200
+    assert client.get(settled, headers={"if-match": '"other"'}).status_code == 412
+
+
+def test_if_range_serves_the_range_only_while_the_etag_matches(client, settled):
+    etag = client.get(settled).headers["etag"]
+
+    partial = client.get(settled, headers={"range": "bytes=100-199", "if-range": etag})
+    assert partial.status_code == 206
+    assert partial.content == DATA[100:200]
+
+    stale = client.get(settled, headers={"range": "bytes=100-199", "if-range": '"other"'})
+    assert stale.status_code == 200
+    assert stale.content == DATA
+
+
+def test_a_freshly_written_file_has_a_weak_etag_that_if_range_ignores(client, raid_dir, write_file):
+    write_file(os.path.join(raid_dir, "cond", "fresh.bin"), DATA)
+    url = "/files/download/cond/fresh.bin"
+    etag = client.get(url).headers["etag"]
+    assert etag.startswith("W/")
+
+    response = client.get(url, headers={"range": "bytes=0-9", "if-range": etag})
+    assert response.status_code == 200
+    assert response.content == DATA
+
+
+def test_multiple_ranges_come_back_as_multipart_byteranges(client, settled):
+    response = client.get(settled, headers={"range": "bytes=0-9,100-109"})
+    assert response.status_code == 206
+    assert response.headers["content-type"].startswith("multipart/byteranges")
+    assert DATA[0:10] in response.content and DATA[100:110] in response.content
+
+
+def test_unsatisfiable_range_is_416(client, settled):
+    assert client.get(settled, headers={"range": f"bytes={len(DATA) + 10}-"}).status_code == 416
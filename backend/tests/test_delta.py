@@ -0,0 +1,66 @@
+import os
+
+from services import delta
+
+BASE = bytes(range(256)) * 64
+NEW = BASE[:4096] + b"inserted" + BASE[4096:]
+
+
+def _signature(client, path):
+    response = client.get(f"/files/signature/{path}", params={"block_size": 512})
+    assert response.status_code == 200
+    return response.content, response.headers["etag"]
+
+
+def test_delta_rebuilds_the_file_when_if_match_holds(client, raid_dir, write_file):
+    path = write_file(os.path.join(raid_dir, "delta", "ok.bin"), BASE, age=60)
+    signature, etag = _signature(client, "delta/ok.bin")
+
+    response = client.post("/files/delta/delta/ok.bin", content=delta.encode_delta(signature, NEW),
+                           headers={"if-match": etag})
+    assert response.status_code == 200
+    assert response.json()["literal_bytes"] < len(NEW) // 4
+    with open(path, "rb") as f:
+        assert f.read() == NEW
+
+
+def test_delta_requires_if_match(client, raid_dir, write_file):
+    write_file(os.path.join(raid_dir, "delta", "no-match.bin"), BASE, age=60)
+    signature, _ = _signature(client, "delta/no-match.bin")
+
+    response = client.post("/files/delta/delta/no-match.bin", content=delta.encode_delta(signature, NEW))
+    assert response.status_code == 428
+
+
+def test_delta_against_a_changed_file_fails_with_412(client, raid_dir, write_file):
+    path = write_file(os.path.join(raid_dir, "delta", "stale.bin"), BASE, age=60)
+    signature, etag = _signature(client, "delta/stale.bin")
+    # Someone else rewrites the file after the signature was taken
+    write_file(path, BASE[::-1], age=30)
+
+    response = client.post("/files/delta/delta/stale.bin", content=delta.encode_delta(signature, NEW),
+                           headers={"if-match": etag})
+    assert response.status_code == 412
+    with open(path, "rb") as f:
+        assert f.read() == BASE[::-1]
+    assert [name for name in os.listdir(os.path.dirname(path)) if name.startswith(".")] == []
+
+
+def test_delta_right_after_a_write_and_a_second_delta_both_apply(client, raid_dir, write_file):
+    # Written just now: the download ETag would still be weak
+    path = write_file(os.path.join(raid_dir, "delta", "fresh.bin"), BASE)
+    signature, etag = _signature(client, "delta/fresh.bin")
+    assert not etag.startswith("W/")
+
+    first = client.post("/files/delta/delta/fresh.bin", content=delta.encode_delta(signature, NEW),
+                        headers={"if-match": etag})
+    assert first.status_code == 200
+
+    # The ETag returned by the delta is good for the next one
+    newer = NEW + b"appended"
+    signature, _ = _signature(client, "delta/fresh.bin")
+    second = client.post("/files/delta/delta/fresh.bin", content=delta.encode_delta(signature, newer),
+                         headers={"if-match": first.headers["etag"]})
+    assert second.status_code == 200
+    with open(path, "rb") as f:
+        assert f.read() == newer
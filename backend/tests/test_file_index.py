@@ -0,0 +1,79 @@
+import os
+
+import pytest
+
+from services import file_index, storage
+
+
+@pytest.fixture
+def index(tmp_path, write_file):
+    root = tmp_path / "root"
+    for rel_path, data in [
+        ("reports/annual_report_2024.pdf", b"x" * 300),
+        ("reports/report.txt", b"x" * 10),
+        ("photos/holiday/beach.jpg", b"x" * 5000),
+        ("photos/100%_real.jpg", b"x" * 50),
+        ("notes.md", b"x"),
+        (".hidden/report_secret.txt", b"x"),
+    ]:
+        write_file(os.path.join(root, rel_path), data)
+    index = file_index.FileIndex(str(tmp_path / "index.db"), storage.StoragePool([storage.Volume(str(root))]))
+    index.rebuild()
+    return index
+
+
+def _names(result):
+    return [item["name"] for item in result["items"]]
+
+
+def test_substring_search_ranks_exact_names_first(index):
+    names = _names(index.search("report"))
+    assert names[0] == "reports"
+    assert set(names) == {"reports", "reports/report.txt", "reports/annual_report_2024.pdf"}
+
+
+def test_short_queries_match_name_prefixes(index):
+    assert _names(index.search("no")) == ["notes.md"]
+    assert _names(index.search("ot")) == []
+
+
+def test_like_wildcards_in_queries_match_literally(index):
+    assert _names(index.search("10")) == ["photos/100%_real.jpg"]
+    assert _names(index.search("%_")) == []
+
+
+def test_filters_narrow_the_results(index):
+    assert _names(index.search("report", type="directory")) == ["reports"]
+    assert _names(index.search("report", extensions=[".PDF"])) == ["reports/annual_report_2024.pdf"]
+    assert _names(index.search("report", type="file", min_size=100)) == ["reports/annual_report_2024.pdf"]
+    assert _names(index.search("report", type="file", max_size=100)) == ["reports/report.txt"]
+
+
+def test_results_are_paged(index):
+    first = index.search("report", limit=2)
+    rest = index.search("report", limit=2, offset=2)
+    assert first["has_more"] and not rest["has_more"]
+    assert len(_names(first) + _names(rest)) == 3
+
+
+def test_index_follows_changes_without_a_rebuild(index, write_file):
+    write_file(os.path.join(index.root, "reports", "report_q3.txt"), b"q3")
+    index.upsert_path("reports/report_q3.txt")
+    assert "reports/report_q3.txt" in _names(index.search("report_q3"))
+
+    os.rename(os.path.join(index.root, "reports"), os.path.join(index.root, "archive"))
+    index.move_path("reports", "archive")
+    assert _names(index.search("report_q3")) == ["archive/report_q3.txt"]
+
+    index.remove_path("archive")
+    assert _names(index.search("report")) == []
+
+
+def test_list_search_is_answered_from_the_index(client, raid_dir, write_file):
+    from routes import files
+
+    write_file(os.path.join(raid_dir, "indexed", "needle_in_haystack.txt"), b"n")
+    files.search_index.upsert_path("indexed/needle_in_haystack.txt")
+    response = client.get("/files/list", params={"q": "needle_in"})
+    assert response.status_code == 200
+    assert [item["name"] for item in response.json()["items"]] == ["indexed/needle_in_haystack.txt"]
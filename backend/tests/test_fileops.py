@@ -0,0 +1,138 @@
+import errno
+import json
+import os
+
+import pytest
+from fastapi import HTTPException
+
+from services import file_index, fileops, storage
+
+
+class Cancelled(Exception):
+    pass
+
+
+@pytest.fixture
+def pool(tmp_path):
+    root = tmp_path / "root"
+    root.mkdir()
+    return storage.StoragePool([storage.Volume(str(root))])
+
+
+@pytest.fixture
+def index(tmp_path, pool):
+    index = file_index.FileIndex(str(tmp_path / "index.db"), pool)
+    index.rebuild()
+    return index
+
+
+def _path(pool, rel_path):
+    return os.path.join(pool.root, rel_path)
+
+
+def _read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _hidden(pool, rel_dir=""):
+    return [name for name in os.listdir(_path(pool, rel_dir)) if name.startswith(".")]
+
+
+def test_existing_destination_needs_overwrite(pool, index, write_file):
+    write_file(_path(pool, "a.txt"), b"a")
+    write_file(_path(pool, "b.txt"), b"b")
+    with pytest.raises(HTTPException) as exc:
+        fileops.copy_path(pool, index, "a.txt", "b.txt")
+    assert exc.value.status_code == 409
+
+    fileops.copy_path(pool, index, "a.txt", "b.txt", overwrite=True)
+    assert _read(_path(pool, "b.txt")) == b"a"
+
+
+def test_a_failed_overwriting_copy_keeps_the_destination(pool, index, write_file, monkeypatch):
+    write_file(_path(pool, "new.bin"), b"new" * 1000)
+    write_file(_path(pool, "keep.bin"), b"precious")
+
+    def broken_copy(src, dest, on_progress=None):
+        with open(dest, "wb") as f:
+            f.write(b"partial")
+        raise OSError(errno.EIO, "I/O error")
+
+    monkeypatch.setattr(fileops, "copy_file", broken_copy)
+    with pytest.raises(OSError):
+        fileops.copy_path(pool, index, "new.bin", "keep.bin", overwrite=True)
+    assert _read(_path(pool, "keep.bin")) == b"precious"
+    assert _hidden(pool) == []
+
+
+def test_a_cancelled_overwriting_tree_copy_keeps_the_destination(pool, index, write_file):
+    for name in ("1", "2", "3"):
+        write_file(_path(pool, f"src/{name}.txt"), name.encode())
+    write_file(_path(pool, "dest/old.txt"), b"old")
+    calls = []
+
+    def cancel_on_second_file():
+        calls.append(1)
+        if len(calls) == 2:
+            raise Cancelled()
+
+    with pytest.raises(Cancelled):
+        fileops.copy_path(pool, index, "src", "dest", overwrite=True, check_cancelled=cancel_on_second_file)
+    assert os.listdir(_path(pool, "dest")) == ["old.txt"]
+    assert _hidden(pool) == []
+
+
+def test_overwriting_a_directory_replaces_it_whole(pool, index, write_file):
+    write_file(_path(pool, "src/new.txt"), b"new")
+    write_file(_path(pool, "dest/old.txt"), b"old")
+    fileops.copy_path(pool, index, "src", "dest", overwrite=True)
+    assert os.listdir(_path(pool, "dest")) == ["new.txt"]
+
+    write_file(_path(pool, "other/x.txt"), b"x")
+    fileops.move_path(pool, index, "other", "dest", overwrite=True)
+    assert os.listdir(_path(pool, "dest")) == ["x.txt"]
+    assert not os.path.exists(_path(pool, "other"))
+    assert _hidden(pool) == []
+
+
+def test_a_failed_cross_device_move_keeps_both_sides(pool, index, write_file, monkeypatch):
+    write_file(_path(pool, "src.bin"), b"moving")
+    write_file(_path(pool, "dest.bin"), b"precious")
+
+    install = fileops._install
+
+    def install_across_devices(ready, full_dest):
+        # Renaming the source itself fails as it would across filesystems; the copy's temp file is fine
+        if ready == _path(pool, "src.bin"):
+            raise OSError(errno.EXDEV, "Invalid cross-device link")
+        install(ready, full_dest)
+
+    def broken_copy(src, dest, on_progress=None):
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+    monkeypatch.setattr(fileops, "_install", install_across_devices)
+    monkeypatch.setattr(fileops, "copy_file", broken_copy)
+    with pytest.raises(OSError):
+        fileops.move_path(pool, index, "src.bin", "dest.bin", overwrite=True)
+    assert _read(_path(pool, "src.bin")) == b"moving"
+    assert _read(_path(pool, "dest.bin")) == b"precious"
+
+
+def test_batch_runs_dependent_operations_in_order(client, raid_dir, write_file):
+    write_file(os.path.join(raid_dir, "batch", "a.txt"), b"a")
+    write_file(os.path.join(raid_dir, "batch", "b.txt"), b"b")
+    operations = [
+        {"op": "copy", "path": "batch/a.txt", "destination": "batch/c.txt"},
+        {"op": "rename", "path": "batch/c.txt", "name": "d.txt"},
+        {"op": "move", "path": "batch/d.txt", "destination": "batch/b.txt", "overwrite": True},
+        {"op": "delete", "path": "batch/a.txt"},
+        {"op": "delete", "path": "batch/missing.txt"},
+    ]
+    response = client.post("/files/batch", json={"operations": operations, "background": False})
+    assert response.status_code == 200
+    results = sorted((json.loads(line) for line in response.text.splitlines()), key=lambda r: r["index"])
+    assert [r["status"] for r in results] == ["ok", "ok", "ok", "ok", "error"]
+    assert results[4]["code"] == 404
+    assert sorted(os.listdir(os.path.join(raid_dir, "batch"))) == ["b.txt"]
+    assert _read(os.path.join(raid_dir, "batch", "b.txt")) == b"a"
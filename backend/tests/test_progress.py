@@ -0,0 +1,61 @@
+import time
+
+import pytest
+from starlette.websockets import WebSocketDisconnect
+
+from conftest import TEST_USER
+from services import progress
+
+
+def _ticket(client, job_ids=None):
+    response = client.post("/files/jobs/ticket", json={} if job_ids is None else {"job_id": job_ids})
+    assert response.status_code == 200
+    return response.json()["ticket"]
+
+
+def _wait_for_subscription():
+    deadline = time.monotonic() + 5
+    while not progress.hub._subscriptions.get(TEST_USER["user_id"]):
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def _receive_updates(websocket):
+    while True:
+        batch = websocket.receive_json()
+        if batch:
+            return batch
+
+
+def test_streams_need_a_valid_ticket_or_bearer_token(client):
+    assert client.get("/files/jobs/events").status_code == 401
+    assert client.get("/files/jobs/events", params={"ticket": "made-up"}).status_code == 401
+
+
+def test_a_ticket_cannot_open_a_stream_of_jobs_outside_its_scope(client):
+    ticket = _ticket(client, ["job-a"])
+    response = client.get("/files/jobs/events", params={"ticket": ticket, "job_id": "job-b"})
+    assert response.status_code == 403
+
+    with pytest.raises(WebSocketDisconnect):
+        with client.websocket_connect(f"/files/jobs/ws?ticket={ticket}&job_id=job-b") as websocket:
+            websocket.receive_json()
+
+
+def test_an_empty_scope_is_refused_rather_than_read_as_every_job(client):
+    assert client.post("/files/jobs/ticket", json={"job_id": []}).status_code == 400
+
+
+def test_a_scoped_ticket_only_receives_its_own_jobs(client):
+    ticket = _ticket(client, ["job-a"])
+    with client.websocket_connect(f"/files/jobs/ws?ticket={ticket}") as websocket:
+        _wait_for_subscription()
+        progress.hub.publish(TEST_USER["user_id"], {"job_id": "job-b", "status": "running"})
+        progress.hub.publish(TEST_USER["user_id"], {"job_id": "job-a", "status": "running"})
+        assert [update["job_id"] for update in _receive_updates(websocket)] == ["job-a"]
+
+
+def test_an_empty_job_list_subscribes_to_nothing():
+    subscription = progress.Subscription(1, set(), loop=None)
+    subscription.offer({"job_id": "any"})
+    assert subscription.pending == {}
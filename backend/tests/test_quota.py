@@ -0,0 +1,130 @@
+import os
+import uuid
+
+import pytest
+from fastapi import HTTPException
+
+from services import quota, state, storage, uploads
+
+MB = 1024 * 1024
+
+
+@pytest.fixture
+def pool(tmp_path):
+    root = tmp_path / "root"
+    root.mkdir()
+    return storage.StoragePool([storage.Volume(str(root))])
+
+
+@pytest.fixture
+def ledger(tmp_path, pool):
+    return quota.QuotaLedger(str(tmp_path / "quota.db"), pool, default_quota=10 * MB)
+
+
+@pytest.fixture
+def user_id():
+    # The reservation counters live in the process-wide state store; keep tests apart
+    return uuid.uuid4().int % 10**9
+
+
+def reserved(user_id, session=False):
+    return state.store.get(quota._reservation_key(user_id, session)[0]) or 0
+
+
+def test_reserve_refuses_what_does_not_fit_and_release_frees_it(ledger, user_id):
+    first = ledger.reserve(user_id, 6 * MB)
+    with pytest.raises(HTTPException) as exc:
+        ledger.reserve(user_id, 6 * MB)
+    assert exc.value.status_code == 507
+    # A refused reservation leaves nothing behind
+    assert reserved(user_id) == 6 * MB
+
+    ledger.release(first)
+    assert reserved(user_id) == 0
+    ledger.release(ledger.reserve(user_id, 6 * MB))
+
+
+def test_recorded_files_count_against_the_quota(ledger, pool, user_id):
+    with open(os.path.join(pool.root, "a.bin"), "wb") as f:
+        f.write(b"x" * (8 * MB))
+    ledger.record(user_id, "a.bin", 8 * MB)
+    assert ledger.usage(user_id) == 8 * MB
+    with pytest.raises(HTTPException):
+        ledger.release(ledger.reserve(user_id, 3 * MB))
+    # Overwriting the file only needs room for the difference
+    ledger.release(ledger.reserve(user_id, 9 * MB, replacing="a.bin"))
+
+
+def test_unlimited_users_reserve_nothing(tmp_path, pool, user_id):
+    ledger = quota.QuotaLedger(str(tmp_path / "unlimited.db"), pool, default_quota=0)
+    reservation = ledger.reserve(user_id, 100 * MB)
+    assert reserved(user_id) == 0
+    ledger.release(reservation)
+
+
+def test_session_reservation_is_held_until_the_session_is_aborted(ledger, pool, user_id):
+    released = []
+
+    def release(meta):
+        released.append(meta["upload_id"])
+        ledger.release(meta["reservation"])
+
+    reservation = ledger.reserve(user_id, 6 * MB, session=True)
+    meta = uploads.create_session(pool.root, user_id, "", "big.bin", 6 * MB,
+                                  reservation=reservation, on_removed=release)
+    assert reserved(user_id, session=True) == 6 * MB
+    # Counted against the quota alongside short-lived reservations
+    with pytest.raises(HTTPException):
+        ledger.reserve(user_id, 5 * MB)
+
+    uploads.abort_session(pool.root, meta, release)
+    uploads.abort_session(pool.root, meta, release)
+    assert released == [meta["upload_id"]]
+    assert reserved(user_id, session=True) == 0
+
+
+def test_purging_a_stale_session_releases_its_reservation(ledger, pool, user_id):
+    meta = uploads.create_session(pool.root, user_id, "", "stale.bin", 4 * MB,
+                                  reservation=ledger.reserve(user_id, 4 * MB, session=True))
+    assert reserved(user_id, session=True) == 4 * MB
+
+    uploads.purge_stale_sessions(pool.root, ttl=-1, on_removed=lambda m: ledger.release(m["reservation"]))
+    assert reserved(user_id, session=True) == 0
+    with pytest.raises(HTTPException) as exc:
+        uploads.load_session(pool.root, meta["upload_id"], user_id)
+    assert exc.value.status_code == 404
+
+
+def test_chunked_upload_holds_its_quota_until_the_session_ends(client, monkeypatch):
+    from routes import files
+
+    monkeypatch.setattr(files.quota_ledger, "default_quota", 2 * MB)
+    init = client.post("/files/upload/init", json={"filename": "held.bin", "size": int(1.5 * MB),
+                                                    "path": "quota-chunked"})
+    assert init.status_code == 200
+    assert client.post("/files/upload/init", json={"filename": "other.bin", "size": MB,
+                                                   "path": "quota-chunked"}).status_code == 507
+
+    assert client.delete(f"/files/upload/{init.json()['upload_id']}").status_code == 200
+    second = client.post("/files/upload/init", json={"filename": "other.bin", "size": MB,
+                                                     "path": "quota-chunked"})
+    assert second.status_code == 200
+    client.delete(f"/files/upload/{second.json()['upload_id']}")
+
+
+def test_multipart_uploads_and_copies_are_charged(client, raid_dir, monkeypatch):
+    from routes import files
+
+    monkeypatch.setattr(files.quota_ledger, "default_quota", 3 * MB)
+    assert client.post("/files/upload", params={"path": "quota-copy"},
+                       files={"file": ("a.bin", b"a" * (2 * MB))}).status_code == 200
+    assert client.post("/files/upload", params={"path": "quota-copy"},
+                       files={"file": ("b.bin", b"b" * (2 * MB))}).status_code == 507
+    assert not os.path.exists(os.path.join(raid_dir, "quota-copy", "b.bin"))
+
+    copy = client.post("/files/copy", json={"path": "quota-copy/a.bin", "destination": "quota-copy/c.bin",
+                                            "background": False})
+    assert copy.status_code == 507
+    assert not os.path.exists(os.path.join(raid_dir, "quota-copy", "c.bin"))
+
+    client.delete("/files/delete/quota-copy")
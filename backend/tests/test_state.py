@@ -0,0 +1,73 @@
+import time
+
+import pytest
+
+from services import state
+
+
+class FlakyStore(state.StateStore):
+    """Local store whose lease operations can be made to fail, like an unreachable Redis."""
+
+    def __init__(self):
+        super().__init__()
+        self.down = False
+
+    def acquire(self, name, owner, ttl):
+        if self.down:
+            raise ConnectionError("state store unreachable")
+        return super().acquire(name, owner, ttl)
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+@pytest.fixture
+def store():
+    return FlakyStore()
+
+
+def test_leader_steps_down_on_a_lost_lease_and_recovers(store):
+    calls = []
+    leadership = state.Leadership(store, name="test-recover", ttl=0.3)
+    leadership.start(lambda: calls.append("elected"), lambda: calls.append("demoted"))
+    try:
+        assert leadership.is_leader
+        assert calls == ["elected"]
+
+        store.down = True
+        assert wait_for(lambda: not leadership.is_leader)
+        assert calls == ["elected", "demoted"]
+        assert leadership._thread.is_alive()
+
+        store.down = False
+        assert wait_for(lambda: leadership.is_leader)
+        assert calls == ["elected", "demoted", "elected"]
+    finally:
+        leadership.stop()
+    assert not leadership._thread.is_alive()
+
+
+def test_lease_held_elsewhere_keeps_a_process_out_until_it_expires(store):
+    store.acquire("test-takeover", "other-process", 0.3)
+    leadership = state.Leadership(store, name="test-takeover", ttl=0.3)
+    leadership.start(lambda: None)
+    try:
+        assert not leadership.is_leader
+        assert wait_for(lambda: leadership.is_leader)
+    finally:
+        leadership.stop()
+
+
+def test_stop_hands_the_lease_over(store):
+    leadership = state.Leadership(store, name="test-stop", ttl=30)
+    leadership.start(lambda: None)
+    assert leadership.is_leader
+    leadership.stop()
+    assert not leadership.is_leader
+    assert store.acquire("test-stop", "other-process", 30)
@@ -0,0 +1,98 @@
+import os
+
+import pytest
+
+from services import storage
+
+
+@pytest.fixture
+def volumes(tmp_path):
+    paths = [tmp_path / "hdd", tmp_path / "ssd"]
+    for path in paths:
+        path.mkdir()
+    return [storage.Volume(str(path)) for path in paths]
+
+
+@pytest.fixture
+def rebalancer(volumes):
+    return storage.Rebalancer(storage.StoragePool(volumes))
+
+
+def _read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _leftovers(*dirs):
+    return [name for d in dirs if os.path.isdir(d) for name in os.listdir(d) if name.endswith(".migrate")]
+
+
+def test_migrate_moves_the_file(rebalancer, volumes, write_file):
+    source, target = volumes
+    write_file(os.path.join(source.path, "d", "f.bin"), b"x" * 100_000)
+
+    assert rebalancer.migrate("d/f.bin", source, target)
+    assert not os.path.exists(os.path.join(source.path, "d", "f.bin"))
+    assert _read(os.path.join(target.path, "d", "f.bin")) == b"x" * 100_000
+    assert rebalancer.pool.locate("d/f.bin") == os.path.join(target.path, "d", "f.bin")
+
+
+def test_migrate_keeps_a_file_appended_to_during_the_copy(rebalancer, volumes, write_file, monkeypatch):
+    source, target = volumes
+    src = write_file(os.path.join(source.path, "d", "f.bin"), b"x" * 100_000)
+    copy_file = storage.copy_file
+
+    def copy_then_write(from_path, to_path, *args):
+        copy_file(from_path, to_path, *args)
+        with open(from_path, "ab") as f:
+            f.write(b"late write")
+
+    monkeypatch.setattr(storage, "copy_file", copy_then_write)
+    assert not rebalancer.migrate("d/f.bin", source, target)
+    assert _read(src) == b"x" * 100_000 + b"late write"
+    assert not os.path.exists(os.path.join(target.path, "d", "f.bin"))
+    assert _leftovers(os.path.dirname(src), os.path.join(target.path, "d")) == []
+
+
+def test_migrate_keeps_a_file_replaced_during_the_copy(rebalancer, volumes, write_file, monkeypatch):
+    source, target = volumes
+    src = write_file(os.path.join(source.path, "d", "f.bin"), b"old" * 1000)
+    copy_file = storage.copy_file
+
+    def copy_then_replace(from_path, to_path, *args):
+        copy_file(from_path, to_path, *args)
+        write_file(from_path + ".tmp", b"new")
+        os.replace(from_path + ".tmp", from_path)
+
+    monkeypatch.setattr(storage, "copy_file", copy_then_replace)
+    assert not rebalancer.migrate("d/f.bin", source, target)
+    assert _read(src) == b"new"
+    assert not os.path.exists(os.path.join(target.path, "d", "f.bin"))
+
+
+def test_migrate_keeps_a_file_recreated_after_it_was_set_aside(rebalancer, volumes, write_file, monkeypatch):
+    source, target = volumes
+    src = write_file(os.path.join(source.path, "d", "f.bin"), b"old")
+    rename = os.rename
+
+    def rename_then_recreate(from_path, to_path):
+        rename(from_path, to_path)
+        if from_path == src:
+            # A writer opens the name again right after the source was renamed aside
+            write_file(src, b"recreated")
+
+    monkeypatch.setattr(storage.os, "rename", rename_then_recreate)
+    assert not rebalancer.migrate("d/f.bin", source, target)
+    assert _read(src) == b"recreated"
+    assert not os.path.exists(os.path.join(target.path, "d", "f.bin"))
+    assert _leftovers(os.path.dirname(src)) == []
+
+
+def test_migrate_never_replaces_an_existing_target(rebalancer, volumes, write_file):
+    source, target = volumes
+    write_file(os.path.join(source.path, "f.bin"), b"source")
+    write_file(os.path.join(target.path, "f.bin"), b"target")
+
+    assert not rebalancer.migrate("f.bin", source, target)
+    assert _read(os.path.join(source.path, "f.bin")) == b"source"
+    assert _read(os.path.join(target.path, "f.bin")) == b"target"
@@ -0,0 +1,88 @@
+import hashlib
+import os
+
+import pytest
+from fastapi import HTTPException
+
+from services import uploads
+
+CHUNK = uploads.MIN_CHUNK_SIZE
+DATA = os.urandom(2 * CHUNK + 1000)
+
+
+def _chunks(data):
+    return [data[i:i + CHUNK] for i in range(0, len(data), CHUNK)]
+
+
+def _init(client, filename, data=DATA, **extra):
+    response = client.post("/files/upload/init", json={"filename": filename, "size": len(data), "path": "chunked",
+                                                       "chunk_size": CHUNK, **extra})
+    assert response.status_code == 200
+    return response.json()["upload_id"]
+
+
+def _put(client, upload_id, index, chunk, checksum=None):
+    headers = {"x-chunk-sha256": checksum or hashlib.sha256(chunk).hexdigest()}
+    return client.put(f"/files/upload/{upload_id}/chunks/{index}", content=chunk, headers=headers)
+
+
+def test_chunks_sent_out_of_order_assemble_into_the_file(client, raid_dir):
+    upload_id = _init(client, "ordered.bin", sha256=hashlib.sha256(DATA).hexdigest())
+    chunks = _chunks(DATA)
+    for index in (2, 0, 1):
+        assert _put(client, upload_id, index, chunks[index]).status_code == 200
+
+    response = client.post(f"/files/upload/{upload_id}/finalize")
+    assert response.status_code == 200
+    assert response.json()["sha256"] == hashlib.sha256(DATA).hexdigest()
+    with open(os.path.join(raid_dir, "chunked", "ordered.bin"), "rb") as f:
+        assert f.read() == DATA
+
+
+def test_status_reports_what_is_missing_for_a_resume(client):
+    upload_id = _init(client, "resume.bin")
+    chunks = _chunks(DATA)
+    _put(client, upload_id, 0, chunks[0])
+    _put(client, upload_id, 2, chunks[2])
+
+    status = client.get(f"/files/upload/{upload_id}").json()
+    assert status["received_chunks"] == [0, 2]
+    assert status["missing_chunks"] == [1]
+    assert status["offset"] == CHUNK
+    assert client.post(f"/files/upload/{upload_id}/finalize").status_code == 409
+
+    _put(client, upload_id, 1, chunks[1])
+    assert client.post(f"/files/upload/{upload_id}/finalize").status_code == 200
+
+
+def test_a_corrupt_chunk_is_rejected_and_not_recorded(client):
+    upload_id = _init(client, "corrupt.bin")
+    chunk = _chunks(DATA)[0]
+    response = _put(client, upload_id, 0, chunk, checksum=hashlib.sha256(b"other").hexdigest())
+    assert response.status_code == 422
+    assert client.get(f"/files/upload/{upload_id}").json()["received_chunks"] == []
+    client.delete(f"/files/upload/{upload_id}")
+
+
+def test_a_chunk_without_a_checksum_header_is_a_bad_request(client):
+    upload_id = _init(client, "no-header.bin")
+    response = client.put(f"/files/upload/{upload_id}/chunks/0", content=_chunks(DATA)[0])
+    assert response.status_code == 400
+    assert response.json()["detail"] == "X-Chunk-SHA256 header required"
+    client.delete(f"/files/upload/{upload_id}")
+
+
+def test_a_chunk_of_the_wrong_length_is_rejected(client):
+    upload_id = _init(client, "short.bin")
+    chunk = _chunks(DATA)[0][:-1]
+    assert _put(client, upload_id, 0, chunk).status_code == 400
+    assert _put(client, upload_id, 0, _chunks(DATA)[0] + b"x").status_code == 413
+    client.delete(f"/files/upload/{upload_id}")
+
+
+def test_sessions_belong_to_the_user_who_opened_them(tmp_path):
+    meta = uploads.create_session(str(tmp_path), 1, "", "mine.bin", 10, chunk_size=CHUNK)
+    assert uploads.load_session(str(tmp_path), meta["upload_id"], 1)["filename"] == "mine.bin"
+    with pytest.raises(HTTPException) as exc:
+        uploads.load_session(str(tmp_path), meta["upload_id"], 2)
+    assert exc.value.status_code == 404
@@ -0,0 +1,60 @@
+import io
+import os
+import zipfile
+
+import pytest
+
+from services import zipstream
+from services.cas import BLOB_DIR_NAME
+from services.uploads import STAGING_DIR_NAME
+
+
+@pytest.fixture
+def tree(tmp_path, write_file):
+    root = tmp_path / "root"
+    for rel_path, data in [
+        ("a.txt", b"a"),
+        ("docs/b.txt", b"bb"),
+        ("docs/.b.txt.1234.upload", b"half written"),
+        (".hidden/c.txt", b"ccc"),
+        (f"{STAGING_DIR_NAME}/1234.part", b"staged"),
+        (f"{STAGING_DIR_NAME}/1234.chunks/0", b"chunk"),
+        (f"{BLOB_DIR_NAME}/ab/cd/abcd", b"blob"),
+    ]:
+        write_file(os.path.join(root, rel_path), data)
+    return str(root)
+
+
+def _names(archive):
+    return sorted(zipfile.ZipFile(io.BytesIO(archive)).namelist())
+
+
+def test_archive_leaves_out_internal_and_hidden_entries(tree):
+    archive = b"".join(zipstream.stream_zip(tree))
+    assert _names(archive) == ["a.txt", "docs/b.txt"]
+
+
+def test_tree_size_counts_only_archived_files(tree):
+    assert zipstream.tree_size(tree) == 3
+
+
+def test_archive_merges_copies_on_several_volumes(tmp_path, write_file):
+    first, second = tmp_path / "v1", tmp_path / "v2"
+    write_file(os.path.join(first, "x.txt"), b"x")
+    write_file(os.path.join(second, "y.txt"), b"y")
+    write_file(os.path.join(second, STAGING_DIR_NAME, "z.part"), b"z")
+    archive = b"".join(zipstream.stream_zip([str(first), str(second)]))
+    assert _names(archive) == ["x.txt", "y.txt"]
+
+
+def test_download_of_a_folder_excludes_internal_dirs(client, raid_dir, write_file):
+    write_file(os.path.join(raid_dir, "zipped", "keep.txt"), b"keep")
+    write_file(os.path.join(raid_dir, "zipped", ".cache", "skip.txt"), b"skip")
+    response = client.get("/files/download/zipped")
+    assert response.status_code == 200
+    assert _names(response.content) == ["keep.txt"]
+
+
+@pytest.mark.parametrize("path", [STAGING_DIR_NAME, f"{STAGING_DIR_NAME}/x.part", "../outside", "%2e%2e/outside"])
+def test_download_refuses_paths_outside_the_visible_tree(client, path):
+    assert client.get(f"/files/download/{path}").status_code in (403, 404)
@@ -1,7 +1,8 @@
-import { useState, useEffect } from 'react';
+import { useState, useEffect, useRef } from 'react';
 import axios from 'axios';
 import { Folder, File, FileText, Image, Video, Music, FileCode, Share2, Trash2, AlertTriangle } from 'lucide-react';
 import { Dropdown, Modal, Button, Form, InputGroup, ProgressBar } from 'react-bootstrap';
+import { API_BASE } from '../config';
 
 interface FileItem {
     name: string;
@@ -19,6 +20,12 @@ interface FileListProps {
 export const FileList = ({ refreshTrigger, viewMode, currentPath, onNavigate, searchQuery }: FileListProps) => {
     const [items, setItems] = useState<FileItem[]>([]);
     const [message, setMessage] = useState<string | null>(null);
+
+    // Paging State: large folders load one page at a time, on demand
+    const [nextCursor, setNextCursor] = useState<string | null>(null);
+    const [loadingMore, setLoadingMore] = useState(false);
+    // Aborted when the folder or search changes, so a late response never lands in another listing
+    const listController = useRef<AbortController | null>(null);
     
     // Share State
     const [showShareModal, setShowShareModal] = useState(false);
@@ -38,7 +45,7 @@ export const FileList = ({ refreshTrigger, viewMode, currentPath, onNavigate, se
         const fullPath = (currentPath && !searchQuery) ? `${currentPath}/${filename}` : filename;
         
         try {
-            const response = await axios.post('http://localhost:8006/share/create', 
+            const response = await axios.post(`${API_BASE}/share/create`, 
                 { path: fullPath },
                 { headers: { Authorization: `Bearer ${token}` } }
             );
@@ -58,7 +65,7 @@ export const FileList = ({ refreshTrigger, viewMode, currentPath, onNavigate, se
         
         try {
             // Start Zip Job
-            const response = await axios.post(`http://localhost:8006/files/zip/${encodeURIComponent(fullPath)}`, {}, {
+            const response = await axios.post(`${API_BASE}/files/zip/${encodeURIComponent(fullPath)}`, {}, {
                 headers: { Authorization: `Bearer ${token}` }
             });
             
@@ -66,36 +73,51 @@ export const FileList = ({ refreshTrigger, viewMode, currentPath, onNavigate, se
             setShowProgressModal(true);
             setProgress(0);
             
-            // Poll Status
-            const interval = setInterval(async () => {
-                try {
-                    const statusRes = await axios.get(`http://localhost:8006/files/zip/status/${jobId}`, {
-                        headers: { Authorization: `Bearer ${token}` }
-                    });
-                    
-                    const job = statusRes.data;
+            // Progress is pushed over Server-Sent Events. EventSource cannot set headers, so it presents
+            // a short-lived ticket for this job instead of the bearer token
+            const openEvents = async (attemptsLeft: number) => {
+                const ticket = await axios.post(`${API_BASE}/files/jobs/ticket`, { job_id: [jobId] }, {
+                    headers: { Authorization: `Bearer ${token}` }
+                });
+                const events = new EventSource(
+                    `${API_BASE}/files/jobs/events?job_id=${jobId}&ticket=${encodeURIComponent(ticket.data.ticket)}`
+                );
+                events.addEventListener('progress', (event) => {
+                    const job = JSON.parse((event as MessageEvent).data);
                     setProgress(job.progress);
-                    
+
                     if (job.status === 'complete') {
-                        clearInterval(interval);
+                        events.close();
                         // Trigger Download
                          // Short delay to let user see 100%
                         setTimeout(() => {
                              setShowProgressModal(false);
-                             const downloadUrl = `http://localhost:8006/files/zip/download/${jobId}`;
+                             const downloadUrl = `${API_BASE}/files/zip/download/${jobId}`;
                              downloadZipFile(downloadUrl, job.filename);
                         }, 500);
-                    } else if (job.status === 'error') {
-                        clearInterval(interval);
+                    } else if (job.status === 'error' || job.status === 'cancelled') {
+                        events.close();
                         setShowProgressModal(false);
-                        setMessage(`Error zipping file: ${job.error}`);
+                        setMessage(`Error zipping file: ${job.error ?? job.status}`);
                     }
-                } catch (err) {
-                    clearInterval(interval);
-                    setShowProgressModal(false);
-                    setMessage("Error checking zip status.");
-                }
-            }, 1000);
+                });
+                events.onerror = () => {
+                    // EventSource reconnects by itself after network blips; once it gives up
+                    // (the ticket expired, say) start over with a fresh ticket
+                    if (events.readyState === EventSource.CLOSED) {
+                        if (attemptsLeft > 0) {
+                            openEvents(attemptsLeft - 1).catch(() => {
+                                setShowProgressModal(false);
+                                setMessage("Error checking zip status.");
+                            });
+                        } else {
+                            setShowProgressModal(false);
+                            setMessage("Error checking zip status.");
+                        }
+                    }
+                };
+            };
+            await openEvents(3);
             
         } catch (error) {
             console.error("Error starting zip job:", error);
@@ -130,7 +152,7 @@ export const FileList = ({ refreshTrigger, viewMode, currentPath, onNavigate, se
         const token = localStorage.getItem('token');
         const fullPath = (currentPath && !searchQuery) ? `${currentPath}/${filename}` : filename;
 
-        axios.get(`http://localhost:8006/files/download/${encodeURIComponent(fullPath)}`, {
+        axios.get(`${API_BASE}/files/download/${encodeURIComponent(fullPath)}`, {
             responseType: "blob",
             headers: {
                 "Authorization": `Bearer ${token}`
@@ -164,7 +186,7 @@ export const FileList = ({ refreshTrigger, viewMode, currentPath, onNavigate, se
         const token = localStorage.getItem('token');
         const fullPath = (currentPath && !searchQuery) ? `${currentPath}/${filename}` : filename;
         
-        axios.delete(`http://localhost:8006/files/delete/${encodeURIComponent(fullPath)}`, {
+        axios.delete(`${API_BASE}/files/delete/${encodeURIComponent(fullPath)}`, {
             headers: {
                 "Authorization": `Bearer ${token}`
             }
@@ -186,24 +208,33 @@ export const FileList = ({ refreshTrigger, viewMode, currentPath, onNavigate, se
     };
     
     useEffect(() => {
+        const controller = new AbortController();
+        listController.current = controller;
+        setNextCursor(null);
+        setLoadingMore(false);
+
         const fetchFiles = async () => {
             try {
                 const token = localStorage.getItem('token');
-                const response = await axios.get("http://localhost:8006/files/list", {
+                const response = await axios.get(`${API_BASE}/files/list`, {
                     params: { 
                         path: currentPath,
                         q: searchQuery 
                     },
                     headers: {
                         "Authorization": `Bearer ${token}`
-                    }
+                    },
+                    signal: controller.signal
                 });
                 if (response.data.items) {
                     setItems(response.data.items);
+                    // Large folders are paginated; further pages are fetched by loadMore
+                    setNextCursor(response.data.next_cursor ?? null);
                 } else if (response.data.files) {
                     setItems(response.data.files.map((f: string) => ({ name: f, type: 'file' })));
                 }
             } catch (error) {
+                if (axios.isCancel(error)) return;
                 console.error("Error fetching files:", error);
                 setMessage("Failed to fetch files.");
                 if (axios.isAxiosError(error) && error.response?.status === 401) {
@@ -213,8 +244,33 @@ export const FileList = ({ refreshTrigger, viewMode, currentPath, onNavigate, se
         };
 
         fetchFiles();
+        return () => controller.abort();
     }, [refreshTrigger, currentPath, searchQuery]);
 
+    const loadMore = async () => {
+        const controller = listController.current;
+        if (!nextCursor || loadingMore || !controller) return;
+        setLoadingMore(true);
+        try {
+            const token = localStorage.getItem('token');
+            const page = await axios.get(`${API_BASE}/files/list`, {
+                params: { path: currentPath, cursor: nextCursor },
+                headers: {
+                    "Authorization": `Bearer ${token}`
+                },
+                signal: controller.signal
+            });
+            setItems(prev => [...prev, ...page.data.items]);
+            setNextCursor(page.data.next_cursor ?? null);
+        } catch (error) {
+            if (axios.isCancel(error)) return;
+            console.error("Error fetching files:", error);
+            setMessage("Failed to fetch more files.");
+        } finally {
+            if (!controller.signal.aborted) setLoadingMore(false);
+        }
+    };
+
     const handleItemClick = (item: FileItem) => {
         if (item.type === 'directory') {
             onNavigate(item.name);
@@ -468,6 +524,13 @@ export const FileList = ({ refreshTrigger, viewMode, currentPath, onNavigate, se
                             ))}
                         </div>
                     )}
+                    {nextCursor && (
+                        <div className="text-center mt-3">
+                            <Button variant="outline-secondary" onClick={loadMore} disabled={loadingMore}>
+                                {loadingMore ? 'Loading...' : 'Load more'}
+                            </Button>
+                        </div>
+                    )}
                 </>
             )}
         </div>
@@ -0,0 +1,2 @@
+// Backend origin; set VITE_API_URL at build time to serve the API from elsewhere
+export const API_BASE: string = import.meta.env.VITE_API_URL ?? 'http://localhost:8006';